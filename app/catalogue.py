@@ -0,0 +1,260 @@
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from app.jobs import SUPERCUT_JOBS_DB
+
+SUPERCUT_CATALOGUE_DB = os.getenv('SUPERCUT_CATALOGUE_DB') or SUPERCUT_JOBS_DB
+SUPERCUT_DIR = 'app/static/videos'
+# Remove the least recently watched supercuts once the library is bigger than this, 0 for no limit
+SUPERCUT_LIBRARY_MAX_BYTES = int(os.getenv('SUPERCUT_LIBRARY_MAX_BYTES', '0'))
+# Only record that a supercut was watched again once this many seconds have passed,
+# so page views rarely write to the catalogue
+SUPERCUT_ACCESSED_INTERVAL = float(os.getenv('SUPERCUT_ACCESSED_INTERVAL', '300'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS supercuts (
+    filename TEXT PRIMARY KEY,
+    query TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    search_type TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    profile TEXT,
+    clips TEXT,
+    preview INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS supercuts_accessed ON supercuts (accessed);
+CREATE INDEX IF NOT EXISTS supercuts_query ON supercuts (query);
+"""
+
+# Columns added since the first version of the schema
+MIGRATIONS = {
+    'profile': 'ALTER TABLE supercuts ADD COLUMN profile TEXT',
+    'clips': 'ALTER TABLE supercuts ADD COLUMN clips TEXT',
+    'preview': 'ALTER TABLE supercuts ADD COLUMN preview INTEGER NOT NULL DEFAULT 0',
+}
+
+
+def parse_filename(filename):
+    """
+    Returns the (query, page, search_type) of a supercut from its file name,
+    for supercuts generated before the catalogue existed.
+    e.g. supercut_large-elephants_2_image.mp4 -> ('large elephants', 2, 'image')
+    Previews have the same details as the full supercut.
+    """
+    parts = Path(filename).stem.split('_')
+    if len(parts) < 2 or parts[0] != 'supercut':
+        return None
+    page = 1
+    search_type = 'audio'
+    for part in parts[2:]:
+        if part.isdigit():
+            page = int(part)
+        elif part != 'preview':
+            search_type = part
+    return parts[1].replace('-', ' '), page, search_type
+
+
+class SupercutCatalogue():
+    """
+    A persistent record of generated supercuts.
+
+    Finished jobs are added to the catalogue, which then answers whether
+    a supercut exists and lists examples without touching the directory.
+    Once the library is over `max_bytes` the least recently watched
+    supercuts and their posters are deleted. When they were last watched
+    is only updated every `accessed_interval` seconds.
+    """
+    def __init__(
+        self,
+        path=SUPERCUT_CATALOGUE_DB,
+        directory=SUPERCUT_DIR,
+        max_bytes=SUPERCUT_LIBRARY_MAX_BYTES,
+        accessed_interval=SUPERCUT_ACCESSED_INTERVAL,
+    ):
+        self.path = path
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.accessed_interval = accessed_interval
+        self._schema_ready = False
+        self._synced_pid = None
+        self._sync_lock = threading.Lock()
+
+    @contextmanager
+    def connect(self):
+        """
+        A new connection to the catalogue database.
+        """
+        if not self._schema_ready:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        if not self._schema_ready:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(SCHEMA)
+            columns = {row['name'] for row in connection.execute('PRAGMA table_info(supercuts)')}
+            for column, migration in MIGRATIONS.items():
+                if column not in columns:
+                    try:
+                        connection.execute(migration)
+                    except sqlite3.OperationalError:
+                        # Another worker added it first
+                        pass
+            self._schema_ready = True
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def add(self, query, page, search_type, filename, profile=None, clips=None, preview=False):
+        """
+        Record a newly generated supercut, with the encode profile it was made
+        with, the clips it plays and whether it's only a preview, and evict
+        old ones if the library is too big.
+        """
+        now = time.time()
+        with self.connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO supercuts '
+                '(filename, query, page, search_type, size, profile, clips, preview, '
+                'created, accessed) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    filename, query, page, search_type, self.file_size(filename), profile,
+                    None if clips is None else json.dumps(clips), int(preview), now, now,
+                ),
+            )
+        self.evict(keep=filename)
+
+    def get(self, filename):
+        """
+        Returns a supercut's catalogue entry and marks it as recently watched, or None.
+        Its clips are None for supercuts catalogued before they were recorded.
+        Files deleted by hand are found by sync() or forget() rather than checked here.
+        """
+        self.sync()
+        with self.connect() as connection:
+            row = connection.execute(
+                'SELECT * FROM supercuts WHERE filename = ?', (filename,),
+            ).fetchone()
+            if row is None:
+                return None
+            entry = dict(row)
+            entry['clips'] = json.loads(entry['clips']) if entry['clips'] else None
+            now = time.time()
+            if now - entry['accessed'] >= self.accessed_interval:
+                connection.execute(
+                    'UPDATE supercuts SET accessed = ? WHERE filename = ?', (now, filename),
+                )
+                entry['accessed'] = now
+        return entry
+
+    def forget(self, filename):
+        """
+        Remove a supercut from the catalogue, e.g. when its file turns out to have gone.
+        """
+        with self.connect() as connection:
+            connection.execute('DELETE FROM supercuts WHERE filename = ?', (filename,))
+
+    def examples(self):
+        """
+        Returns the queries of every generated supercut in alphabetical order.
+        """
+        self.sync()
+        with self.connect() as connection:
+            rows = connection.execute(
+                'SELECT DISTINCT query FROM supercuts ORDER BY query',
+            ).fetchall()
+        return [row['query'] for row in rows]
+
+    def size(self):
+        """
+        The total size of the library in bytes.
+        """
+        with self.connect() as connection:
+            return connection.execute('SELECT COALESCE(SUM(size), 0) FROM supercuts').fetchone()[0]
+
+    def evict(self, keep=None):
+        """
+        Delete the least recently watched supercuts until the library fits in `max_bytes`.
+        """
+        if not self.max_bytes:
+            return []
+        removed = []
+        with self.connect() as connection:
+            total = connection.execute('SELECT COALESCE(SUM(size), 0) FROM supercuts').fetchone()[0]
+            rows = connection.execute(
+                'SELECT filename, size FROM supercuts ORDER BY accessed',
+            ).fetchall()
+            for row in rows:
+                if total <= self.max_bytes:
+                    break
+                if row['filename'] == keep:
+                    continue
+                connection.execute('DELETE FROM supercuts WHERE filename = ?', (row['filename'],))
+                self.remove_files(row['filename'])
+                total -= row['size']
+                removed.append(row['filename'])
+        return removed
+
+    def file_size(self, filename):
+        """
+        The size of a supercut and its poster in bytes.
+        """
+        size = 0
+        for path in (filename, Path(filename).with_suffix('.jpg')):
+            try:
+                size += os.path.getsize(os.path.join(self.directory, path))
+            except FileNotFoundError:
+                pass
+        return size
+
+    def remove_files(self, filename):
+        """
+        Delete a supercut, its poster and its HLS stream.
+        """
+        stem = Path(filename).stem
+        for path in (filename, f'{stem}.jpg'):
+            try:
+                os.remove(os.path.join(self.directory, path))
+            except FileNotFoundError:
+                pass
+        shutil.rmtree(os.path.join(self.directory, stem), ignore_errors=True)
+
+    def sync(self):
+        """
+        Once per process, add supercuts on disk that aren't in the catalogue,
+        e.g. from before it existed, and forget any that have been deleted.
+        """
+        if self._synced_pid == os.getpid():
+            return
+        with self._sync_lock:
+            if self._synced_pid == os.getpid():
+                return
+            on_disk = {path.name for path in Path(self.directory).glob('*.mp4')}
+            now = time.time()
+            with self.connect() as connection:
+                catalogued = {
+                    row['filename']
+                    for row in connection.execute('SELECT filename FROM supercuts').fetchall()
+                }
+                for filename in catalogued - on_disk:
+                    connection.execute('DELETE FROM supercuts WHERE filename = ?', (filename,))
+                for filename in on_disk - catalogued:
+                    details = parse_filename(filename)
+                    if details:
+                        connection.execute(
+                            'INSERT OR IGNORE INTO supercuts '
+                            '(filename, query, page, search_type, size, created, accessed) '
+                            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (filename, *details, self.file_size(filename), now, now),
+                        )
+            self._synced_pid = os.getpid()
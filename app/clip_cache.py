@@ -0,0 +1,143 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+SUPERCUT_CLIP_CACHE_DIR = os.getenv('SUPERCUT_CLIP_CACHE_DIR') or os.path.join(
+    tempfile.gettempdir(), 'video-search', 'clips',
+)
+SUPERCUT_CLIP_CACHE_MAX_BYTES = int(os.getenv('SUPERCUT_CLIP_CACHE_MAX_BYTES', str(5 * 1024 ** 3)))
+# Clips used this recently may belong to a supercut that's still being joined
+SUPERCUT_CLIP_CACHE_GRACE_SECONDS = float(os.getenv('SUPERCUT_CLIP_CACHE_GRACE_SECONDS', '3600'))
+SUPERCUT_CLIP_CACHE_PRECISION = int(os.getenv('SUPERCUT_CLIP_CACHE_PRECISION', '1'))
+
+
+class DiskCache():
+    """
+    A directory of files with a size cap and least recently used eviction.
+
+    Files are written to a temporary name and renamed into place so readers
+    never see a partial file, and using a file updates its modified time.
+    """
+    suffix = ''
+
+    def __init__(self, directory, max_bytes, grace_seconds):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.grace_seconds = grace_seconds
+
+    def path(self, key):
+        """
+        The file path for a cache key.
+        """
+        return os.path.join(self.directory, f'{key}{self.suffix}')
+
+    def get(self, key):
+        """
+        Returns the path of a cached file and marks it as recently used, or None.
+        """
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def temp_path(self):
+        """
+        A temporary file in the cache directory to write a new entry into.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            dir=self.directory, prefix='.', suffix='.part', delete=False,
+        ) as temp_file:
+            return temp_file.name
+
+    def commit(self, key, temp_path):
+        """
+        Move a new file into the cache and evict old files if needed.
+        """
+        path = self.path(key)
+        os.replace(temp_path, path)
+        self.evict()
+        return path
+
+    def entries(self):
+        """
+        Returns (last used, size, path) for every cached file.
+        """
+        entries = []
+        try:
+            with os.scandir(self.directory) as scanner:
+                for entry in scanner:
+                    # Abandoned partial files are included so they're eventually cleaned up
+                    if entry.is_file() and not entry.name.endswith('.lock'):
+                        try:
+                            stat = entry.stat()
+                        except FileNotFoundError:
+                            continue
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def size(self):
+        """
+        The total size of the cache in bytes.
+        """
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """
+        Remove the least recently used files until the cache fits in `max_bytes`,
+        leaving files used within the grace period for in-progress supercuts.
+        """
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        cutoff = time.time() - self.grace_seconds
+        removed = []
+        for last_used, size, path in entries:
+            if total <= self.max_bytes or last_used > cutoff:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed.append(path)
+        return removed
+
+
+class ClipCache(DiskCache):
+    """
+    A content-addressed on-disk cache of encoded supercut segments.
+
+    Segments are keyed on their source, rounded start and end times, fade and
+    encoder settings, so overlapping supercuts reuse the same encoded clips.
+    The least recently used clips are evicted once the cache is over `max_bytes`.
+    """
+    suffix = '.mp4'
+
+    def __init__(
+        self,
+        directory=SUPERCUT_CLIP_CACHE_DIR,
+        max_bytes=SUPERCUT_CLIP_CACHE_MAX_BYTES,
+        grace_seconds=SUPERCUT_CLIP_CACHE_GRACE_SECONDS,
+    ):
+        super().__init__(directory, max_bytes, grace_seconds)
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def key(self, path, start, end, fade, settings):
+        """
+        Returns the cache key for a segment. Signed URL query strings are
+        ignored so the same object always has the same key.
+        """
+        identity = json.dumps([
+            path.split('?')[0],
+            round(float(start), SUPERCUT_CLIP_CACHE_PRECISION),
+            round(float(end), SUPERCUT_CLIP_CACHE_PRECISION),
+            bool(fade),
+            settings,
+        ], sort_keys=True)
+        return hashlib.sha256(identity.encode('utf-8')).hexdigest()
@@ -0,0 +1,600 @@
+import base64
+import json
+import os
+import re
+import socket
+import threading
+import time
+from datetime import datetime, timezone
+
+from elasticsearch import Elasticsearch
+from urllib3.connection import HTTPConnection
+
+DEBUG = os.getenv('DEBUG', 'false').lower() == 'true'
+ELASTICSEARCH_HOST = os.getenv('ELASTICSEARCH_HOST', 'http://video-search:9200')
+ELASTICSEARCH_CLOUD_ID = os.getenv('ELASTICSEARCH_CLOUD_ID')
+ELASTICSEARCH_API_KEY = os.getenv('ELASTICSEARCH_API_KEY')
+ELASTICSEARCH_CONNECTIONS_PER_NODE = int(os.getenv('ELASTICSEARCH_CONNECTIONS_PER_NODE', '10'))
+ELASTICSEARCH_TIMEOUT = float(os.getenv('ELASTICSEARCH_TIMEOUT', '30'))
+ELASTICSEARCH_MAX_RETRIES = int(os.getenv('ELASTICSEARCH_MAX_RETRIES', '3'))
+ELASTICSEARCH_RETRY_ON_TIMEOUT = os.getenv(
+    'ELASTICSEARCH_RETRY_ON_TIMEOUT', 'true',
+).lower() == 'true'
+ELASTICSEARCH_KEEPALIVE = os.getenv('ELASTICSEARCH_KEEPALIVE', 'true').lower() == 'true'
+ELASTICSEARCH_HTTP_COMPRESS = os.getenv('ELASTICSEARCH_HTTP_COMPRESS', 'false').lower() == 'true'
+ELASTICSEARCH_NESTED = os.getenv('ELASTICSEARCH_NESTED', 'false').lower() == 'true'
+ELASTICSEARCH_INNER_HITS_SIZE = int(os.getenv('ELASTICSEARCH_INNER_HITS_SIZE', '100'))
+INDEX_REPLICAS = int(os.getenv('INDEX_REPLICAS', '1'))
+INDEX_REFRESH_INTERVAL = os.getenv('INDEX_REFRESH_INTERVAL') or None
+INDEX_KEEP_VERSIONS = int(os.getenv('INDEX_KEEP_VERSIONS', '2'))
+# How long a point in time stays open between result pages
+ELASTICSEARCH_PIT_KEEP_ALIVE = os.getenv('ELASTICSEARCH_PIT_KEEP_ALIVE', '5m')
+# How long each worker reuses one point in time for searches without a cursor,
+# shorter than the keep alive so its cursors still work for a while after
+ELASTICSEARCH_PIT_REUSE_SECONDS = float(os.getenv('ELASTICSEARCH_PIT_REUSE_SECONDS', '60'))
+
+# Timestamped lists that are indexed as nested documents so a query can
+# return just the matching segments via inner_hits
+NESTED_PATHS = [
+    'transcription.segments',
+    'classification.captions.huggingface',
+    'classification.captions.clap',
+]
+
+# Fields the search results page needs from each video, the matching
+# segments are added back from inner_hits
+SEARCH_SOURCE_INCLUDES = [
+    'id',
+    'title',
+    'web_resource',
+    'snapshot',
+    'works.id',
+    'works.slug',
+    'works.title',
+]
+
+# The field each search type matches the query against
+SEARCH_FIELDS = {
+    'audio': 'transcription.segments.text',
+    'image': 'classification.captions.huggingface.predictions.prediction',
+    'audioDescription': 'classification.captions.clap.predictions.prediction',
+}
+
+# Paged searches in a point in time sort by relevance, then by each document's
+# place in the point in time, so every page ends at a stable place that
+# search_after can carry on from whatever the index's mapping
+SEARCH_SORT = [{'_score': 'desc'}, {'_shard_doc': 'asc'}]
+# The same order backwards, to fetch the page before a cursor
+REVERSE_SEARCH_SORT = [{'_score': 'asc'}, {'_shard_doc': 'desc'}]
+
+PREDICTIONS_MAPPING = {
+    'type': 'nested',
+    'properties': {
+        'timestamp': {'type': 'float'},
+        'predictions': {
+            'properties': {
+                'prediction': {'type': 'text'},
+                'confidence': {'type': 'float'},
+            },
+        },
+    },
+}
+
+VIDEOS_MAPPING = {
+    'properties': {
+        'id': {'type': 'keyword'},
+        'title': {'type': 'text'},
+        'transcription': {
+            'properties': {
+                'segments': {
+                    'type': 'nested',
+                    'properties': {
+                        'start': {'type': 'float'},
+                        'end': {'type': 'float'},
+                        'text': {'type': 'text'},
+                    },
+                },
+            },
+        },
+        'classification': {
+            'properties': {
+                'captions': {
+                    'properties': {
+                        'huggingface': PREDICTIONS_MAPPING,
+                        'clap': PREDICTIONS_MAPPING,
+                    },
+                },
+            },
+        },
+        # Precomputed for the detail page, stored but not searchable
+        'summaries': {'type': 'object', 'enabled': False},
+    },
+}
+
+# One client per worker process, created on first use
+shared = {
+    'client': None,
+    'pid': None,
+    'lock': threading.Lock(),
+}
+
+
+def get_client():
+    """
+    Returns the shared Elasticsearch client for this process, creating it on first use.
+    A forked child never reuses its parent's sockets, it builds its own client.
+    """
+    client = shared['client']
+    if client is not None and shared['pid'] == os.getpid():
+        return client
+    with shared['lock']:
+        if shared['client'] is None or shared['pid'] != os.getpid():
+            shared['client'] = create_client()
+            shared['pid'] = os.getpid()
+        return shared['client']
+
+
+def create_client():
+    """
+    Build a new Elasticsearch client using the pool settings from the environment.
+    """
+    options = {
+        'connections_per_node': ELASTICSEARCH_CONNECTIONS_PER_NODE,
+        'request_timeout': ELASTICSEARCH_TIMEOUT,
+        'max_retries': ELASTICSEARCH_MAX_RETRIES,
+        'retry_on_timeout': ELASTICSEARCH_RETRY_ON_TIMEOUT,
+        'http_compress': ELASTICSEARCH_HTTP_COMPRESS,
+    }
+    if DEBUG:
+        client = Elasticsearch(ELASTICSEARCH_HOST, **options)
+    else:
+        client = Elasticsearch(
+            cloud_id=ELASTICSEARCH_CLOUD_ID,
+            api_key=ELASTICSEARCH_API_KEY,
+            **options,
+        )
+    if ELASTICSEARCH_KEEPALIVE:
+        enable_tcp_keepalive(client)
+    return client
+
+
+def enable_tcp_keepalive(client):
+    """
+    Turn on TCP keep-alive for new pooled connections so idle sockets
+    aren't silently dropped by the Elastic Cloud load balancer.
+    """
+    socket_options = HTTPConnection.default_socket_options + [
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+    ]
+    for node in client.transport.node_pool.all():
+        pool = getattr(node, 'pool', None)
+        if pool is not None and hasattr(pool, 'conn_kw'):
+            pool.conn_kw['socket_options'] = socket_options
+
+
+def reset_client():
+    """
+    Drop the shared client, closing its connections if it belongs to this process.
+    """
+    with shared['lock']:
+        if shared['client'] is not None and shared['pid'] == os.getpid():
+            shared['client'].close()
+        shared['client'] = None
+        shared['pid'] = None
+
+
+def _forget_client_after_fork():
+    """
+    A child process must not share the parent's sockets or lock state.
+    """
+    shared['client'] = None
+    shared['pid'] = None
+    shared['lock'] = threading.Lock()
+
+
+def pool_stats():
+    """
+    Returns the connection pool statistics for the shared client.
+    """
+    stats = {
+        'pid': os.getpid(),
+        'created': shared['client'] is not None and shared['pid'] == os.getpid(),
+        'connections_per_node': ELASTICSEARCH_CONNECTIONS_PER_NODE,
+        'timeout': ELASTICSEARCH_TIMEOUT,
+        'max_retries': ELASTICSEARCH_MAX_RETRIES,
+        'retry_on_timeout': ELASTICSEARCH_RETRY_ON_TIMEOUT,
+        'keepalive': ELASTICSEARCH_KEEPALIVE,
+        'nodes': [],
+    }
+    if not stats['created']:
+        return stats
+    for node in shared['client'].transport.node_pool.all():
+        node_stats = {'base_url': node.base_url}
+        pool = getattr(node, 'pool', None)
+        if pool is not None:
+            node_stats['connections_opened'] = getattr(pool, 'num_connections', None)
+            node_stats['requests'] = getattr(pool, 'num_requests', None)
+            if getattr(pool, 'pool', None) is not None:
+                node_stats['idle_connections'] = sum(
+                    1 for connection in list(pool.pool.queue) if connection is not None
+                )
+        stats['nodes'].append(node_stats)
+    return stats
+
+
+def ensure_index(client, index):
+    """
+    Create the index with the nested video mapping if it doesn't exist yet.
+    """
+    if client.indices.exists(index=index):
+        return False
+    client.indices.create(index=index, mappings=VIDEOS_MAPPING)
+    return True
+
+
+def nested_path(field):
+    """
+    Returns the nested document path for a field, or None if it isn't nested.
+    e.g. transcription.segments.text -> transcription.segments
+    """
+    for path in NESTED_PATHS:
+        if field.startswith(f'{path}.'):
+            return path
+    return None
+
+
+def nested_query(field, query, path):
+    """
+    A match_phrase query that only returns the matching nested segments
+    and the few top level fields the results page displays.
+    """
+    return {
+        'query': {
+            'nested': {
+                'path': path,
+                'query': {
+                    'match_phrase': {
+                        field: query,
+                    },
+                },
+                'inner_hits': {
+                    'size': ELASTICSEARCH_INNER_HITS_SIZE,
+                },
+            },
+        },
+        '_source': {
+            'includes': SEARCH_SOURCE_INCLUDES,
+        },
+    }
+
+
+def merge_inner_hits(search_results, path):
+    """
+    Put the matching segments from inner_hits back into each hit's _source
+    so templates can treat them the same as a full document.
+    """
+    for hit in search_results['hits']['hits']:
+        segments = [
+            inner_hit['_source']
+            for inner_hit in hit.get('inner_hits', {}).get(path, {}).get('hits', {}).get('hits', [])
+        ]
+        segments.sort(key=lambda segment: segment.get('start', segment.get('timestamp', 0)))
+        source = hit.setdefault('_source', {})
+        keys = path.split('.')
+        for key in keys[:-1]:
+            source = source.setdefault(key, {})
+        source[keys[-1]] = segments
+    return search_results
+
+
+def search_body(field, query, size, offset=0, path=None):
+    """
+    A match_phrase search for one page of results. With a nested `path`
+    only the matching segments are returned, via inner_hits.
+    """
+    body = {'size': size, 'from': offset}
+    if path:
+        body.update(nested_query(field, query, path))
+    else:
+        body['query'] = {
+            'match_phrase': {
+                field: query,
+            },
+        }
+    return body
+
+
+def msearch_searches(index, query, search_types, size, offset=0, nested=False, counts=True):
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    """
+    Returns the header and body lines of a multi-search with one compact search
+    per search type. Without `nested` each hit's _source is cut down to the
+    displayed fields and its segments. Without `counts` totals aren't tracked,
+    which is cheaper for top hits only.
+    """
+    searches = []
+    for search_type in search_types:
+        field = SEARCH_FIELDS[search_type]
+        path = nested_path(field)
+        body = search_body(field, query, size, offset, path if nested else None)
+        if not nested:
+            body['_source'] = {'includes': SEARCH_SOURCE_INCLUDES + [path]}
+        body['track_total_hits'] = counts
+        searches += [{'index': index}, body]
+    return searches
+
+
+def lookup_path(source, path):
+    """
+    Returns the value at a dotted path in a document's _source, or None.
+    """
+    for key in path.split('.'):
+        if not isinstance(source, dict):
+            return None
+        source = source.get(key)
+    return source
+
+
+def matching_segments(segments, query):
+    """
+    Returns the transcript segments whose text contains the query, or the
+    caption frames with just their predictions that contain it.
+    """
+    query = query.lower()
+    matches = []
+    for segment in segments or []:
+        if 'text' in segment:
+            if query in segment['text'].lower():
+                matches.append(segment)
+            continue
+        predictions = [
+            prediction for prediction in segment.get('predictions') or []
+            if query in prediction.get('prediction', '').lower()
+        ]
+        if predictions:
+            matches.append({**segment, 'predictions': predictions})
+    return matches
+
+
+def compact_hit(hit, search_type, query, nested=False):
+    """
+    A search hit cut down to the video's displayed fields, its score and
+    its matching segments with their timestamps.
+    """
+    source = hit.get('_source') or {}
+    path = nested_path(SEARCH_FIELDS[search_type])
+    if nested:
+        segments = lookup_path(source, path) or []
+    else:
+        segments = matching_segments(lookup_path(source, path), query)
+    return {
+        'id': source.get('id', hit.get('_id')),
+        'score': hit.get('_score'),
+        'title': source.get('title'),
+        'web_resource': source.get('web_resource'),
+        'snapshot': source.get('snapshot'),
+        'works': source.get('works') or [],
+        'segments': segments,
+    }
+
+
+def encode_cursor(pit, sort_values, direction='next'):
+    """
+    Returns a URL-safe cursor for the page after (or before) a hit's sort values
+    in a point in time.
+    """
+    data = json.dumps(
+        {'pit': pit, 'after': sort_values, 'direction': direction},
+        separators=(',', ':'),
+    )
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Returns the point in time, sort values and direction in a cursor,
+    or None if it isn't a valid cursor.
+    """
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(data, dict) or not isinstance(data.get('after'), list) \
+            or data.get('direction') not in ('next', 'previous'):
+        return None
+    return data
+
+
+def cursor_body(body, cursor, pit, keep_alive=ELASTICSEARCH_PIT_KEEP_ALIVE):
+    """
+    Turns a search body into a sorted search in a point in time, for the page
+    after or before a cursor, so deep pages cost the same as the first one.
+    Without a cursor it's the page at the body's `from`, which starts a cursor chain.
+    A point in time search names its index in the pit rather than the URL.
+    """
+    body = dict(body, sort=SEARCH_SORT, track_scores=True)
+    if cursor:
+        del body['from']
+        body['search_after'] = cursor['after']
+        if cursor['direction'] == 'previous':
+            body['sort'] = REVERSE_SEARCH_SORT
+    body['pit'] = {'id': pit, 'keep_alive': keep_alive}
+    return body
+
+
+class SharedPointsInTime():
+    """
+    One point in time per client and index, shared by every search in this
+    worker that doesn't carry a cursor, so new searches don't each open one
+    that's left to expire. A point in time older than `reuse_seconds` is left to expire
+    and a new one opened, so results stay fresh.
+    """
+    def __init__(self, reuse_seconds=ELASTICSEARCH_PIT_REUSE_SECONDS):
+        self.reuse_seconds = reuse_seconds
+        self._pits = {}
+        self._lock = threading.Lock()
+
+    def get(self, client, index, open_point_in_time):
+        """
+        Returns the point in time for a client's index, opening one with
+        open_point_in_time(index) if there isn't a recent one.
+        """
+        with self._lock:
+            pit, opened = self._pits.get((client, index), (None, 0))
+            if pit is None or time.monotonic() - opened > self.reuse_seconds:
+                pit, opened = open_point_in_time(index), time.monotonic()
+                self._pits[(client, index)] = (pit, opened)
+            return pit
+
+    def replace(self, pit, new_pit):
+        """
+        Use the id Elasticsearch returned for a point in time from now on,
+        or forget the point in time if there's no new id.
+        """
+        with self._lock:
+            for key, (shared_pit, opened) in list(self._pits.items()):
+                if shared_pit == pit:
+                    if new_pit:
+                        self._pits[key] = (new_pit, opened)
+                    else:
+                        del self._pits[key]
+
+
+def has_next_page(search_results, page, size):
+    """
+    Whether there are more results after this page of search results.
+    """
+    total = search_results['hits']['total']
+    more = page * size < total['value'] or total.get('relation') == 'gte'
+    return len(search_results['hits']['hits']) == size and more
+
+
+def page_cursors(search_results, page, size):
+    """
+    Returns the (previous, next) page cursors for a page of search results,
+    None where there's no such page or the page has no point in time, e.g.
+    because it came from the search cache. The page before page 2 is the
+    first page, which doesn't need a cursor.
+    """
+    hits = search_results['hits']['hits']
+    pit = search_results.get('pit_id')
+    if not hits or 'sort' not in hits[0] or not pit:
+        return None, None
+    previous_cursor = encode_cursor(pit, hits[0]['sort'], 'previous') if page > 2 else None
+    next_cursor = encode_cursor(pit, hits[-1]['sort']) \
+        if has_next_page(search_results, page, size) else None
+    return previous_cursor, next_cursor
+
+
+def versioned_index_name(alias, when=None):
+    """
+    Returns a timestamped index name for an alias, for now unless `when` is given.
+    e.g. videos -> videos-20250101120000
+    """
+    when = when or datetime.now(timezone.utc)
+    return f'{alias}-{when.strftime("%Y%m%d%H%M%S")}'
+
+
+def create_build_index(client, index, nested=ELASTICSEARCH_NESTED):
+    """
+    Create an index tuned for bulk loading: no refreshes and no replicas.
+    """
+    options = {
+        'index': index,
+        'settings': {
+            'index': {
+                'refresh_interval': '-1',
+                'number_of_replicas': 0,
+            },
+        },
+    }
+    if nested:
+        options['mappings'] = VIDEOS_MAPPING
+    client.indices.create(**options)
+
+
+def finalise_build_index(client, index):
+    """
+    Merge a freshly loaded index down to one segment and restore its
+    refresh interval and replicas so it's ready to serve searches.
+    """
+    client.options(request_timeout=None).indices.forcemerge(index=index, max_num_segments=1)
+    client.indices.put_settings(
+        index=index,
+        settings={
+            'index': {
+                'refresh_interval': INDEX_REFRESH_INTERVAL,
+                'number_of_replicas': INDEX_REPLICAS,
+            },
+        },
+    )
+    client.indices.refresh(index=index)
+
+
+def alias_indices(client, alias):
+    """
+    Returns the names of the indices an alias currently points to.
+    """
+    if not client.indices.exists_alias(name=alias):
+        return []
+    return list(client.indices.get_alias(name=alias).keys())
+
+
+def clone_concrete_index(client, alias):
+    """
+    Copy an old concrete index that has the alias name to a versioned index,
+    named for when the old one was created, so it can be rolled back to once
+    it's been replaced. Returns the copy's name.
+    """
+    settings = client.indices.get_settings(index=alias, name='index.creation_date')
+    created = int(settings[alias]['settings']['index']['creation_date']) / 1000
+    clone = versioned_index_name(alias, datetime.fromtimestamp(created, timezone.utc))
+    # Only an index that can't be written to can be cloned
+    client.indices.put_settings(index=alias, settings={'index.blocks.write': True})
+    client.indices.clone(
+        index=alias,
+        target=clone,
+        settings={'index.blocks.write': False},
+        wait_for_active_shards=1,
+    )
+    return clone
+
+
+def swap_alias(client, alias, index):
+    """
+    Atomically point the alias at the new index. If an old concrete index
+    is still using the alias name it's first cloned to a versioned index
+    to roll back to, then removed in the same request.
+    """
+    actions = [
+        {'remove': {'index': old_index, 'alias': alias}}
+        for old_index in alias_indices(client, alias)
+    ]
+    if not actions and client.indices.exists(index=alias):
+        clone_concrete_index(client, alias)
+        actions.append({'remove_index': {'index': alias}})
+    actions.append({'add': {'index': index, 'alias': alias}})
+    client.indices.update_aliases(actions=actions)
+
+
+def prune_indices(client, alias, keep=INDEX_KEEP_VERSIONS):
+    """
+    Delete old versioned indices for an alias, keeping the newest `keep`
+    plus whatever the alias currently points to.
+    """
+    live = set(alias_indices(client, alias))
+    version_pattern = re.compile(rf'^{re.escape(alias)}-\d{{14}}$')
+    versions = sorted(
+        (
+            name for name in client.indices.get(index=f'{alias}-*').keys()
+            if version_pattern.match(name) and name not in live
+        ),
+        reverse=True,
+    )
+    removed = versions[keep:]
+    for index in removed:
+        client.indices.delete(index=index)
+    return removed
+
+
+os.register_at_fork(after_in_child=_forget_client_after_fork)
@@ -0,0 +1,137 @@
+import atexit
+import glob
+import itertools
+import os
+import socket
+import tempfile
+import threading
+from collections import OrderedDict
+
+SUPERCUT_EVENTS_DIR = os.getenv('SUPERCUT_EVENTS_DIR') or os.path.join(
+    tempfile.gettempdir(), 'video-search', 'events',
+)
+# The most recently published keys each process remembers, older jobs have long finished
+SUPERCUT_EVENTS_MAX_KEYS = int(os.getenv('SUPERCUT_EVENTS_MAX_KEYS', '10000'))
+
+
+class EventChannel():  # pylint: disable=too-many-instance-attributes
+    """
+    Push notifications that a job has changed, shared by every process on this host.
+
+    Each process that waits for events listens on a Unix datagram socket in
+    `directory`. Publishing sends the job id to every listener, so progress
+    streams wake as soon as the supercut worker updates the job. An event may
+    carry a short `data` string, e.g. the job's new state, so listeners don't
+    have to read it back from the database.
+
+    Only the `max_keys` most recently published keys are remembered. Versions
+    never repeat, so a waiter whose key was forgotten just wakes and re-reads.
+    """
+    def __init__(self, directory=SUPERCUT_EVENTS_DIR, max_keys=SUPERCUT_EVENTS_MAX_KEYS):
+        self.directory = directory
+        self.max_keys = max_keys
+        self.condition = threading.Condition()
+        self.versions = OrderedDict()
+        self.payloads = {}
+        self._counter = itertools.count(1)
+        self.address = None
+        self._listening_pid = None
+        self._listen_lock = threading.Lock()
+
+    def publish(self, key, data=None):
+        """
+        Wake everything waiting on `key` in this and every other process,
+        with `data` as the key's latest payload.
+        """
+        self._notify(key, data)
+        message = key if data is None else f'{key}\n{data}'
+        message = message.encode('utf-8')
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sender:
+            # Never block a job on a slow listener, it'll catch up when its wait times out
+            sender.setblocking(False)
+            for address in glob.glob(os.path.join(self.directory, '*.sock')):
+                if address == self.address and self._listening_pid == os.getpid():
+                    continue
+                try:
+                    sender.sendto(message, address)
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # The process that was listening has gone
+                    try:
+                        os.remove(address)
+                    except FileNotFoundError:
+                        pass
+                except OSError:
+                    pass
+
+    def version(self, key):
+        """
+        The version of `key` in this process, which changes every time it's published.
+        """
+        with self.condition:
+            return self.versions.get(key, 0)
+
+    def payload(self, key):
+        """
+        The data published with the latest version of `key`, or None.
+        """
+        with self.condition:
+            return self.payloads.get(key)
+
+    def wait(self, key, version, timeout=None):
+        """
+        Block until `key` is published after `version`, or `timeout` seconds pass.
+        Returns the latest version, which equals `version` if it timed out.
+        """
+        self.listen()
+        with self.condition:
+            self.condition.wait_for(lambda: self.versions.get(key, 0) != version, timeout)
+            return self.versions.get(key, 0)
+
+    def listen(self):
+        """
+        Start this process's listener thread if it isn't running yet.
+        """
+        if self._listening_pid == os.getpid():
+            return
+        with self._listen_lock:
+            if self._listening_pid == os.getpid():
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            address = os.path.join(self.directory, f'{os.getpid()}.sock')
+            try:
+                os.remove(address)
+            except FileNotFoundError:
+                pass
+            receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            receiver.bind(address)
+            atexit.register(self._close, receiver, address)
+            self.address = address
+            self._listening_pid = os.getpid()
+            threading.Thread(target=self._receive, args=(receiver,), daemon=True).start()
+
+    def _receive(self, receiver):
+        while True:
+            try:
+                message = receiver.recv(65536)
+            except OSError:
+                return
+            key, _, data = message.decode('utf-8').partition('\n')
+            self._notify(key, data or None)
+
+    def _notify(self, key, data=None):
+        with self.condition:
+            self.versions[key] = next(self._counter)
+            self.versions.move_to_end(key)
+            self.payloads[key] = data
+            while len(self.versions) > self.max_keys:
+                forgotten, _ = self.versions.popitem(last=False)
+                self.payloads.pop(forgotten, None)
+            self.condition.notify_all()
+
+    @staticmethod
+    def _close(receiver, address):
+        receiver.close()
+        try:
+            os.remove(address)
+        except FileNotFoundError:
+            pass
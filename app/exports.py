@@ -0,0 +1,271 @@
+import atexit
+import glob
+import gzip
+import json
+import os
+import queue
+import threading
+import time
+
+# Where EXPORT_VIDEO_JSON writes each indexed video
+EXPORT_VIDEO_JSON_DIR = os.getenv('EXPORT_VIDEO_JSON_DIR', 'app/static/json')
+# json or json.gz for a file per video named by its id, jsonl or jsonl.gz for
+# shards of EXPORT_VIDEO_JSON_SHARD_SIZE videos, one per line
+EXPORT_VIDEO_JSON_FORMAT = os.getenv('EXPORT_VIDEO_JSON_FORMAT', 'json')
+EXPORT_VIDEO_JSON_SHARD_SIZE = int(os.getenv('EXPORT_VIDEO_JSON_SHARD_SIZE', '1000'))
+# Videos waiting to be written before indexing waits for the writer to catch up
+EXPORT_VIDEO_JSON_QUEUE_SIZE = int(os.getenv('EXPORT_VIDEO_JSON_QUEUE_SIZE', '1000'))
+
+FORMATS = ('json', 'json.gz', 'jsonl', 'jsonl.gz')
+# How long an unfinished shard is left open while nothing is being exported
+SHARD_IDLE_SECONDS = 1
+# Fast enough to keep up with indexing while still shrinking exports several times over
+GZIP_LEVEL = 6
+# Queued to have the writer thread compact its shards
+COMPACT = object()
+
+
+def compact_json(value):
+    """
+    Returns a value as compact UTF-8 JSON bytes.
+    """
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def write_atomically(path, data):
+    """
+    Write a file via a temporary file and a rename, so readers never see half of it.
+    """
+    temporary = os.path.join(os.path.dirname(path), f'.{os.path.basename(path)}.{os.getpid()}.part')
+    with open(temporary, 'wb') as temporary_file:
+        temporary_file.write(data)
+    os.replace(temporary, path)
+
+
+class ExportWriter():  # pylint: disable=too-many-instance-attributes
+    """
+    Writes exported video JSON on a background thread, so indexing only has
+    to put each document on a queue.
+
+    Each video is written as compact JSON to a file named by its id, gzipped
+    for json.gz, or appended to JSON Lines shards for jsonl and jsonl.gz.
+    Every file is written under a temporary name and renamed into place, and
+    a shard only appears once it's full, flushed, or exports have gone quiet.
+    Deleted videos have their file removed, or a tombstone line in a shard.
+    """
+    def __init__(
+        self,
+        directory=EXPORT_VIDEO_JSON_DIR,
+        export_format=EXPORT_VIDEO_JSON_FORMAT,
+        shard_size=EXPORT_VIDEO_JSON_SHARD_SIZE,
+        queue_size=EXPORT_VIDEO_JSON_QUEUE_SIZE,
+    ):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        if export_format not in FORMATS:
+            raise ValueError(f'Unknown export format {export_format}, expected one of {FORMATS}')
+        self.directory = directory
+        self.format = export_format
+        self.shard_size = shard_size
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stats = {'written': 0, 'deleted': 0, 'failed': 0}
+        self._shard = None
+        self._shards = 0
+        self._started_pid = None
+        self._start_lock = threading.Lock()
+
+    def filename(self, document_id):
+        """
+        The name of a video's export file, or None if it's in a shard.
+        """
+        if self.format.startswith('jsonl'):
+            return None
+        return f'{document_id}.{self.format}'
+
+    def write(self, document, encoded=None):
+        """
+        Queue a prepared document to be exported, with its compact JSON if
+        it's already been encoded, e.g. for a bulk request.
+        """
+        self.start()
+        self.queue.put((document, encoded))
+
+    def delete(self, document_id):
+        """
+        Queue the removal of a video's export.
+        """
+        self.write({'id': document_id, 'deleted': True})
+
+    def export_action(self, action):
+        """
+        Queue the export for a bulk action and return the action, with an
+        index action's source encoded once for both the bulk request and the export.
+        """
+        if action['_op_type'] == 'delete':
+            self.delete(action['_id'])
+        elif action['_op_type'] == 'index':
+            document = action['_source']
+            action['_source'] = compact_json(document)
+            self.write(document, action['_source'])
+        return action
+
+    def flush(self):
+        """
+        Block until every queued document has been written and any open shard is in place.
+        """
+        if self._started_pid != os.getpid():
+            return
+        self.queue.put(None)
+        self.queue.join()
+
+    def compact(self):
+        """
+        Flush, then rewrite the JSON Lines shards with only the newest export
+        of each video and without deleted videos, so re-exports don't pile up.
+        """
+        if not self.format.startswith('jsonl'):
+            self.flush()
+            return
+        self.start()
+        self.queue.put(None)
+        self.queue.put(COMPACT)
+        self.queue.join()
+
+    def start(self):
+        """
+        Start this process's writer thread if it isn't running yet.
+        """
+        if self._started_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._started_pid == os.getpid():
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            self._shard = None
+            self._started_pid = os.getpid()
+            atexit.register(self.flush)
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=SHARD_IDLE_SECONDS if self._shard else None)
+            except queue.Empty:
+                self._export(None)
+                continue
+            try:
+                if item is COMPACT:
+                    self._compact()
+                else:
+                    self._export(*(item or (None, None)))
+            finally:
+                self.queue.task_done()
+
+    def _export(self, document, data=None):
+        """
+        Write a document, or finish the open shard if there's no document.
+        Failures are logged and counted so the writer thread never dies.
+        """
+        try:
+            if document is None:
+                self._finish_shard()
+                return
+            if document.get('deleted'):
+                self._delete(document)
+                return
+            data = data or compact_json(document)
+            if self.format.startswith('jsonl'):
+                self._append(data)
+            else:
+                if self.format == 'json.gz':
+                    data = gzip.compress(data, GZIP_LEVEL)
+                write_atomically(
+                    os.path.join(self.directory, self.filename(document.get('id'))), data,
+                )
+            self.stats['written'] += 1
+        except Exception as exception:  # pylint: disable=broad-exception-caught
+            self.stats['failed'] += 1
+            print(f'ERROR: couldn\'t export {document.get("id") if document else "shard"}: '
+                  f'{exception}')
+
+    def _delete(self, tombstone):
+        for export_format in ('json', 'json.gz'):
+            try:
+                os.remove(os.path.join(self.directory, f'{tombstone["id"]}.{export_format}'))
+            except FileNotFoundError:
+                pass
+        if self.format.startswith('jsonl'):
+            # Older shards may still have the video, so readers need to know it's gone
+            self._append(compact_json(tombstone))
+        self.stats['deleted'] += 1
+
+    def _compact(self):
+        """
+        Replace every finished shard with new shards of the newest line for each video.
+        """
+        try:
+            paths = sorted(
+                glob.glob(os.path.join(self.directory, f'videos-*.{self.format}')),
+                key=lambda path: (os.path.getmtime(path), path),
+            )
+            newest = {}
+            lines = 0
+            for path in paths:
+                opener = gzip.open if path.endswith('.gz') else open
+                with opener(path, 'rb') as shard_file:
+                    for line in filter(bytes.strip, shard_file):
+                        lines += 1
+                        document = json.loads(line)
+                        newest.pop(str(document.get('id')), None)
+                        newest[str(document.get('id'))] = (
+                            None if document.get('deleted') else line.rstrip(b'\n')
+                        )
+            compacted = list(filter(None, newest.values()))
+            if len(compacted) == lines:
+                return
+            for data in compacted:
+                self._append(data)
+            self._finish_shard()
+            # The compacted shards are newer, so readers prefer them until these are gone
+            for path in paths:
+                os.remove(path)
+        except Exception as exception:  # pylint: disable=broad-exception-caught
+            self.stats['failed'] += 1
+            print(f'ERROR: couldn\'t compact shards: {exception}')
+
+    def _append(self, data):
+        if self._shard is None:
+            self._shards += 1
+            name = (
+                f'videos-{time.strftime("%Y%m%d%H%M%S")}-{os.getpid()}-{self._shards:05}'
+                f'.{self.format}'
+            )
+            path = os.path.join(self.directory, name)
+            temporary = os.path.join(self.directory, f'.{name}.part')
+            if self.format.endswith('.gz'):
+                shard_file = gzip.open(temporary, 'wb', compresslevel=GZIP_LEVEL)
+            else:
+                shard_file = open(temporary, 'wb')  # pylint: disable=consider-using-with
+            self._shard = {
+                'path': path,
+                'temporary': temporary,
+                'file': shard_file,
+                'lines': 0,
+            }
+        self._shard['file'].write(data + b'\n')
+        self._shard['lines'] += 1
+        if self._shard['lines'] >= self.shard_size:
+            self._finish_shard()
+
+    def _finish_shard(self):
+        if self._shard is None:
+            return
+        shard, self._shard = self._shard, None
+        try:
+            shard['file'].close()
+            os.replace(shard['temporary'], shard['path'])
+        except OSError:
+            # Don't leave the half written shard behind
+            try:
+                os.remove(shard['temporary'])
+            except OSError:
+                pass
+            raise
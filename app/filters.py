@@ -0,0 +1,114 @@
+import json
+from math import exp, floor
+
+from app.prediction_stats import PredictionStats
+from app.summaries import common_words, lookup, summarise_frames
+
+IMAGE_AUDIO_CAPTION_DURATION = 4.5
+
+
+def tags_json_to_string(tags):
+    """
+    Converts a JSON dictionary of tag data to a formatted string.
+    Input: {"music": 69, "frog": 26, "water": 18}
+    Output: music (69), frog (26), water (18)
+    """
+    tags = json.loads(tags)
+    return ', '.join([f'{key} ({tags[key]})' for key in tags.keys() if key])
+
+
+def tags_list_to_string(tags):
+    """
+    Converts a list of tag data to a formatted string.
+    Input: [("music", 69), ("frog", 26), ("water", 18)]
+    Output: music (69), frog (26), water (18)
+    """
+    return ', '.join([f'{item[0]} ({item[1]})' for item in tags if item])
+
+
+def seconds_to_timecode_filter(seconds):
+    """
+    Converts an integer of seconds into timecode format.
+    """
+    timecode_seconds = str(floor(seconds % 60))
+    timecode_minutes = str(floor((seconds / 60) % 60))
+    timecode_hours = str(floor(seconds / 60 / 60))
+    timecode_seconds = pad_with_leading_zero(timecode_seconds)
+    timecode_minutes = pad_with_leading_zero(timecode_minutes)
+    timecode_hours = pad_with_leading_zero(timecode_hours)
+    return f'{timecode_hours}:{timecode_minutes}:{timecode_seconds}'
+
+
+def float_to_percentage_filter(confidence):
+    """
+    Converts a confidence level float into a percentage.
+    """
+    return int(confidence * 100)
+
+
+def average_log_probability_to_percentage_filter(avg_logprob):
+    """
+    Converts an average log probability into a percentage.
+    """
+    return float_to_percentage_filter(exp(avg_logprob))
+
+
+def calculate_prediction_counts_filter(predictions, score=0.0):
+    """
+    Calculate the total occurrences of each prediction for this video.
+
+    Returns:
+        A list of touples of format: [(prediction label, count, average confidence)]
+    """
+    return PredictionStats(predictions).top(threshold=score)
+
+
+def get_common_words_from_text(text, number=50):
+    """
+    Returns a list of tuples containing the most common word and how many times it appears.
+    """
+    return common_words(text, number)
+
+
+def common_words_filter(source, path):
+    """
+    Returns the most common words in a classification source, e.g. captions.clap,
+    as a list of (word, count) tuples. Uses the summary stored at index time,
+    or summarises the frames now for documents indexed before summaries existed.
+    """
+    summary = lookup(source.get('summaries'), path)
+    if not summary:
+        frames = lookup(source.get('classification'), path)
+        summary = summarise_frames(frames if isinstance(frames, list) else [])
+    return [(item['word'], item['count']) for item in summary['words']]
+
+
+def pad_with_leading_zero(number):
+    """
+    Add leading zeros to a single digit number.
+    """
+    padded_number = number
+    if len(str(padded_number)) == 1:
+        padded_number = f'0{padded_number}'
+    return padded_number
+
+
+def poster_from_video_filter(video_file):
+    """
+    Returns the poster file name from a video file name.
+    """
+    return video_file.replace('.mp4', '.jpg')
+
+
+# Template filters by the name templates use
+FILTERS = {
+    'tags_json_to_string': tags_json_to_string,
+    'tags_list_to_string': tags_list_to_string,
+    'seconds_to_timecode': seconds_to_timecode_filter,
+    'float_to_percentage': float_to_percentage_filter,
+    'average_log_probability_to_percentage': average_log_probability_to_percentage_filter,
+    'calculate_prediction_counts': calculate_prediction_counts_filter,
+    'get_common_words_from_text': get_common_words_from_text,
+    'common_words': common_words_filter,
+    'poster': poster_from_video_filter,
+}
@@ -0,0 +1,257 @@
+import hashlib
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from math import ceil
+
+import requests
+from elasticsearch import helpers
+
+XOS_PAGE_SIZE = int(os.getenv('XOS_PAGE_SIZE', '100'))
+XOS_PREFETCH_THREADS = int(os.getenv('XOS_PREFETCH_THREADS', '4'))
+INDEX_CHUNK_SIZE = int(os.getenv('INDEX_CHUNK_SIZE', '100'))
+INDEX_THREADS = int(os.getenv('INDEX_THREADS', '4'))
+INDEX_MAX_RETRIES = int(os.getenv('INDEX_MAX_RETRIES', '3'))
+INDEX_BULK_TIMEOUT = float(os.getenv('INDEX_BULK_TIMEOUT', '120'))
+INDEX_BUILD_MAX_FAILURES = int(os.getenv('INDEX_BUILD_MAX_FAILURES', '0'))
+# Keep the sync state in this file, e.g. on a mounted volume, rather than in Elasticsearch
+INDEX_STATE_FILE = os.getenv('INDEX_STATE_FILE', '')
+INDEX_STATE_INDEX = os.getenv('INDEX_STATE_INDEX', 'video-search-state')
+XOS_MODIFIED_SINCE_PARAM = os.getenv('XOS_MODIFIED_SINCE_PARAM', 'modified_since')
+XOS_ID_PAGE_SIZE = int(os.getenv('XOS_ID_PAGE_SIZE', '1000'))
+
+# Resource URLs that may be presigned, so their query strings change on every request
+URL_FIELDS = ('resource', 'web_resource', 'subtitles', 'subtitles_vtt', 'snapshot')
+
+
+def fetch_page(get_page, number):
+    """
+    Returns a page of XOS API results, or an empty last page if it's gone
+    because the collection shrank while we were paging.
+    """
+    try:
+        return get_page(number)
+    except requests.exceptions.HTTPError as exception:
+        if exception.response is not None and exception.response.status_code == 404:
+            return {'count': 0, 'next': None, 'results': []}
+        raise
+
+
+def fetch_pages(get_page, threads=XOS_PREFETCH_THREADS):
+    """
+    Yields XOS API result pages in order, fetching up to `threads` pages ahead.
+
+    get_page(page_number) should return the decoded JSON for that page.
+    The first page tells us how many pages there are, the rest are prefetched
+    concurrently. If the collection grows while we're paging we carry on
+    sequentially from the last page until there's no `next`, and if it
+    shrinks we stop at the first page without a `next`.
+    """
+    response = get_page(1)
+    yield response
+    if not response.get('next'):
+        return
+
+    page = 1
+    count = response.get('count')
+    page_size = len(response.get('results') or [])
+    if count and page_size and threads > 1:
+        last_page = ceil(count / page_size)
+        pages = iter(range(2, last_page + 1))
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            futures = deque(
+                executor.submit(fetch_page, get_page, number) for number in islice(pages, threads)
+            )
+            while futures:
+                response = futures.popleft().result()
+                page += 1
+                if not response.get('next'):
+                    # The last page, pages prefetched after it are past the end
+                    for future in futures:
+                        future.cancel()
+                    yield response
+                    return
+                next_number = next(pages, None)
+                if next_number:
+                    futures.append(executor.submit(fetch_page, get_page, next_number))
+                yield response
+
+    while response.get('next'):
+        page += 1
+        response = fetch_page(get_page, page)
+        yield response
+
+
+def parallel_streaming_bulk(client, actions, threads, chunk_size, **options):
+    """
+    Yields (success, item) results like helpers.parallel_bulk, in order, with
+    up to `threads` chunks sent at once. Each chunk goes through
+    helpers.streaming_bulk, so documents Elasticsearch rejects with a 429 are
+    retried with backoff rather than failed. Actions are only read from this
+    thread, a couple of chunks ahead of the requests.
+    """
+    actions = iter(actions)
+    chunks = iter(lambda: list(islice(actions, chunk_size)), [])
+
+    def send(chunk):
+        return list(helpers.streaming_bulk(
+            client, chunk, chunk_size=chunk_size, max_retries=INDEX_MAX_RETRIES, **options,
+        ))
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = deque(executor.submit(send, chunk) for chunk in islice(chunks, threads * 2))
+        while futures:
+            results = futures.popleft().result()
+            chunk = next(chunks, None)
+            if chunk:
+                futures.append(executor.submit(send, chunk))
+            yield from results
+
+
+def bulk_index(client, actions, chunk_size=INDEX_CHUNK_SIZE, threads=INDEX_THREADS):
+    """
+    Stream index actions to Elasticsearch with the bulk helpers and collect
+    the per-document failures rather than stopping at the first error.
+
+    Returns a dictionary of stats: indexed, failed ids, errors, seconds and docs_per_second.
+    """
+    client = client.options(request_timeout=INDEX_BULK_TIMEOUT)
+    options = {
+        'chunk_size': chunk_size,
+        'raise_on_error': False,
+        'raise_on_exception': False,
+    }
+    if threads > 1:
+        results = parallel_streaming_bulk(client, actions, threads, **options)
+    else:
+        results = helpers.streaming_bulk(
+            client,
+            actions,
+            max_retries=INDEX_MAX_RETRIES,
+            **options,
+        )
+
+    stats = {
+        'indexed': 0,
+        'deleted': 0,
+        'failed': [],
+        'errors': {},
+    }
+    start = time.monotonic()
+    for success, item in results:
+        operation, result = next(iter(item.items()))
+        if operation == 'delete' and (success or result.get('status') == 404):
+            stats['deleted'] += 1
+        elif success:
+            stats['indexed'] += 1
+        else:
+            stats['failed'].append(result.get('_id'))
+            stats['errors'][result.get('_id')] = result.get('error', str(result.get('exception')))
+    stats['seconds'] = round(time.monotonic() - start, 2)
+    stats['docs_per_second'] = 0.0
+    if stats['seconds']:
+        stats['docs_per_second'] = round(stats['indexed'] / stats['seconds'], 1)
+    return stats
+
+
+def load_state(index, path=None, client=None):
+    """
+    Returns the sync state for an index: the last successful sync time
+    and a content hash for every document we've indexed.
+
+    The state is read from INDEX_STATE_FILE if it's set, otherwise from
+    its document in the INDEX_STATE_INDEX Elasticsearch index.
+    """
+    path = path or INDEX_STATE_FILE
+    state = {}
+    if path:
+        try:
+            with open(path, 'r', encoding='utf-8') as state_file:
+                state = json.load(state_file).get(index, {})
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+    elif client is not None:
+        response = client.options(ignore_status=404).get(index=INDEX_STATE_INDEX, id=index)
+        if response.get('found'):
+            state = response['_source']
+    return {
+        'last_sync': state.get('last_sync'),
+        'hashes': state.get('hashes', {}),
+    }
+
+
+def save_state(index, state, path=None, client=None):
+    """
+    Save the sync state for an index, so it survives the container.
+
+    A state file is replaced atomically so an interrupted run never leaves
+    a half written state behind. In Elasticsearch the state is one document
+    per index that isn't mapped, so the hashes don't become fields.
+    """
+    path = path or INDEX_STATE_FILE
+    if not path:
+        # Already exists is fine
+        client.options(ignore_status=400).indices.create(
+            index=INDEX_STATE_INDEX, mappings={'dynamic': False},
+        )
+        client.index(index=INDEX_STATE_INDEX, id=index, document=state, refresh=True)
+        return
+    all_state = {}
+    try:
+        with open(path, 'r', encoding='utf-8') as state_file:
+            all_state = json.load(state_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass
+    all_state[index] = state
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as temp_file:
+        json.dump(all_state, temp_file)
+    os.replace(temp_path, path)
+
+
+def document_hash(document):
+    """
+    A stable content hash of a document, ignoring the query strings of its
+    resource URLs so re-signing them doesn't count as a change.
+    """
+    document = {
+        key: value.split('?')[0] if key in URL_FIELDS and isinstance(value, str) else value
+        for key, value in document.items()
+    }
+    encoded = json.dumps(document, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+
+def sync_actions(index, documents, hashes, full=False, skipped=None):
+    """
+    Yields bulk actions for the prepared documents that need to change in the index.
+
+    Documents whose content hash matches `hashes` are skipped unless `full`
+    is set, assets that no longer have a transcription or classification are
+    deleted. `hashes` is updated in place with the new content hashes.
+    """
+    for document in documents:
+        document_id = str(document['id'])
+        if not (document.get('transcription') or document.get('classification')):
+            if hashes.pop(document_id, None):
+                yield {'_op_type': 'delete', '_index': index, '_id': document['id']}
+            continue
+        digest = document_hash(document)
+        if not full and hashes.get(document_id) == digest:
+            if skipped is not None:
+                skipped.append(document['id'])
+            continue
+        hashes[document_id] = digest
+        yield {'_op_type': 'index', '_index': index, '_id': document['id'], '_source': document}
+
+
+def delete_actions(index, document_ids, hashes):
+    """
+    Yields bulk delete actions for documents that have disappeared from XOS.
+    """
+    for document_id in document_ids:
+        hashes.pop(str(document_id), None)
+        yield {'_op_type': 'delete', '_index': index, '_id': document_id}
@@ -0,0 +1,388 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from app.events import EventChannel
+
+# Kept with the supercuts in app/ so it lasts as long as they do, but outside
+# app/static so it isn't served
+SUPERCUT_JOBS_DB = os.getenv('SUPERCUT_JOBS_DB') or 'app/supercut_jobs.sqlite3'
+SUPERCUT_MAX_JOBS = int(os.getenv('SUPERCUT_MAX_JOBS', '2'))
+SUPERCUT_CPU_BUDGET = int(os.getenv('SUPERCUT_CPU_BUDGET') or os.cpu_count() or 1)
+SUPERCUT_POLL_SECONDS = float(os.getenv('SUPERCUT_POLL_SECONDS', '5'))
+# Running jobs whose worker hasn't sent a heartbeat for this long are queued again
+SUPERCUT_STALE_SECONDS = float(os.getenv('SUPERCUT_STALE_SECONDS', '60'))
+# Completed and failed jobs are deleted once they're this old
+SUPERCUT_JOB_RETENTION_SECONDS = float(os.getenv('SUPERCUT_JOB_RETENTION_SECONDS', '604800'))
+
+ACTIVE_STATUSES = ('queued', 'in_progress', 'saving')
+RUNNING_STATUSES = ('in_progress', 'saving')
+FINISHED_STATUSES = ('completed', 'failed')
+# Published when a job is queued or a running job finishes, to wake the dispatcher
+QUEUE_EVENT = 'supercut-queue'
+# The job fields published with every change, enough for a progress stream
+EVENT_FIELDS = ('id', 'status', 'progress', 'filename', 'query', 'page', 'search_type', 'preview')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    key TEXT NOT NULL,
+    query TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    search_type TEXT NOT NULL,
+    status TEXT NOT NULL,
+    progress REAL NOT NULL DEFAULT 0,
+    filename TEXT,
+    error TEXT,
+    preview INTEGER NOT NULL DEFAULT 0,
+    cursor TEXT,
+    profile TEXT,
+    clips TEXT,
+    owner TEXT,
+    heartbeat REAL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_key_status ON jobs (key, status);
+CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created);
+"""
+
+
+# Columns added since the first version of the schema
+MIGRATIONS = {
+    'preview': 'ALTER TABLE jobs ADD COLUMN preview INTEGER NOT NULL DEFAULT 0',
+    'cursor': 'ALTER TABLE jobs ADD COLUMN cursor TEXT',
+    'owner': 'ALTER TABLE jobs ADD COLUMN owner TEXT',
+    'heartbeat': 'ALTER TABLE jobs ADD COLUMN heartbeat REAL',
+    'profile': 'ALTER TABLE jobs ADD COLUMN profile TEXT',
+    'clips': 'ALTER TABLE jobs ADD COLUMN clips TEXT',
+}
+
+
+def worker_id():
+    """
+    Identifies this process as the owner of the jobs it runs.
+    """
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def owner_gone(owner):
+    """
+    True if a job's owner was a process on this host that has exited.
+    Owners on other hosts are only known to be gone when their heartbeat stops.
+    """
+    host, _, pid = (owner or '').rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+def job_key(query, page, search_type):
+    """
+    Identical supercut requests share a key so they share a job. A preview
+    has the same key as the full supercut, which replaces it once it's made.
+    """
+    return f'{query}|{page}|{search_type}'
+
+
+class SupercutQueue():  # pylint: disable=too-many-instance-attributes
+    """
+    A durable supercut job queue shared by the web workers and the supercut worker.
+
+    Job state lives in SQLite so jobs survive a restart. Web workers only
+    submit jobs and read them, the supercut worker process (app.worker) has
+    a `runner` and dispatches them. At most `max_jobs` jobs run at once, and
+    each running job gets an equal share of `cpu_budget`. Every change to a
+    job is published to `events` with the job's new state, so watchers
+    neither poll nor read it back from the database.
+    """
+    def __init__(
+        self,
+        path=SUPERCUT_JOBS_DB,
+        runner=None,
+        max_jobs=SUPERCUT_MAX_JOBS,
+        cpu_budget=SUPERCUT_CPU_BUDGET,
+        events=None,
+    ):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self.path = path
+        self.runner = runner
+        self.max_jobs = max(1, max_jobs)
+        self.cpu_budget = max(1, cpu_budget)
+        self.events = events or EventChannel()
+        self._started_pid = None
+        self._start_lock = threading.Lock()
+        self._executor = None
+        self._schema_ready = False
+
+    @property
+    def cpus_per_job(self):
+        """
+        The share of the CPU budget each running job may use.
+        """
+        return max(1, self.cpu_budget // self.max_jobs)
+
+    @contextmanager
+    def connect(self):
+        """
+        A new connection to the jobs database, safe to use from any thread or process.
+        """
+        if not self._schema_ready:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        if not self._schema_ready:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(SCHEMA)
+            columns = {row['name'] for row in connection.execute('PRAGMA table_info(jobs)')}
+            for column, migration in MIGRATIONS.items():
+                if column not in columns:
+                    try:
+                        connection.execute(migration)
+                    except sqlite3.OperationalError:
+                        # Another worker added it first
+                        pass
+            self._schema_ready = True
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def submit(self, query, page, search_type, size=20, preview=False, cursor=None, profile=None):
+        """
+        Queue a supercut job, or return the id of an identical job that's
+        already queued or running. A `preview` job makes a short, low
+        resolution supercut that the full one replaces, and a preview request
+        joins a full job for the same supercut but not the other way round.
+        A page's `cursor` is kept so the job searches for the page the user
+        saw. A `profile` is used however busy the queue is.
+        """
+        key = job_key(query, page, search_type)
+        now = time.time()
+        with self.connect() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            row = connection.execute(
+                f'SELECT id FROM jobs WHERE key = ? AND status IN {ACTIVE_STATUSES} '
+                'AND preview <= ? ORDER BY created LIMIT 1',
+                (key, int(preview)),
+            ).fetchone()
+            if row:
+                connection.execute('COMMIT')
+                return row['id']
+            job_id = str(uuid.uuid4())
+            connection.execute(
+                'INSERT INTO jobs '
+                '(id, key, query, page, size, search_type, status, preview, cursor, profile, '
+                'created, updated) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    job_id, key, query, page, size, search_type, 'queued', int(preview), cursor,
+                    profile, now, now,
+                ),
+            )
+            connection.execute('COMMIT')
+        # Wake the dispatcher in the supercut worker
+        self.events.publish(QUEUE_EVENT)
+        return job_id
+
+    def get(self, job_id):
+        """
+        Returns a job as a dictionary, or None.
+        """
+        with self.connect() as connection:
+            row = connection.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def update(self, job_id, **fields):
+        """
+        Update a job's status, progress, filename, clips or error.
+        """
+        fields['updated'] = time.time()
+        columns = ', '.join(f'{column} = ?' for column in fields)
+        with self.connect() as connection:
+            connection.execute(
+                f'UPDATE jobs SET {columns} WHERE id = ?',
+                (*fields.values(), job_id),
+            )
+            row = connection.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        self.publish(row)
+
+    def publish(self, row):
+        """
+        Tell everything watching a job about its new state.
+        """
+        if row:
+            self.events.publish(
+                row['id'], json.dumps({field: row[field] for field in EVENT_FIELDS}),
+            )
+
+    def counts(self):
+        """
+        Returns the number of jobs in each status.
+        """
+        with self.connect() as connection:
+            rows = connection.execute(
+                'SELECT status, COUNT(*) AS count FROM jobs GROUP BY status',
+            ).fetchall()
+        return {row['status']: row['count'] for row in rows}
+
+    def claim(self):
+        """
+        Atomically take the oldest queued job if fewer than `max_jobs` are running.
+        A full supercut queued behind its preview waits for the preview to finish,
+        as they're saved under the same name.
+        """
+        with self.connect() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            running = connection.execute(
+                f'SELECT COUNT(*) FROM jobs WHERE status IN {RUNNING_STATUSES}',
+            ).fetchone()[0]
+            row = None
+            if running < self.max_jobs:
+                row = connection.execute(
+                    "SELECT * FROM jobs WHERE status = 'queued' AND key NOT IN "
+                    f'(SELECT key FROM jobs WHERE status IN {RUNNING_STATUSES}) '
+                    'ORDER BY created LIMIT 1',
+                ).fetchone()
+            if row:
+                now = time.time()
+                connection.execute(
+                    "UPDATE jobs SET status = 'in_progress', owner = ?, heartbeat = ?, updated = ? "
+                    'WHERE id = ?',
+                    (worker_id(), now, now, row['id']),
+                )
+                row = connection.execute(
+                    'SELECT * FROM jobs WHERE id = ?', (row['id'],),
+                ).fetchone()
+            connection.execute('COMMIT')
+        self.publish(row)
+        return dict(row) if row else None
+
+    def heartbeat(self):
+        """
+        Mark the jobs this process is running as still owned by a live worker,
+        even while a long encode isn't reporting progress.
+        """
+        with self.connect() as connection:
+            connection.execute(
+                f'UPDATE jobs SET heartbeat = ? WHERE owner = ? AND status IN {RUNNING_STATUSES}',
+                (time.time(), worker_id()),
+            )
+
+    def requeue_stale(self):
+        """
+        Put running jobs back in the queue once their worker has gone, e.g.
+        because the server restarted part way through: either the process
+        that owned them has exited, or it stopped sending heartbeats.
+        """
+        cutoff = time.time() - SUPERCUT_STALE_SECONDS
+        with self.connect() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            rows = connection.execute(
+                f'SELECT id, owner, COALESCE(heartbeat, updated) AS heartbeat FROM jobs '
+                f'WHERE status IN {RUNNING_STATUSES}',
+            ).fetchall()
+            stale = [
+                row['id'] for row in rows
+                if row['heartbeat'] < cutoff or owner_gone(row['owner'])
+            ]
+            connection.executemany(
+                "UPDATE jobs SET status = 'queued', progress = 0, owner = NULL WHERE id = ?",
+                [(job_id,) for job_id in stale],
+            )
+            requeued = [
+                connection.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+                for job_id in stale
+            ]
+            connection.execute('COMMIT')
+        for row in requeued:
+            self.publish(row)
+        return stale
+
+    def prune(self):
+        """
+        Delete completed and failed jobs older than SUPERCUT_JOB_RETENTION_SECONDS
+        so the table doesn't grow forever.
+        """
+        cutoff = time.time() - SUPERCUT_JOB_RETENTION_SECONDS
+        with self.connect() as connection:
+            return connection.execute(
+                f'DELETE FROM jobs WHERE status IN {FINISHED_STATUSES} AND updated < ?',
+                (cutoff,),
+            ).rowcount
+
+    def start(self):
+        """
+        Start dispatching jobs on a thread in this process if it isn't already.
+        """
+        if self._started_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+            threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        """
+        Dispatch jobs to `runner` forever, waking whenever a job is queued or finishes.
+        A pass that fails, e.g. because the database is locked, is logged and
+        tried again after a growing delay.
+        """
+        self._executor = ThreadPoolExecutor(max_workers=self.max_jobs)
+        failures = 0
+        while True:
+            # Read the version first so a job queued during this pass isn't missed
+            version = self.events.version(QUEUE_EVENT)
+            try:
+                self.dispatch()
+            except Exception as exception:  # pylint: disable=broad-exception-caught
+                failures += 1
+                # Never wait so long that the jobs this worker is running look stale
+                wait = min(SUPERCUT_POLL_SECONDS * 2 ** (failures - 1), SUPERCUT_STALE_SECONDS / 2)
+                print(f'ERROR dispatching supercut jobs: {exception}... retrying in {wait:.1f}s')
+                traceback.print_exc()
+                time.sleep(wait)
+                continue
+            failures = 0
+            self.events.wait(QUEUE_EVENT, version, timeout=SUPERCUT_POLL_SECONDS)
+
+    def dispatch(self):
+        """
+        One pass of the dispatcher: mark this worker's jobs as alive, queue
+        abandoned ones again, prune old ones and start queued jobs while
+        there's room.
+        """
+        self.heartbeat()
+        self.requeue_stale()
+        self.prune()
+        while True:
+            job = self.claim()
+            if not job:
+                break
+            self._executor.submit(self._run, job)
+
+    def _run(self, job):
+        try:
+            self.runner(job, self.cpus_per_job)
+        except Exception as exception:  # pylint: disable=broad-exception-caught
+            print(f'ERROR generating supercut {job["id"]}: {exception}')
+            traceback.print_exc()
+            self.update(job['id'], status='failed', error=str(exception))
+        finally:
+            # A slot is free, look for the next queued job straight away
+            self.events.publish(QUEUE_EVENT)
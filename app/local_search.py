@@ -0,0 +1,539 @@
+import argparse
+import glob
+import gzip
+import json
+import mmap
+import os
+import re
+import shutil
+import threading
+import time
+
+import numpy as np
+
+from app.elastic import (ELASTICSEARCH_INNER_HITS_SIZE, SEARCH_FIELDS,
+                         SEARCH_SORT, SEARCH_SOURCE_INCLUDES, lookup_path,
+                         nested_path)
+from app.exports import compact_json
+from app.search_cache import SearchCache
+
+# Exported video JSON to build the local index from, see EXPORT_VIDEO_JSON
+LOCAL_SEARCH_EXPORTS = os.getenv('LOCAL_SEARCH_EXPORTS', 'app/static/json')
+# Directory holding the built local index
+LOCAL_SEARCH_INDEX = os.getenv('LOCAL_SEARCH_INDEX', 'local_index')
+
+# Words the same way Elasticsearch's standard analyzer splits them, e.g. what's
+TOKEN = re.compile(r"\w+(?:'\w+)*")
+# Each posting is a text unit (a transcript segment or a caption prediction)
+# shifted left by POSITION_BITS plus the word's position in it
+POSITION_BITS = 16
+MAX_POSITION = (1 << POSITION_BITS) - 1
+# Builds are named after the index directory plus the time and process that built them
+BUILD_SUFFIX = re.compile(r'-\d+-\d+')
+# The list of segments each search type matches in, e.g. transcription.segments
+SEARCH_PATHS = {search_type: nested_path(field) for search_type, field in SEARCH_FIELDS.items()}
+
+# One local index per worker process, opened on first use
+shared = {
+    'index': None,
+    'build': None,
+    'lock': threading.Lock(),
+}
+
+
+def tokenise(text):
+    """
+    Returns the lowercase words in a piece of text.
+    """
+    return TOKEN.findall((text or '').lower())
+
+
+def unit_texts(segment, field):
+    """
+    Returns the texts in a transcript segment or caption frame that `field` matches,
+    e.g. the segment's text, or the text of each of a frame's predictions.
+    """
+    key = field[len(nested_path(field)) + 1:]
+    if '.' in key:
+        list_key, text_key = key.split('.', 1)
+        return [item.get(text_key) for item in segment.get(list_key) or []]
+    return [segment.get(key)]
+
+
+def export_documents(path):
+    """
+    Returns the video documents in an export file, newest first: a single
+    video for .json and .json.gz, or a JSON Lines shard's videos in reverse.
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as export_file:
+        if '.jsonl' in path:
+            return [json.loads(line) for line in export_file if line.strip()][::-1]
+        return [json.load(export_file)]
+
+
+def read_exports(exports=LOCAL_SEARCH_EXPORTS):
+    """
+    Yield each exported video document, newest first, skipping older
+    exports of a video that's already been read and videos whose newest
+    export is a deletion tombstone.
+    """
+    seen = set()
+    paths = [
+        path
+        for pattern in ('*.json', '*.json.gz', '*.jsonl', '*.jsonl.gz')
+        for path in glob.glob(os.path.join(exports, pattern))
+    ]
+    # Shards written in the same instant are numbered in the order they were written
+    for path in sorted(paths, key=lambda path: (os.path.getmtime(path), path), reverse=True):
+        for document in export_documents(path):
+            if str(document.get('id')) in seen:
+                continue
+            seen.add(str(document.get('id')))
+            if not document.get('deleted'):
+                yield document
+
+
+def build_index(exports=LOCAL_SEARCH_EXPORTS, directory=LOCAL_SEARCH_INDEX):
+    # pylint: disable=too-many-locals
+    """
+    Build a positional inverted index of every search type's text units from
+    exported video JSON, and replace the index in `directory` with it.
+
+    Writes meta.json (the term dictionary and video ids) and memory-mappable:
+    * postings.npy - every term's sorted (unit, position) keys, term by term
+    * units.npy - the video and segment number of each text unit
+    * documents.bin and sources.bin - each video as compact JSON, in full
+      and cut down to SEARCH_SOURCE_INCLUDES, with their offsets.npy
+    * segments.bin - every segment and caption frame as JSON, with their
+      segment_offsets.npy and the first and last segment of each video's
+      list for each search type in ranges.npy
+    """
+    # Each build gets its own versioned directory that `directory` links to
+    building = f'{directory}-{time.time_ns()}-{os.getpid()}'
+    os.makedirs(building)
+    postings = {search_type: {} for search_type in SEARCH_FIELDS}
+    units = []
+    ids = []
+    offsets = [(0, 0)]
+    segment_offsets = [0]
+    ranges = []
+    with open(os.path.join(building, 'documents.bin'), 'wb') as documents_file, \
+            open(os.path.join(building, 'sources.bin'), 'wb') as sources_file, \
+            open(os.path.join(building, 'segments.bin'), 'wb') as segments_file:
+        for number, document in enumerate(read_exports(exports)):
+            data = compact_json(document)
+            source = compact_json(filter_source(document, SEARCH_SOURCE_INCLUDES))
+            documents_file.write(data)
+            sources_file.write(source)
+            offsets.append((offsets[-1][0] + len(data), offsets[-1][1] + len(source)))
+            ids.append(document.get('id'))
+            video_ranges = []
+            for search_type, field in SEARCH_FIELDS.items():
+                first = len(segment_offsets) - 1
+                for segment in lookup_path(document, SEARCH_PATHS[search_type]) or []:
+                    segment_number = len(segment_offsets) - 1
+                    # Each segment ends in a comma so a video's run of segments is a JSON list
+                    data = compact_json(segment) + b','
+                    segments_file.write(data)
+                    segment_offsets.append(segment_offsets[-1] + len(data))
+                    for text in unit_texts(segment, field):
+                        tokens = tokenise(text)[:MAX_POSITION + 1]
+                        if not tokens:
+                            continue
+                        unit = len(units)
+                        units.append((number, segment_number))
+                        for position, token in enumerate(tokens):
+                            postings[search_type].setdefault(token, []).append(
+                                (unit << POSITION_BITS) | position,
+                            )
+                video_ranges.append((first, len(segment_offsets) - 1))
+            ranges.append(video_ranges)
+
+    # Lay each search type's postings out term by term in one array
+    terms = {}
+    arrays = []
+    start = 0
+    for search_type, search_type_postings in postings.items():
+        terms[search_type] = {}
+        for term in sorted(search_type_postings):
+            keys = search_type_postings[term]
+            terms[search_type][term] = [start, start + len(keys)]
+            arrays.append(np.array(keys, dtype=np.int64))
+            start += len(keys)
+    saved = {
+        'postings': np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.int64),
+        'units': np.reshape(np.array(units, dtype=np.int64), (-1, 2)),
+        'offsets': np.array(offsets, dtype=np.int64),
+        'segment_offsets': np.array(segment_offsets, dtype=np.int64),
+        'ranges': np.reshape(np.array(ranges, dtype=np.int64), (-1, len(SEARCH_FIELDS), 2)),
+    }
+    for name, array in saved.items():
+        np.save(os.path.join(building, f'{name}.npy'), array)
+    with open(os.path.join(building, 'meta.json'), 'w', encoding='utf-8') as meta_file:
+        json.dump({
+            'built': time.time(),
+            'search_types': list(SEARCH_FIELDS),
+            'ids': ids,
+            'terms': terms,
+        }, meta_file)
+
+    swap_index(directory, building)
+    return {'documents': len(ids), 'segments': len(segment_offsets) - 1, 'postings': start}
+
+
+def swap_index(directory, build):
+    """
+    Point `directory` at a new build by atomically replacing its symlink, so
+    readers always open a whole index, then remove builds older than the one
+    before it. Workers that already mapped an older build's files keep them.
+    """
+    link = f'{directory}.link-{os.getpid()}'
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.basename(build), link)
+    if os.path.isdir(directory) and not os.path.islink(directory):
+        # An index built before builds were versioned
+        shutil.rmtree(directory)
+    os.replace(link, directory)
+    builds = sorted(
+        (
+            path for path in glob.glob(f'{glob.escape(directory)}-*')
+            if BUILD_SUFFIX.fullmatch(path[len(directory):])
+        ),
+        key=lambda path: [int(part) for part in path[len(directory) + 1:].split('-')],
+    )
+    # Keep the previous build for workers opening it right now, and any newer
+    # build another process is still writing
+    for old in builds[:max(builds.index(build) - 1, 0)]:
+        shutil.rmtree(old, ignore_errors=True)
+
+
+def map_file(path):
+    """
+    Memory-map a file for reading, or return no bytes if it's empty and can't be mapped.
+    """
+    with open(path, 'rb') as mapped_file:
+        if not os.fstat(mapped_file.fileno()).st_size:
+            return b''
+        return mmap.mmap(mapped_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def load_array(path):
+    """
+    Memory-map a saved NumPy array, or read it if it's empty and can't be mapped.
+    """
+    try:
+        return np.load(path, mmap_mode='r')
+    except ValueError:
+        return np.load(path)
+
+
+def id_key(value):
+    """
+    A sort key for video ids, numbers before strings.
+    """
+    if isinstance(value, (int, float)):
+        return (0, value, '')
+    return (1, 0, str(value))
+
+
+def filter_source(source, includes):
+    """
+    Returns just the dotted `includes` paths of a document, like _source filtering.
+    """
+    filtered = {}
+    for path in includes:
+        copy_path(source, filtered, path.split('.'))
+    return filtered
+
+
+def copy_path(source, target, keys):
+    """
+    Copy the value at a path of keys from `source` into `target`, through lists.
+    """
+    if not isinstance(source, dict) or keys[0] not in source:
+        return
+    value = source[keys[0]]
+    if len(keys) == 1:
+        target[keys[0]] = value
+    elif isinstance(value, list):
+        items = target.setdefault(keys[0], [{} for _ in value])
+        for item, target_item in zip(value, items):
+            copy_path(item, target_item, keys[1:])
+    elif isinstance(value, dict):
+        copy_path(value, target.setdefault(keys[0], {}), keys[1:])
+
+
+def set_path(source, path, value):
+    """
+    Set the value at a dotted path in a document, creating objects on the way.
+    """
+    keys = path.split('.')
+    for key in keys[:-1]:
+        source = source.setdefault(key, {})
+    source[keys[-1]] = value
+
+
+class LocalIndex():  # pylint: disable=too-many-instance-attributes
+    """
+    An embedded, read-only search index over exported video JSON that answers
+    the same match_phrase searches as Elasticsearch, so development, CI and
+    kiosks can search without a cluster. Every file is memory-mapped, so opening
+    the index doesn't read it into memory and gunicorn workers share its pages,
+    and a search only decodes the hits and segments it returns.
+    """
+    def __init__(self, directory=LOCAL_SEARCH_INDEX):
+        with open(os.path.join(directory, 'meta.json'), encoding='utf-8') as meta_file:
+            meta = json.load(meta_file)
+        self.ids = meta['ids']
+        self.terms = meta['terms']
+        self.search_types = meta['search_types']
+        self.numbers = {str(video_id): number for number, video_id in enumerate(self.ids)}
+        self.postings = load_array(os.path.join(directory, 'postings.npy'))
+        self.units = load_array(os.path.join(directory, 'units.npy'))
+        self.offsets = load_array(os.path.join(directory, 'offsets.npy'))
+        self.segment_offsets = load_array(os.path.join(directory, 'segment_offsets.npy'))
+        self.ranges = load_array(os.path.join(directory, 'ranges.npy'))
+        self.documents = map_file(os.path.join(directory, 'documents.bin'))
+        self.sources = map_file(os.path.join(directory, 'sources.bin'))
+        self.segment_data = map_file(os.path.join(directory, 'segments.bin'))
+
+    def document(self, number, compact=False):
+        """
+        Returns a video's document by its number in the index,
+        or just its SEARCH_SOURCE_INCLUDES if `compact`.
+        """
+        column = 1 if compact else 0
+        start, end = int(self.offsets[number][column]), int(self.offsets[number + 1][column])
+        return json.loads((self.sources if compact else self.documents)[start:end])
+
+    def segments(self, first, last):
+        """
+        Returns the segments numbered from `first` up to `last` as a list.
+        """
+        start, end = int(self.segment_offsets[first]), int(self.segment_offsets[last])
+        # Drop the last segment's trailing comma
+        return json.loads(b'[' + self.segment_data[start:max(end - 1, start)] + b']')
+
+    def phrase(self, search_type, query):
+        """
+        Returns the numbers of the segments matching a phrase in each video,
+        keyed by video number, e.g. {0: [3, 17], 4: [2]}
+        """
+        terms = self.terms.get(search_type, {})
+        matches = None
+        for offset, token in enumerate(tokenise(query)):
+            if token not in terms:
+                return {}
+            start, stop = terms[token]
+            # Shift each word's positions back to where the phrase would start
+            keys = np.asarray(self.postings[start:stop]) - offset
+            matches = keys if matches is None else np.intersect1d(
+                matches, keys, assume_unique=True,
+            )
+            if not matches.size:
+                return {}
+        if matches is None:
+            return {}
+        segments = {}
+        for number, segment in self.units[np.unique(matches >> POSITION_BITS)].tolist():
+            video_segments = segments.setdefault(number, [])
+            # Several predictions in one caption frame can match
+            if not video_segments or video_segments[-1] != segment:
+                video_segments.append(segment)
+        return segments
+
+    def search(self, index=None, body=None, **kwargs):
+        # pylint: disable=unused-argument,too-many-locals
+        """
+        Answer an Elasticsearch search body with a match_phrase query, nested or not,
+        sorted by the number of matching segments and id, paged with from or search_after.
+        """
+        started = time.perf_counter()
+        body = body or {}
+        query = body.get('query') or {}
+        nested = query.get('nested')
+        match = (nested['query'] if nested else query).get('match_phrase')
+        if not match:
+            raise ValueError('The local search index only answers match_phrase queries')
+        (field, phrase), = match.items()
+        search_types = {value: key for key, value in SEARCH_FIELDS.items()}
+        if field == 'id':
+            number = self.numbers.get(str(phrase))
+            matches = {} if number is None else {number: []}
+        elif field in search_types:
+            matches = self.phrase(search_types[field], phrase)
+        else:
+            raise ValueError(f'The local search index has no {field} field')
+
+        def sort_key(number):
+            return (-float(len(matches[number]) or 1), id_key(self.ids[number]))
+
+        ordered = sorted(matches, key=sort_key)
+        reverse = (body.get('sort') or SEARCH_SORT)[0].get('_score') == 'asc'
+        after = body.get('search_after')
+        if after:
+            cursor = (-float(after[0]), id_key(after[1]))
+            if reverse:
+                ordered = [number for number in reversed(ordered) if sort_key(number) < cursor]
+            else:
+                ordered = [number for number in ordered if sort_key(number) > cursor]
+        elif reverse:
+            ordered.reverse()
+        offset = 0 if after else body.get('from', 0)
+        hits = [
+            self.hit(number, matches[number], body, index)
+            for number in ordered[offset:offset + body.get('size', 10)]
+        ]
+
+        response = {
+            'took': int((time.perf_counter() - started) * 1000),
+            'timed_out': False,
+            'hits': {
+                'total': {'value': len(matches), 'relation': 'eq'},
+                'max_score': max((hit['_score'] for hit in hits), default=None),
+                'hits': hits,
+            },
+        }
+        if body.get('pit'):
+            response['pit_id'] = body['pit']['id']
+        return response
+
+    def hit(self, number, segments, body, index=None):
+        """
+        A search hit for a video, with its matching segments as inner_hits for a nested query.
+        A search that only includes the displayed fields and segment lists gets them
+        without decoding the whole document.
+        """
+        score = float(len(segments) or 1)
+        hit = {
+            '_index': index or 'local',
+            '_id': str(self.ids[number]),
+            '_score': score,
+        }
+        if body.get('sort'):
+            hit['sort'] = [score, self.ids[number]]
+        nested = (body.get('query') or {}).get('nested')
+        if nested:
+            size = (nested.get('inner_hits') or {}).get('size', ELASTICSEARCH_INNER_HITS_SIZE)
+            hit['inner_hits'] = {nested['path']: {'hits': {
+                'total': {'value': len(segments), 'relation': 'eq'},
+                'hits': [
+                    {'_source': self.segments(segment, segment + 1)[0]}
+                    for segment in segments[:size]
+                ],
+            }}}
+
+        includes = (body.get('_source') or {}).get('includes')
+        paths = {
+            path: self.search_types.index(search_type)
+            for search_type, path in SEARCH_PATHS.items() if path in (includes or [])
+        }
+        if includes and set(includes) <= set(SEARCH_SOURCE_INCLUDES) | set(paths):
+            hit['_source'] = self.document(number, compact=True)
+            for path, search_type in paths.items():
+                set_path(hit['_source'], path, self.segments(*self.ranges[number][search_type]))
+        else:
+            document = self.document(number)
+            hit['_source'] = filter_source(document, includes) if includes else document
+        return hit
+
+    def msearch(self, searches=None, **kwargs):  # pylint: disable=unused-argument
+        """
+        Answer the header and body pairs of a multi-search.
+        """
+        responses = []
+        for header, body in zip(searches[::2], searches[1::2]):
+            try:
+                responses.append(self.search(index=header.get('index'), body=body))
+            except ValueError as exception:
+                responses.append({
+                    'error': {'type': 'local_search_error', 'reason': str(exception)},
+                })
+        return {'responses': responses}
+
+    def open_point_in_time(self, index=None, **kwargs):  # pylint: disable=unused-argument
+        """
+        The local index doesn't change under a search, so every point in time is the same.
+        """
+        return {'id': 'local'}
+
+    def close_point_in_time(self, id=None, **kwargs):  # pylint: disable=unused-argument,redefined-builtin
+        """
+        There's nothing to close in the local index.
+        """
+        return {'succeeded': True, 'num_freed': 0}
+
+
+def get_local_index():
+    """
+    Returns this process's local index, reopening it when a newer build has been
+    swapped in. Searches never build the index, that's done by
+    `python -m app.local_search` or index_all.
+    """
+    try:
+        # Each build has its own directory, so its path changes with meta.json's `built`
+        build = os.path.realpath(os.path.join(LOCAL_SEARCH_INDEX, 'meta.json'), strict=True)
+    except OSError as exception:
+        raise FileNotFoundError(
+            f'There is no local search index in {LOCAL_SEARCH_INDEX}, '
+            'build it with: python -m app.local_search',
+        ) from exception
+    with shared['lock']:
+        if shared['index'] is None or shared['build'] != build:
+            shared['index'] = LocalIndex(os.path.dirname(build))
+            shared['build'] = build
+        return shared['index']
+
+
+def reset_local_index():
+    """
+    Forget the opened local index so the next search opens the latest build.
+    """
+    with shared['lock']:
+        shared['index'] = None
+        shared['build'] = None
+
+
+def rebuild_local_index():
+    """
+    Build the local index from LOCAL_SEARCH_EXPORTS into LOCAL_SEARCH_INDEX, and
+    invalidate cached search results so every worker searches the new build.
+    """
+    started = time.perf_counter()
+    stats = build_index(LOCAL_SEARCH_EXPORTS, LOCAL_SEARCH_INDEX)
+    SearchCache().invalidate()
+    seconds = time.perf_counter() - started
+    stats.update({
+        'indexed': stats['documents'],
+        'failed': [],
+        'seconds': round(seconds, 2),
+        'docs_per_second': round(stats['documents'] / seconds, 1) if seconds else 0,
+    })
+    return stats
+
+
+def main(argv=None):
+    """
+    Build the local search index from exported video JSON.
+
+    Usage: python -m app.local_search [--exports app/static/json] [--index local_index]
+    """
+    parser = argparse.ArgumentParser(description='Build the local search index.')
+    parser.add_argument('--exports', default=LOCAL_SEARCH_EXPORTS)
+    parser.add_argument('--index', default=LOCAL_SEARCH_INDEX)
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    stats = build_index(args.exports, args.index)
+    SearchCache().invalidate()
+    print(
+        f'{stats["documents"]} videos, {stats["segments"]} segments and {stats["postings"]} '
+        f'postings in {time.perf_counter() - started:.2f}s',
+    )
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
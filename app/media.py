@@ -0,0 +1,132 @@
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import requests
+
+from app.clip_cache import DiskCache
+
+SUPERCUT_MEDIA_CACHE_DIR = os.getenv('SUPERCUT_MEDIA_CACHE_DIR') or os.path.join(
+    tempfile.gettempdir(), 'video-search', 'media',
+)
+SUPERCUT_MEDIA_CACHE_MAX_BYTES = int(
+    os.getenv('SUPERCUT_MEDIA_CACHE_MAX_BYTES', str(20 * 1024 ** 3)),
+)
+SUPERCUT_MEDIA_CACHE_GRACE_SECONDS = float(os.getenv('SUPERCUT_MEDIA_CACHE_GRACE_SECONDS', '3600'))
+# Remote files bigger than this are read with byte ranges rather than downloaded,
+# 0 to always download
+SUPERCUT_MEDIA_RANGE_BYTES = int(os.getenv('SUPERCUT_MEDIA_RANGE_BYTES', '0'))
+SUPERCUT_MEDIA_TIMEOUT = int(os.getenv('SUPERCUT_MEDIA_TIMEOUT', '60'))
+CHUNK_SIZE = 1024 * 1024
+# Downloads lock one of a fixed set of files, so there's no lock file per URL to clean up
+LOCK_SHARDS = 64
+
+
+class MediaCache(DiskCache):
+    """
+    A bounded on-disk cache of remote source videos.
+
+    Concurrent requests for the same URL, from any thread or process, share
+    a single download. Long files can instead be left remote so ffmpeg only
+    fetches the byte ranges it seeks to.
+    """
+    def __init__(
+        self,
+        directory=SUPERCUT_MEDIA_CACHE_DIR,
+        max_bytes=SUPERCUT_MEDIA_CACHE_MAX_BYTES,
+        grace_seconds=SUPERCUT_MEDIA_CACHE_GRACE_SECONDS,
+        range_bytes=SUPERCUT_MEDIA_RANGE_BYTES,
+    ):
+        super().__init__(directory, max_bytes, grace_seconds)
+        self.range_bytes = range_bytes
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self):
+        """
+        A pooled HTTP session, created on first use in each process.
+        """
+        with self._session_lock:
+            if self._session is None or self._session[0] != os.getpid():
+                self._session = (os.getpid(), requests.Session())
+            return self._session[1]
+
+    def key(self, url):
+        """
+        Returns the cache key for a URL, ignoring signed URL query strings
+        and keeping the file extension so ffmpeg can recognise the format.
+        """
+        path = url.split('?')[0]
+        extension = os.path.splitext(urlparse(path).path)[1][:8]
+        return hashlib.sha256(path.encode('utf-8')).hexdigest() + extension
+
+    def resolve(self, url):
+        """
+        Returns something ffmpeg can read for a source: a local file path,
+        or the URL itself for long files that support byte-range reads.
+        """
+        if urlparse(url).scheme not in ('http', 'https'):
+            return url
+        cached_path = self.get(self.key(url))
+        if cached_path:
+            return cached_path
+        if self.range_bytes and self.supports_range(url):
+            return url
+        return self.fetch(url)
+
+    def supports_range(self, url):
+        """
+        True if the file is longer than `range_bytes` and the server accepts range requests.
+        """
+        try:
+            response = self.session.head(url, allow_redirects=True, timeout=SUPERCUT_MEDIA_TIMEOUT)
+            response.raise_for_status()
+        except requests.exceptions.RequestException:
+            return False
+        length = int(response.headers.get('Content-Length') or 0)
+        return response.headers.get('Accept-Ranges') == 'bytes' and length > self.range_bytes
+
+    def fetch(self, url):
+        """
+        Download a URL into the cache, or wait for another worker that's
+        already downloading it, and return the local path.
+        """
+        key = self.key(url)
+        with self.lock(key):
+            cached_path = self.get(key)
+            if cached_path:
+                return cached_path
+            temp_path = self.temp_path()
+            try:
+                with self.session.get(url, stream=True, timeout=SUPERCUT_MEDIA_TIMEOUT) as response:
+                    response.raise_for_status()
+                    response.raw.decode_content = True
+                    with open(temp_path, 'wb') as media_file:
+                        shutil.copyfileobj(response.raw, media_file, CHUNK_SIZE)
+            except Exception:
+                os.remove(temp_path)
+                raise
+            return self.commit(key, temp_path)
+
+    @contextmanager
+    def lock(self, key):
+        """
+        An exclusive lock on a cache key shared by every thread and process.
+        Keys share LOCK_SHARDS lock files, so now and then a download waits
+        for another URL's download to finish.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        shard = int(key[:8], 16) % LOCK_SHARDS
+        lock_path = os.path.join(self.directory, f'.{shard:02}.lock')
+        with open(lock_path, 'w', encoding='utf-8') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -0,0 +1,278 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import (before_render_template, g, has_request_context, request,
+                   template_rendered)
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY,
+                               CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, values)
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.multiprocess import MultiProcessCollector
+
+# Print a JSON line for every request and supercut job
+STRUCTURED_LOGS = os.getenv('STRUCTURED_LOGS', 'true').lower() == 'true'
+# Set for gunicorn so /metrics adds up every worker's metrics, the directory
+# must be emptied before the server starts
+PROMETHEUS_MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+if not PROMETHEUS_MULTIPROC_DIR:
+    # prometheus_client goes multiprocess if the variable exists at all, and would
+    # write its files to the current directory if it's empty
+    os.environ.pop('PROMETHEUS_MULTIPROC_DIR', None)
+    values.ValueClass = values.get_value_class()
+
+SIZE_BUCKETS = (1e3, 1e4, 5e4, 1e5, 5e5, 1e6, 5e6, 1e7, 5e7, 1e8)
+STAGE_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+REQUEST_SECONDS = Histogram(
+    'http_request_seconds',
+    'Time to handle a request.',
+    ['endpoint', 'method', 'status'],
+)
+ELASTICSEARCH_SECONDS = Histogram(
+    'elasticsearch_query_seconds',
+    'Time waiting for Elasticsearch to answer a query.',
+    ['operation'],
+)
+ELASTICSEARCH_RESPONSE_BYTES = Histogram(
+    'elasticsearch_response_bytes',
+    'Size of Elasticsearch query responses.',
+    ['operation'],
+    buckets=SIZE_BUCKETS,
+)
+RENDER_SECONDS = Histogram(
+    'template_render_seconds',
+    'Time to render a page template.',
+    ['template'],
+)
+SUPERCUT_STAGE_SECONDS = Histogram(
+    'supercut_stage_seconds',
+    'Time spent in each supercut stage: search, fetch and encode for each source '
+    'or clip, concat and poster for each supercut.',
+    ['stage'],
+    buckets=STAGE_BUCKETS,
+)
+SUPERCUT_JOB_SECONDS = Histogram(
+    'supercut_job_seconds',
+    'Time to run a supercut job from start to finish.',
+    ['status'],
+    buckets=STAGE_BUCKETS,
+)
+SUPERCUT_ENCODE_SPEED = Histogram(
+    'supercut_encode_speed',
+    'Seconds of video encoded per second of encoding, for each clip.',
+    ['profile', 'codec'],
+    buckets=(0.25, 0.5, 1, 2, 4, 8, 16, 32, 64),
+)
+SUPERCUT_CLIPS = Counter(
+    'supercut_clips',
+    'Supercut clips by whether they came from the clip cache.',
+    ['cache'],
+)
+XOS_REQUESTS = Counter(
+    'xos_requests',
+    'XOS API pages downloaded, confirmed unchanged or served from the response cache, '
+    'and retries.',
+    ['result'],
+)
+SUPERCUT_POOL_THREADS = Gauge(
+    'supercut_pool_threads',
+    'Threads in the supercut encoding pools.',
+    multiprocess_mode='livesum',
+)
+SUPERCUT_POOL_BUSY = Gauge(
+    'supercut_pool_busy_threads',
+    'Supercut encoding pool threads that are cutting a source video.',
+    multiprocess_mode='livesum',
+)
+
+
+class Timings():
+    """
+    Thread-safe running totals of the time spent in each stage of a request
+    or job, for its structured log line.
+    """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.seconds = {}
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        """
+        Add `seconds` to the total for `stage`.
+        """
+        with self._lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+            self.counts[stage] = self.counts.get(stage, 0) + 1
+
+    def elapsed(self):
+        """
+        Seconds since these timings started.
+        """
+        return time.perf_counter() - self.started
+
+    def summary(self):
+        """
+        Returns the total seconds and count of each stage,
+        e.g. {'encode_seconds': 3.2, 'encode_count': 4}
+        """
+        with self._lock:
+            summary = {}
+            for stage, seconds in self.seconds.items():
+                summary[f'{stage}_seconds'] = round(seconds, 4)
+                summary[f'{stage}_count'] = self.counts[stage]
+            return summary
+
+
+@contextmanager
+def timed(histogram, timings=None, name=None, **labels):
+    """
+    Observe how long the block takes in `histogram`, and add it to `timings` as `name`.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        (histogram.labels(**labels) if labels else histogram).observe(seconds)
+        if timings is not None:
+            timings.add(name, seconds)
+
+
+def log_event(event, **fields):
+    """
+    Print a structured log line as JSON, e.g. {"event": "request", "path": "/", ...}
+    """
+    if STRUCTURED_LOGS:
+        line = json.dumps({'event': event, 'time': round(time.time(), 3), **fields}, default=str)
+        print(line, flush=True)
+
+
+def request_timings():
+    """
+    The stage timings of the current request, or None outside a request.
+    """
+    return getattr(g, 'timings', None) if has_request_context() else None
+
+
+def start_request_timings():
+    """
+    Start timing the stages of this request.
+    """
+    g.timings = Timings()
+
+
+def log_request(response):
+    """
+    Record how long this request took and log where the time went.
+    """
+    timings = request_timings()
+    if timings:
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        seconds = timings.elapsed()
+        REQUEST_SECONDS.labels(
+            endpoint=endpoint,
+            method=request.method,
+            status=response.status_code,
+        ).observe(seconds)
+        log_event(
+            'request',
+            method=request.method,
+            path=request.path,
+            endpoint=endpoint,
+            status=response.status_code,
+            seconds=round(seconds, 4),
+            **timings.summary(),
+        )
+    return response
+
+
+def start_render(sender, template, context, **extra):  # pylint: disable=unused-argument
+    """
+    Note when a template starts rendering.
+    """
+    if has_request_context():
+        g.render_started = time.perf_counter()
+
+
+def finish_render(sender, template, context, **extra):  # pylint: disable=unused-argument
+    """
+    Record how long a template took to render.
+    """
+    started = getattr(g, 'render_started', None) if has_request_context() else None
+    if started is None:
+        return
+    seconds = time.perf_counter() - started
+    RENDER_SECONDS.labels(template=template.name).observe(seconds)
+    timings = request_timings()
+    if timings:
+        timings.add('render', seconds)
+
+
+def instrument(application):
+    """
+    Measure and log every request a Flask application handles and the templates it renders.
+    """
+    application.before_request(start_request_timings)
+    application.after_request(log_request)
+    before_render_template.connect(start_render, application)
+    template_rendered.connect(finish_render, application)
+
+
+def observe_response_size(operation, response):
+    """
+    Record the size of an Elasticsearch response from its Content-Length header.
+    """
+    meta = getattr(response, 'meta', None)
+    length = meta.headers.get('content-length') if meta else None
+    if length:
+        ELASTICSEARCH_RESPONSE_BYTES.labels(operation=operation).observe(int(length))
+
+
+class SupercutQueueCollector():  # pylint: disable=too-few-public-methods
+    """
+    Reports the number of supercut jobs in each status when metrics are
+    scraped, read from the queue database every worker shares.
+    """
+    def __init__(self, queue, statuses=('queued', 'in_progress', 'saving')):
+        self.queue = queue
+        self.statuses = statuses
+
+    def collect(self):
+        """
+        Yield a gauge of jobs by status, plus the running total and the job limit.
+        """
+        counts = self.queue.counts()
+        jobs = GaugeMetricFamily('supercut_jobs', 'Supercut jobs by status.', labels=['status'])
+        for status in self.statuses:
+            jobs.add_metric([status], counts.get(status, 0))
+        yield jobs
+        yield GaugeMetricFamily(
+            'supercut_jobs_running',
+            'Supercut jobs being generated.',
+            value=counts.get('in_progress', 0) + counts.get('saving', 0),
+        )
+        yield GaugeMetricFamily(
+            'supercut_jobs_max',
+            'Supercut jobs that may run at once.',
+            value=self.queue.max_jobs,
+        )
+
+
+def exposition(*collectors):
+    """
+    Returns the metrics in the Prometheus text format and its content type.
+    Under gunicorn with PROMETHEUS_MULTIPROC_DIR set every worker's metrics
+    are added together, otherwise they're this process's.
+    """
+    registry = CollectorRegistry()
+    if PROMETHEUS_MULTIPROC_DIR:
+        MultiProcessCollector(registry)
+    else:
+        registry.register(REGISTRY)
+    for collector in collectors:
+        registry.register(collector)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
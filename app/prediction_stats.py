@@ -0,0 +1,104 @@
+import numpy as np
+
+
+class PredictionStats():
+    """
+    Statistics for the predictions in a list of classification frames.
+
+    The frames are read once into flat NumPy arrays of label ids, confidences
+    and timestamps, so counts, means, top labels, histograms and percentiles
+    are array operations rather than rescans of every frame for every label.
+    """
+    def __init__(self, frames):
+        label_ids = {}
+        ids = []
+        confidences = []
+        timestamps = []
+        for frame in frames or []:
+            timestamp = frame.get('timestamp') or 0
+            for prediction in frame.get('predictions') or []:
+                ids.append(label_ids.setdefault(prediction['prediction'], len(label_ids)))
+                confidences.append(prediction['confidence'])
+                timestamps.append(timestamp)
+        self.labels = list(label_ids)
+        self.label_ids = label_ids
+        self.ids = np.array(ids, dtype=np.int32)
+        self.confidences = np.array(confidences, dtype=np.float64)
+        self.timestamps = np.array(timestamps, dtype=np.float64)
+
+    def mask(self, threshold=0.0, label=None):
+        """
+        Returns a boolean array selecting predictions above `threshold`, optionally for one label.
+        """
+        selected = self.confidences > threshold
+        if label is not None:
+            selected &= self.ids == self.label_ids.get(label, -1)
+        return selected
+
+    def aggregate(self, threshold=0.0):
+        """
+        Returns compact per-label arrays of count, sum, min and max confidence,
+        indexed by label id, for predictions above `threshold`.
+        """
+        selected = self.mask(threshold)
+        ids = self.ids[selected]
+        confidences = self.confidences[selected]
+        size = len(self.labels)
+        minimums = np.full(size, np.inf)
+        maximums = np.full(size, -np.inf)
+        np.minimum.at(minimums, ids, confidences)
+        np.maximum.at(maximums, ids, confidences)
+        return {
+            'count': np.bincount(ids, minlength=size),
+            'sum': np.bincount(ids, weights=confidences, minlength=size),
+            'min': minimums,
+            'max': maximums,
+        }
+
+    def top(self, number=None, threshold=0.0):
+        """
+        Returns the `number` most common labels above `threshold` (all of them if None)
+        as a list of tuples: [(prediction label, count, average confidence)]
+        Ties keep the order the labels first appear in, the same as Counter.most_common().
+        """
+        selected = self.mask(threshold)
+        ids = self.ids[selected]
+        if not ids.size:
+            return []
+        aggregates = self.aggregate(threshold)
+        present, first_seen = np.unique(ids, return_index=True)
+        counts = aggregates['count'][present]
+        order = present[np.lexsort((first_seen, -counts))][:number]
+        return [
+            (
+                self.labels[label_id],
+                int(aggregates['count'][label_id]),
+                round(float(aggregates['sum'][label_id] / aggregates['count'][label_id]), 2),
+            )
+            for label_id in order
+        ]
+
+    def histogram(self, bin_seconds=60, label=None, threshold=0.0):
+        """
+        Returns the number of predictions above `threshold` in each `bin_seconds`
+        window of the video, optionally for one label.
+        """
+        timestamps = self.timestamps[self.mask(threshold, label)]
+        if not self.timestamps.size:
+            return []
+        bins = int(self.timestamps.max() // bin_seconds) + 1
+        return np.bincount((timestamps // bin_seconds).astype(np.int64), minlength=bins).tolist()
+
+    def percentiles(self, label=None, percentiles=(50, 90, 99), threshold=0.0):
+        """
+        Returns a dictionary of confidence percentiles for predictions above
+        `threshold`, optionally for one label, e.g. {50: 0.71, 90: 0.93, 99: 0.98}
+        """
+        confidences = self.confidences[self.mask(threshold, label)]
+        if not confidences.size:
+            return {}
+        values = np.percentile(confidences, percentiles)
+        return {
+            percentile: round(float(value), 4)
+            for percentile, value in zip(percentiles, values)
+        }
@@ -0,0 +1,41 @@
+import argparse
+
+from app.indexing import INDEX_CHUNK_SIZE, INDEX_THREADS
+from app.video import Search
+
+
+def main(argv=None):
+    """
+    Reindex all videos from XOS and report the indexing throughput.
+
+    Usage: python -m app.reindex --chunk-size 200 --threads 8 [--full | --build]
+    """
+    parser = argparse.ArgumentParser(description='Reindex XOS videos into Elasticsearch.')
+    parser.add_argument('--resource', default='videos')
+    parser.add_argument('--chunk-size', type=int, default=INDEX_CHUNK_SIZE)
+    parser.add_argument('--threads', type=int, default=INDEX_THREADS)
+    parser.add_argument(
+        '--full',
+        action='store_true',
+        help='Reindex every asset rather than only those changed since the last sync.',
+    )
+    parser.add_argument(
+        '--build',
+        action='store_true',
+        help='Build a new versioned index and swap the alias to it when finished.',
+    )
+    args = parser.parse_args(argv)
+
+    stats = Search().index_all(
+        resource=args.resource,
+        chunk_size=args.chunk_size,
+        threads=args.threads,
+        full=args.full,
+        build=args.build,
+    )
+    print(f'{stats["docs_per_second"]} docs/sec')
+    return 1 if stats['failed'] else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,186 @@
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+SEARCH_CACHE_TTL = float(os.getenv('SEARCH_CACHE_TTL', '300'))
+SEARCH_CACHE_SIZE = int(os.getenv('SEARCH_CACHE_SIZE', '256'))
+# An SQLite database to share cached results between gunicorn workers, blank to disable
+SEARCH_CACHE_DB = os.getenv('SEARCH_CACHE_DB', '')
+# Touched whenever the index changes so every process on this host drops its cached results
+SEARCH_CACHE_GENERATION_FILE = os.getenv('SEARCH_CACHE_GENERATION_FILE') or os.path.join(
+    tempfile.gettempdir(), 'video-search', 'search_generation',
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_expires ON results (expires);
+"""
+
+
+class SearchCache():  # pylint: disable=too-many-instance-attributes
+    """
+    A cache of search results with a time to live.
+
+    Results are kept in an in-process LRU of `max_entries` and, if `path`
+    is set, in an SQLite database shared by every worker. Bumping the
+    generation with `invalidate()` drops every cached result in every process.
+    Cached results are shared, so treat them as read-only.
+    """
+    def __init__(
+        self,
+        ttl=SEARCH_CACHE_TTL,
+        max_entries=SEARCH_CACHE_SIZE,
+        path=SEARCH_CACHE_DB,
+        generation_file=SEARCH_CACHE_GENERATION_FILE,
+    ):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.path = path
+        self.generation_file = generation_file
+        self.entries = OrderedDict()
+        self.stats = {'hits': 0, 'shared_hits': 0, 'misses': 0, 'invalidations': 0}
+        self._lock = threading.Lock()
+        self._schema_ready = False
+
+    @property
+    def enabled(self):
+        """
+        False if the TTL is 0.
+        """
+        return self.ttl > 0
+
+    def generation(self):
+        """
+        The current generation of the index, changed by `invalidate()`.
+        """
+        try:
+            return os.stat(self.generation_file).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def key(self, index, query, search_type, size, page, field):
+        """
+        Returns the cache key for a search in the current generation, normalising
+        the query so trivially different spellings of the same search share an entry.
+        Take the key before searching so results from before an invalidation aren't kept.
+        """
+        identity = json.dumps([
+            index,
+            ' '.join((query or '').lower().split()),
+            search_type,
+            size,
+            page,
+            field,
+        ])
+        return f'{self.generation()}:{hashlib.sha256(identity.encode("utf-8")).hexdigest()}'
+
+    def invalidate(self):
+        """
+        Drop every cached result, here and in every other process.
+        """
+        os.makedirs(os.path.dirname(self.generation_file), exist_ok=True)
+        with open(self.generation_file, 'a', encoding='utf-8'):
+            pass
+        # Make sure the generation changes even on filesystems with coarse timestamps
+        generation = max(time.time_ns(), self.generation() + 1)
+        os.utime(self.generation_file, ns=(generation, generation))
+        with self._lock:
+            self.entries.clear()
+            self.stats['invalidations'] += 1
+        if self.path:
+            with self.connect() as connection:
+                connection.execute('DELETE FROM results')
+
+    def get(self, key):
+        """
+        Returns the cached result for a key, or None.
+        """
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > now:
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry[1]
+            self.entries.pop(key, None)
+        if self.path:
+            with self.connect() as connection:
+                row = connection.execute(
+                    'SELECT value, expires FROM results WHERE key = ? AND expires > ?',
+                    (key, now),
+                ).fetchone()
+            if row:
+                value = json.loads(row[0])
+                with self._lock:
+                    self.stats['shared_hits'] += 1
+                    self._remember(key, value, row[1])
+                return value
+        with self._lock:
+            self.stats['misses'] += 1
+        return None
+
+    def set(self, key, value):
+        """
+        Cache a result for `ttl` seconds.
+        """
+        if not self.enabled:
+            return
+        expires = time.time() + self.ttl
+        with self._lock:
+            self._remember(key, value, expires)
+        if self.path:
+            with self.connect() as connection:
+                connection.execute('DELETE FROM results WHERE expires <= ?', (time.time(),))
+                connection.execute(
+                    'INSERT OR REPLACE INTO results (key, value, expires) VALUES (?, ?, ?)',
+                    (key, json.dumps(value), expires),
+                )
+
+    def _remember(self, key, value, expires):
+        self.entries[key] = (expires, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    @contextmanager
+    def connect(self):
+        """
+        A new connection to the shared cache database.
+        """
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        if not self._schema_ready:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(SCHEMA)
+            self._schema_ready = True
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def summary(self):
+        """
+        Returns the hit and miss counters for this process.
+        """
+        with self._lock:
+            stats = dict(self.stats)
+            stats['entries'] = len(self.entries)
+        lookups = stats['hits'] + stats['shared_hits'] + stats['misses']
+        hits = stats['hits'] + stats['shared_hits']
+        stats['hit_rate'] = round(hits / lookups, 3) if lookups else 0
+        stats['pid'] = os.getpid()
+        stats['ttl'] = self.ttl
+        stats['shared'] = bool(self.path)
+        return stats
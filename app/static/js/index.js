@@ -12,23 +12,8 @@ function setPlaybackTime(videoId, seconds) {
   video.play();
 }
 
-document.addEventListener('DOMContentLoaded', function() {
-  // Highlight query strings in search results
-  let searchQuery = document.querySelector('input[name="query"]');
-  if (searchQuery) {
-    searchQuery = searchQuery.value.trim().toLowerCase();
-    const segments = document.querySelectorAll('.segment dd');
-    segments.forEach(segment => {
-      const textContent = segment.innerHTML;
-      if (textContent.toLowerCase().includes(searchQuery)) {
-        // Create a regex to match the search query (case-insensitive)
-        const regex = new RegExp(`(${searchQuery})`, 'gi');
-        const highlightedText = textContent.replace(regex, '<span class="highlight">$1</span>');
-        segment.innerHTML = highlightedText;
-      }
-    });
-  }
-
+function setupCredits() {
+  // Show each supercut credit while its clip plays
   const video   = document.getElementById('supercut');
   const credits = Array.from(
     /** @type {NodeListOf<HTMLLIElement>} */
@@ -59,4 +44,25 @@ document.addEventListener('DOMContentLoaded', function() {
   video.addEventListener('timeupdate',   updateCredits); // normal playback
   video.addEventListener('seeked',       updateCredits); // user drags scrubber
   video.addEventListener('loadedmetadata', updateCredits); // initial state
+  if (video.readyState > 0) updateCredits(); // already playing, e.g. a streamed supercut
+}
+
+document.addEventListener('DOMContentLoaded', function() {
+  // Highlight query strings in search results
+  let searchQuery = document.querySelector('input[name="query"]');
+  if (searchQuery) {
+    searchQuery = searchQuery.value.trim().toLowerCase();
+    const segments = document.querySelectorAll('.segment dd');
+    segments.forEach(segment => {
+      const textContent = segment.innerHTML;
+      if (textContent.toLowerCase().includes(searchQuery)) {
+        // Create a regex to match the search query (case-insensitive)
+        const regex = new RegExp(`(${searchQuery})`, 'gi');
+        const highlightedText = textContent.replace(regex, '<span class="highlight">$1</span>');
+        segment.innerHTML = highlightedText;
+      }
+    });
+  }
+
+  setupCredits();
 }, false);
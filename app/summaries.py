@@ -0,0 +1,88 @@
+import re
+from collections import Counter
+
+from app.utils import STOPWORDS
+
+# Classification sources summarised at index time, relative to `classification`
+SUMMARY_SOURCES = (
+    'captions.clap',
+    'captions.huggingface',
+    'objects.huggingface',
+    'objects.yolo',
+    'actions',
+)
+SUMMARY_WORDS = 50
+NON_ALPHABETICAL = re.compile('[^a-zA-Z]')
+STOPWORD_SET = frozenset(STOPWORDS)
+
+
+def common_words(text, number=SUMMARY_WORDS):
+    """
+    Returns a list of tuples containing the most common word and how many times it appears.
+    Frames are passed as they are, so their words are split from the frames' text
+    exactly as the detail page has always shown them, e.g. punctuation joins words.
+    """
+    tags = None
+    try:
+        text = str(text)
+        words = [NON_ALPHABETICAL.sub('', word.lower()) for word in text.split(' ')]
+        tags = Counter(word for word in words if word not in STOPWORD_SET).most_common(number)
+    except TypeError:
+        pass
+    return tags
+
+
+def summarise_frames(frames, number=SUMMARY_WORDS):
+    """
+    Summarise a list of classification frames.
+
+    Returns the `number` most common words in the frames, and every
+    predicted label with how many times it appears and its mean confidence.
+    e.g. {
+        'words': [{'word': 'frog', 'count': 3}],
+        'labels': [{'label': 'a frog', 'count': 3, 'confidence': 0.91}],
+    }
+    """
+    counts = Counter()
+    totals = {}
+    for frame in frames or []:
+        for prediction in frame.get('predictions') or []:
+            label = prediction.get('prediction') or ''
+            counts[label] += 1
+            totals[label] = totals.get(label, 0.0) + (prediction.get('confidence') or 0.0)
+    return {
+        'words': [
+            {'word': word, 'count': count} for word, count in common_words(frames or [], number)
+        ],
+        'labels': [
+            {'label': label, 'count': count, 'confidence': round(totals[label] / count, 2)}
+            for label, count in counts.most_common()
+        ],
+    }
+
+
+def lookup(data, path):
+    """
+    Returns the value at a dotted path in nested dictionaries, or None.
+    """
+    for key in path.split('.'):
+        if not isinstance(data, dict):
+            return None
+        data = data.get(key)
+    return data
+
+
+def summarise_document(document):
+    """
+    Returns the summaries of every classification source in a video document,
+    nested the same way as `classification`.
+    """
+    summaries = {}
+    for source in SUMMARY_SOURCES:
+        frames = lookup(document.get('classification'), source)
+        summary = summaries
+        keys = source.split('.')
+        for key in keys[:-1]:
+            summary = summary.setdefault(key, {})
+        summary[keys[-1]] = summarise_frames(frames if isinstance(frames, list) else [])
+    return summaries
@@ -0,0 +1,389 @@
+import json
+import math
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+from functools import lru_cache
+
+from moviepy.config import FFMPEG_BINARY
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+
+SUPERCUT_RESOLUTION = (1280, 720)
+SUPERCUT_FPS = int(os.getenv('SUPERCUT_FPS', '25'))
+SUPERCUT_AUDIO_RATE = 48000
+SUPERCUT_AUDIO_BITRATE = '128k'
+FADE_DURATION = 0.5
+# Windows from the same video closer than this are joined into one clip
+SUPERCUT_MERGE_GAP = float(os.getenv('SUPERCUT_MERGE_GAP', '0'))
+# Publish an HLS playlist that grows as clips are encoded so playback can start straight away
+SUPERCUT_STREAMING = os.getenv('SUPERCUT_STREAMING', 'false').lower() == 'true'
+HLS_PLAYLIST = 'playlist.m3u8'
+
+# Video encoder for supercut segments, 'auto' uses a hardware encoder if one works
+SUPERCUT_ENCODER = os.getenv('SUPERCUT_ENCODER', 'auto')
+HARDWARE_ENCODERS = ('h264_videotoolbox', 'h264_nvenc', 'h264_qsv')
+# Encode profiles: x264 preset, CRF, resolution, frame rate and the most threads
+# a job may use (0 for its share of the CPU budget). Override them with JSON, e.g.
+# SUPERCUT_ENCODE_PROFILES='{"standard": {"crf": 21}}'
+ENCODE_PROFILES = {
+    'preview': {
+        'preset': 'ultrafast',
+        'crf': 30,
+        'resolution': [854, 480],
+        'fps': 15,
+        'threads': 0,
+    },
+    'standard': {
+        'preset': 'veryfast',
+        'crf': 23,
+        'resolution': list(SUPERCUT_RESOLUTION),
+        'fps': SUPERCUT_FPS,
+        'threads': 0,
+    },
+    'archival': {
+        'preset': 'slow',
+        'crf': 18,
+        'resolution': [1920, 1080],
+        'fps': SUPERCUT_FPS,
+        'threads': 0,
+    },
+}
+SUPERCUT_ENCODE_PROFILES = json.loads(os.getenv('SUPERCUT_ENCODE_PROFILES') or '{}')
+SUPERCUT_PROFILE = os.getenv('SUPERCUT_PROFILE', 'standard')
+# Switch to SUPERCUT_BUSY_PROFILE while this many jobs are waiting, 0 to never switch
+SUPERCUT_BUSY_PROFILE = os.getenv('SUPERCUT_BUSY_PROFILE', 'preview')
+SUPERCUT_BUSY_QUEUE_DEPTH = int(os.getenv('SUPERCUT_BUSY_QUEUE_DEPTH', '4'))
+# Make a short preview supercut first, with the full one built on request
+SUPERCUT_PREVIEW = os.getenv('SUPERCUT_PREVIEW', 'false').lower() == 'true'
+SUPERCUT_PREVIEW_PROFILE = os.getenv('SUPERCUT_PREVIEW_PROFILE', 'preview')
+SUPERCUT_PREVIEW_MAX_CLIPS = int(os.getenv('SUPERCUT_PREVIEW_MAX_CLIPS', '8'))
+SUPERCUT_PREVIEW_MAX_SECONDS = float(os.getenv('SUPERCUT_PREVIEW_MAX_SECONDS', '30'))
+# Hardware encoder presets closest to each x264 preset
+NVENC_PRESETS = {
+    'ultrafast': 'p1', 'superfast': 'p1', 'veryfast': 'p2', 'faster': 'p3', 'fast': 'p4',
+    'medium': 'p5', 'slow': 'p6', 'slower': 'p7', 'veryslow': 'p7',
+}
+REALTIME_PRESETS = ('ultrafast', 'superfast', 'veryfast')
+
+
+def probe(path):
+    """
+    Returns the duration of a video and whether it has an audio stream.
+    """
+    infos = ffmpeg_parse_infos(path)
+    return {
+        'duration': infos.get('duration'),
+        'audio': infos.get('audio_found', False),
+    }
+
+
+def merge_windows(windows, gap=SUPERCUT_MERGE_GAP):
+    """
+    Sort (start, end) windows and merge any that overlap or are within `gap` seconds.
+    e.g. [(9.5, 12), (0, 2), (11.5, 14)] -> [(0, 2), (9.5, 14)]
+    """
+    merged = []
+    for start, end in sorted(windows):
+        if merged and start <= merged[-1][1] + gap:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def preview_clips(clips, max_clips=SUPERCUT_PREVIEW_MAX_CLIPS,
+                  max_seconds=SUPERCUT_PREVIEW_MAX_SECONDS):
+    """
+    Choose the clips for a preview from (path, start, end, score) clips: the
+    highest scoring first, up to `max_clips` clips and `max_seconds` in total,
+    shortening the last clip to fit. Returns (path, start, end) clips.
+    """
+    selected = []
+    total = 0
+    # sorted() is stable, so clips from the same hit keep their order
+    for path, start, end, _ in sorted(clips, key=lambda clip: -clip[3]):
+        if len(selected) >= max_clips or total >= max_seconds:
+            break
+        end = min(end, start + max_seconds - total)
+        selected.append((path, start, end))
+        total += end - start
+    return selected
+
+
+def group_windows(clips):
+    """
+    Group (path, start, end) clips by source video, keeping the order in which
+    each video first appears, with each video's windows merged in timestamp order.
+    """
+    sources = {}
+    for path, start, end in clips:
+        sources.setdefault(path, []).append((start, end))
+    return [(path, merge_windows(windows)) for path, windows in sources.items()]
+
+
+def encode_profiles(overrides=None):
+    """
+    Returns the encode profiles with any settings from SUPERCUT_ENCODE_PROFILES applied.
+    """
+    overrides = SUPERCUT_ENCODE_PROFILES if overrides is None else overrides
+    profiles = {name: dict(profile) for name, profile in ENCODE_PROFILES.items()}
+    for name, settings in overrides.items():
+        profiles[name] = {**profiles.get(name, profiles['standard']), **settings}
+    return profiles
+
+
+def encode_profile(name=SUPERCUT_PROFILE):
+    """
+    Returns an encode profile by name, with the encoder it will use,
+    e.g. {'name': 'preview', 'codec': 'libx264', 'preset': 'ultrafast', ...}
+    """
+    profiles = encode_profiles()
+    if name not in profiles:
+        name = 'standard'
+    return {'name': name, 'codec': detect_encoder(), **profiles[name]}
+
+
+def choose_profile(queued, default=SUPERCUT_PROFILE, busy=SUPERCUT_BUSY_PROFILE,
+                   depth=SUPERCUT_BUSY_QUEUE_DEPTH):
+    """
+    Returns the name of the profile to encode with when `queued` jobs are waiting:
+    the faster `busy` profile once the queue is `depth` jobs deep, otherwise `default`.
+    """
+    if depth and queued >= depth:
+        return busy
+    return default
+
+
+@lru_cache(maxsize=None)
+def detect_encoder(encoder=SUPERCUT_ENCODER):
+    """
+    Returns the video encoder to use. With 'auto' each hardware encoder
+    this machine might have is tried on a tiny test clip and the first one
+    that works is used, falling back to libx264.
+    """
+    if encoder != 'auto':
+        return encoder
+    for candidate in HARDWARE_ENCODERS:
+        if candidate == 'h264_videotoolbox' and platform.system() != 'Darwin':
+            continue
+        try:
+            subprocess.run(
+                [
+                    FFMPEG_BINARY, '-hide_banner', '-loglevel', 'error',
+                    '-f', 'lavfi', '-i', 'color=size=256x256:rate=25:duration=0.2',
+                    '-c:v', candidate, '-f', 'null', '-',
+                ],
+                check=True,
+                capture_output=True,
+                timeout=30,
+            )
+            return candidate
+        except (OSError, subprocess.SubprocessError):
+            continue
+    return 'libx264'
+
+
+def codec_arguments(codec, preset, crf):
+    """
+    Returns the ffmpeg arguments that set an encoder's speed and quality
+    from an x264 preset and CRF.
+    """
+    if codec == 'h264_nvenc':
+        return ['-preset', NVENC_PRESETS.get(preset, 'p4'), '-rc', 'vbr', '-cq', str(crf)]
+    if codec == 'h264_qsv':
+        preset = 'veryfast' if preset in ('ultrafast', 'superfast') else preset
+        return ['-preset', preset, '-global_quality', str(crf)]
+    if codec == 'h264_videotoolbox':
+        return ['-realtime', 'true' if preset in REALTIME_PRESETS else 'false']
+    return ['-preset', preset, '-crf', str(crf)]
+
+
+def encoder_settings(codec='libx264', preset='veryfast', crf=23, resolution=SUPERCUT_RESOLUTION,
+                     fps=SUPERCUT_FPS):
+    """
+    Everything that affects how a segment is encoded, used in clip cache keys.
+    """
+    return {
+        'codec': codec,
+        'preset': preset,
+        'crf': crf,
+        'resolution': list(resolution),
+        'fps': fps,
+        'audio_rate': SUPERCUT_AUDIO_RATE,
+        'audio_bitrate': SUPERCUT_AUDIO_BITRATE,
+    }
+
+
+def segment_filters(duration, fade, audio, resolution=SUPERCUT_RESOLUTION, fps=SUPERCUT_FPS):
+    """
+    Returns the ffmpeg video and audio filters that normalise a segment
+    to the supercut resolution, frame rate and audio format.
+    """
+    width, height = resolution
+    video_filter = (
+        f'scale={width}:{height}:force_original_aspect_ratio=decrease,'
+        f'pad={width}:{height}:(ow-iw)/2:(oh-ih)/2:color=black,'
+        f'setsar=1,fps={fps},format=yuv420p'
+    )
+    audio_filter = f'aresample={SUPERCUT_AUDIO_RATE}'
+    if fade and audio:
+        fade_out_start = max(duration - FADE_DURATION, 0)
+        audio_filter += (
+            f',afade=t=in:st=0:d={FADE_DURATION}'
+            f',afade=t=out:st={fade_out_start:.3f}:d={FADE_DURATION}'
+        )
+    return video_filter, audio_filter
+
+
+# pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-locals
+def encode_segment(path, start, end, output_path, fade=True, threads=1, codec='libx264',
+                   preset='veryfast', info=None, crf=23, resolution=SUPERCUT_RESOLUTION,
+                   fps=SUPERCUT_FPS):
+    """
+    Cut start → end from a video and encode it once at the supercut resolution.
+
+    Every segment is encoded with identical parameters (codec, frame rate,
+    pixel format, timescale and audio layout) so they can be joined with
+    the concat demuxer without re-encoding. Videos without audio get a silent track.
+    """
+    info = info or probe(path)
+    if info['duration']:
+        end = min(end, info['duration'])
+    duration = max(end - start, 1 / fps)
+    video_filter, audio_filter = segment_filters(duration, fade, info['audio'], resolution, fps)
+
+    command = [
+        FFMPEG_BINARY, '-hide_banner', '-loglevel', 'error', '-y',
+        '-ss', f'{start:.3f}', '-t', f'{duration:.3f}', '-i', path,
+    ]
+    if info['audio']:
+        command += ['-map', '0:v:0', '-map', '0:a:0']
+    else:
+        command += [
+            '-f', 'lavfi', '-t', f'{duration:.3f}',
+            '-i', f'anullsrc=r={SUPERCUT_AUDIO_RATE}:cl=stereo',
+            '-map', '0:v:0', '-map', '1:a:0',
+        ]
+    command += [
+        '-vf', video_filter,
+        '-af', audio_filter,
+        '-c:v', codec,
+        *codec_arguments(codec, preset, crf),
+        '-threads', str(threads),
+        '-c:a', 'aac',
+        '-b:a', SUPERCUT_AUDIO_BITRATE,
+        '-ar', str(SUPERCUT_AUDIO_RATE),
+        '-ac', '2',
+        '-video_track_timescale', '90000',
+        '-f', 'mp4',
+        output_path,
+    ]
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    return output_path
+
+
+def concat_segments(paths, output_path):
+    """
+    Join encoded segments with ffmpeg's concat demuxer, copying the streams
+    rather than re-encoding. The output is written next to `output_path`
+    and renamed into place so a half-written supercut is never served.
+    """
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as list_file:
+        for path in paths:
+            escaped_path = os.path.abspath(path).replace("'", "'\\''")
+            list_file.write(f"file '{escaped_path}'\n")
+    partial_path = f'{output_path}.part'
+    try:
+        subprocess.run(
+            [
+                FFMPEG_BINARY, '-hide_banner', '-loglevel', 'error', '-y',
+                '-f', 'concat', '-safe', '0', '-i', list_file.name,
+                '-c', 'copy',
+                '-movflags', '+faststart',
+                '-f', 'mp4',
+                partial_path,
+            ],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        os.replace(partial_path, output_path)
+    finally:
+        os.remove(list_file.name)
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+    return output_path
+
+
+class HLSPlaylist():
+    """
+    A growing HLS event playlist of supercut segments.
+
+    Each finished clip is remuxed to an MPEG-TS segment without re-encoding
+    and the playlist is rewritten atomically, so players can start on the
+    first clip while the rest are still being encoded.
+    """
+    def __init__(self, directory, target_duration):
+        self.directory = directory
+        self.target_duration = max(1, math.ceil(target_duration))
+        self.segments = []
+        # Start from scratch if an earlier attempt left segments behind
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+
+    @property
+    def path(self):
+        """
+        The playlist file path.
+        """
+        return os.path.join(self.directory, HLS_PLAYLIST)
+
+    def append(self, clip_path):
+        """
+        Add an encoded clip to the end of the playlist.
+        """
+        name = f'{len(self.segments):05d}.ts'
+        subprocess.run(
+            [
+                FFMPEG_BINARY, '-hide_banner', '-loglevel', 'error', '-y',
+                '-i', clip_path,
+                '-map', '0', '-c', 'copy',
+                '-bsf:v', 'h264_mp4toannexb',
+                '-f', 'mpegts',
+                os.path.join(self.directory, name),
+            ],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        self.segments.append((name, probe(clip_path)['duration'] or 0))
+        self.write()
+
+    def write(self, complete=False):
+        """
+        Write the playlist, marking it as finished if `complete`.
+        """
+        lines = [
+            '#EXTM3U',
+            '#EXT-X-VERSION:3',
+            '#EXT-X-PLAYLIST-TYPE:EVENT',
+            f'#EXT-X-TARGETDURATION:{self.target_duration}',
+            '#EXT-X-MEDIA-SEQUENCE:0',
+        ]
+        for index, (name, duration) in enumerate(self.segments):
+            if index:
+                # Every clip starts its own timestamps
+                lines.append('#EXT-X-DISCONTINUITY')
+            lines += [f'#EXTINF:{duration:.3f},', name]
+        if complete:
+            lines.append('#EXT-X-ENDLIST')
+        partial_path = f'{self.path}.part'
+        with open(partial_path, 'w', encoding='utf-8') as playlist_file:
+            playlist_file.write('\n'.join(lines) + '\n')
+        os.replace(partial_path, self.path)
+
+    def close(self):
+        """
+        Mark the playlist as finished so players stop polling for more segments.
+        """
+        self.write(complete=True)
@@ -1,113 +1,124 @@
 import json
-import multiprocessing
 import os
-import platform
 import re
-import statistics
-import tempfile
 import threading
 import time
-import uuid
-from collections import Counter
-from concurrent.futures import ProcessPoolExecutor
-from math import exp, floor
+from datetime import datetime, timezone
 from pathlib import Path
 
 import elasticsearch
-import requests
-from elasticsearch import Elasticsearch
-from flask import Flask, Response, render_template, request
-from moviepy import (ColorClip, CompositeVideoClip, VideoFileClip,
-                     concatenate_videoclips)
-from moviepy.audio.fx import AudioFadeIn, AudioFadeOut
-from PIL import Image
+from flask import Flask, Response, jsonify, render_template, request
 from slugify import slugify
 
-from app.utils import STOPWORDS
+from app.catalogue import SupercutCatalogue
+from app.elastic import (ELASTICSEARCH_NESTED, ELASTICSEARCH_PIT_KEEP_ALIVE,
+                         SEARCH_FIELDS, SharedPointsInTime, compact_hit,
+                         create_build_index, cursor_body, decode_cursor,
+                         ensure_index, finalise_build_index, get_client,
+                         has_next_page, merge_inner_hits, msearch_searches,
+                         nested_path, page_cursors, pool_stats, prune_indices,
+                         search_body, swap_alias, versioned_index_name)
+from app.exports import ExportWriter
+from app.filters import FILTERS
+from app.indexing import (INDEX_BUILD_MAX_FAILURES, INDEX_CHUNK_SIZE,
+                          INDEX_THREADS, URL_FIELDS, XOS_ID_PAGE_SIZE,
+                          XOS_MODIFIED_SINCE_PARAM, XOS_PAGE_SIZE, bulk_index,
+                          delete_actions, fetch_pages, load_state, save_state,
+                          sync_actions)
+from app.jobs import SupercutQueue
+from app.local_search import get_local_index, rebuild_local_index
+from app.metrics import (ELASTICSEARCH_SECONDS, SupercutQueueCollector,
+                         exposition, instrument, observe_response_size,
+                         request_timings, timed)
+from app.search_cache import SearchCache
+from app.summaries import summarise_document
+from app.supercut import (HLS_PLAYLIST, SUPERCUT_PREVIEW, SUPERCUT_PROFILE,
+                          SUPERCUT_STREAMING)
+from app.xos import XOSAPI
 
 DEBUG = os.getenv('DEBUG', 'false').lower() == 'true'
-XOS_API_ENDPOINT = os.getenv('XOS_API_ENDPOINT', None)
-XOS_API_TOKEN = os.getenv('XOS_API_TOKEN', None)
-XOS_RETRIES = int(os.getenv('XOS_RETRIES', '3'))
-XOS_TIMEOUT = int(os.getenv('XOS_TIMEOUT', '60'))
-ELASTICSEARCH_HOST = os.getenv('ELASTICSEARCH_HOST', 'http://video-search:9200')
-ELASTICSEARCH_CLOUD_ID = os.getenv('ELASTICSEARCH_CLOUD_ID')
-ELASTICSEARCH_API_KEY = os.getenv('ELASTICSEARCH_API_KEY')
 ELASTICSEARCH_INDEX_NAME = os.getenv('ELASTICSEARCH_INDEX_NAME', None)
 PORT = int(os.getenv('PORT', '8081'))
 EXPORT_VIDEO_JSON = os.getenv('EXPORT_VIDEO_JSON', 'false').lower() == 'true'
 REMOVE_QUERY_PARAMS = os.getenv('REMOVE_QUERY_PARAMS', 'false').lower() == 'true'
 EXAMPLES = os.getenv('EXAMPLES', None)
-SUPERCUT_RESOLUTION = (1280, 720)
-IMAGE_AUDIO_CAPTION_DURATION = 4.5
-IS_MAC = platform.system() == 'Darwin'
-VIDEO_CODEC = 'h264_videotoolbox' if IS_MAC else 'libx264'
-PRESET = 'realtime' if IS_MAC else 'veryfast'
-THREADS = 0 if IS_MAC else multiprocessing.cpu_count()
+# 'elasticsearch', or 'local' to search an embedded index built from the exported video JSON
+SEARCH_BACKEND = os.getenv('SEARCH_BACKEND', 'elasticsearch')
+# Progress streams open at once in each worker, and how long each may stay open
+# before the browser reconnects, 0 for no limit
+SUPERCUT_MAX_STREAMS = int(os.getenv('SUPERCUT_MAX_STREAMS', '100'))
+SUPERCUT_STREAM_SECONDS = float(os.getenv('SUPERCUT_STREAM_SECONDS', '60'))
+SUPERCUT_KEEPALIVE_SECONDS = float(os.getenv('SUPERCUT_KEEPALIVE_SECONDS', '15'))
+# How long the browser waits before reconnecting to a closed progress stream
+SUPERCUT_STREAM_RETRY_MS = 1000
+SEARCH_TYPES = ('audio', 'image', 'audioDescription')
+# Most search results on a page
+MAX_SEARCH_SIZE = 50
 
 application = Flask(__name__)
 application.config['TEMPLATES_AUTO_RELOAD'] = DEBUG
-
-# Global dictionary to track supercut tasks
-supercut_tasks = {}
-lock = threading.Lock()
+instrument(application)
+application.jinja_env.filters.update(FILTERS)
+# hls.js plays streaming supercuts in browsers without native HLS, once it's been vendored
+HLS_JS = os.path.isfile(os.path.join(application.static_folder, 'js', 'hls.min.js'))
 
 
 @application.route('/')
-def home():
+def home():  # pylint: disable=too-many-locals
     """
     Video search home page.
     """
     results = None
     errors = None
     supercut = None
+    # What the supercut plays, for its credits
+    clips = []
     examples = EXAMPLES or []
     args = request.args.copy()
     query = request.args.get('query', None)
-    size = args.get('size', type=int, default=20)
+    size = min(args.get('size', type=int, default=20), MAX_SEARCH_SIZE)
+    args['size'] = size
     page = args.get('page', type=int, default=1)
     search_type = request.args.get('searchType', 'audio')
     supercuts = request.args.get('supercuts', 'off').lower() == 'on'
+    full = request.args.get('full', 'off').lower() == 'on'
+    preview = False
 
     if query:
         query = sanitise_string(query)
         args['query'] = query
         search = Search()
         results, errors = search.search(args)
+    previous_cursor, next_cursor = page_cursors(results, page, size) if results else (None, None)
+    next_page = has_next_page(results, page, size) if results else False
 
     if EXAMPLES:
         examples = examples.strip().split(',')
     else:
-        # Try getting pre-generated supercuts as examples
-        examples = sorted({
-            stem.split('_')[1].replace('-', ' ')
-            for stem in (
-                path.stem
-                for path in Path('app/static/videos').glob('*.mp4')
-            )
-            if len(stem.split('_')) > 1
-        })
+        # Use pre-generated supercuts as examples
+        examples = supercut_catalogue.examples()
 
     if supercuts and query and results and results.get('hits') and results.get('hits').get('hits'):
         filename = get_filename(query, page, search_type)
-        output_path = f'app/static/videos/{filename}'
-        if os.path.isfile(output_path):
+        # Show a quick preview first unless the full supercut exists or was asked for
+        preview = SUPERCUT_PREVIEW and not full
+        entry = supercut_catalogue.get(filename)
+        if entry and not (entry['preview'] and full):
             supercut = filename
+            clips = entry['clips'] or []
+            preview = bool(entry['preview'])
+            if not preview and entry['profile'] not in (None, SUPERCUT_PROFILE):
+                # It was made with the faster profile while the queue was busy, so make it
+                # again with the usual one and keep showing this one until then
+                supercut_queue.submit(
+                    query, page, search_type, size, cursor=args.get('cursor'),
+                    profile=SUPERCUT_PROFILE,
+                )
         else:
-            # Generate a unique task ID
-            task_id = str(uuid.uuid4())
-            with lock:
-                supercut_tasks[task_id] = {
-                    'status': 'in_progress',
-                    'progress': 0,
-                    'filename': None,
-                }
-            # Start background thread for supercut generation
-            thread = threading.Thread(
-                target=generate_supercut_background,
-                args=(query, results, task_id, page, search_type),
+            # Queue the supercut, or join an identical one that's already queued
+            task_id = supercut_queue.submit(
+                query, page, search_type, size, preview=preview, cursor=args.get('cursor'),
             )
-            thread.start()
             # Render progress page
             return render_template(
                 'progress.html',
@@ -118,6 +129,8 @@ def home():
                 size=size,
                 page=page,
                 errors=errors,
+                preview=preview,
+                hls_js=SUPERCUT_STREAMING and HLS_JS,
             )
 
     return render_template(
@@ -130,7 +143,12 @@ def home():
         errors=errors,
         examples=examples,
         supercut=supercut,
+        clips=clips,
         supercuts=supercuts,
+        preview=preview,
+        previous_cursor=previous_cursor,
+        next_cursor=next_cursor,
+        next_page=next_page,
     )
 
 
@@ -145,142 +163,170 @@ def video_detail(video_id):
     return render_template(
         'detail.html',
         video=video,
-        export_json=EXPORT_VIDEO_JSON,
+        export_json=EXPORT_VIDEO_JSON and export_writer.filename(video['_source'].get('id')),
     )
 
 
-@application.route('/supercut_progress/<task_id>')
-def supercut_progress(task_id):
+def progress_message(task):
     """
-    Stream progress updates for supercut generation via EventSource.
+    Returns the EventSource message for a job's status, and whether the job has finished.
     """
-    def generate():
-        while True:
-            with lock:
-                task = supercut_tasks.get(task_id)
-                if task:
-                    if task['status'] == 'in_progress':
-                        yield f"data: {task['progress']}\n\n"
-                    elif task['status'] == 'saving':
-                        yield f"data: {task['status']}\n\n"
-                    elif task['status'] == 'completed':
-                        if task['filename']:
-                            yield f"data: completed {task['filename']}\n\n"
-                        else:
-                            yield "data: no_clips\n\n"
-                        break
-            time.sleep(1)  # Poll every second
-    return Response(generate(), mimetype='text/event-stream')
-
-
-@application.template_filter('tags_json_to_string')
-def tags_json_to_string(tags):
-    """
-    Converts a JSON dictionary of tag data to a formatted string.
-    Input: {"music": 69, "frog": 26, "water": 18}
-    Output: music (69), frog (26), water (18)
-    """
-    tags = json.loads(tags)
-    return ', '.join([f'{key} ({tags[key]})' for key in tags.keys() if key])
+    if task['status'] in ('queued', 'saving'):
+        return f"data: {task['status']}\n\n", False
+    if task['status'] == 'in_progress':
+        return f"data: {task['progress']}\n\n", False
+    if task['status'] == 'failed':
+        return "data: failed\n\n", True
+    if task['status'] == 'completed':
+        if task['filename']:
+            return f"data: completed {task['filename']}\n\n", True
+        return "data: no_clips\n\n", True
+    return None, False
 
 
-@application.template_filter('tags_list_to_string')
-def tags_list_to_string(tags):
+@application.route('/supercut_credits/<task_id>')
+def supercut_credits(task_id):
     """
-    Converts a list of tag data to a formatted string.
-    Input: [("music", 69), ("frog", 26), ("water", 18)]
-    Output: music (69), frog (26), water (18)
+    The credits of a finished supercut job, for its progress page to show once it's made.
     """
-    return ', '.join([f'{item[0]} ({item[1]})' for item in tags if item])
+    task = supercut_queue.get(task_id)
+    if not task:
+        return Response('Unknown supercut job', status=404)
+    return render_template('credits.html', clips=json.loads(task['clips'] or '[]'))
 
 
-@application.template_filter('seconds_to_timecode')
-def seconds_to_timecode_filter(seconds):
-    """
-    Converts an integer of seconds into timecode format.
+@application.route('/supercut_progress/<task_id>')
+def supercut_progress(task_id):
     """
-    timecode_seconds = str(floor(seconds % 60))
-    timecode_minutes = str(floor((seconds / 60) % 60))
-    timecode_hours = str(floor(seconds / 60 / 60))
-    timecode_seconds = pad_with_leading_zero(timecode_seconds)
-    timecode_minutes = pad_with_leading_zero(timecode_minutes)
-    timecode_hours = pad_with_leading_zero(timecode_hours)
-    return f'{timecode_hours}:{timecode_minutes}:{timecode_seconds}'
-
+    Stream progress updates for supercut generation via EventSource.
 
-@application.template_filter('float_to_percentage')
-def float_to_percentage_filter(confidence):
-    """
-    Converts a confidence level float into a percentage.
+    The supercut worker publishes every change to a job with its new state,
+    so a stream reads the job once when it connects and then only relays
+    those events. Streams are capped per worker and closed after
+    SUPERCUT_STREAM_SECONDS, and EventSource reconnects on its own.
     """
-    return int(confidence * 100)
+    if not progress_streams.acquire(blocking=False):  # pylint: disable=consider-using-with
+        return Response('Too many progress streams', status=503, headers={'Retry-After': '5'})
+    events = supercut_queue.events
+
+    def generate():
+        streaming = False
+        deadline = time.monotonic() + SUPERCUT_STREAM_SECONDS
+        yield f'retry: {SUPERCUT_STREAM_RETRY_MS}\n\n'
+        # Read the version first so an update while the job is read isn't missed
+        version = events.version(task_id)
+        task = supercut_queue.get(task_id)
+        while True:
+            if task:
+                playlist = None if streaming else get_stream(task)
+                if playlist:
+                    # Playback can start while the rest of the supercut is encoded
+                    streaming = True
+                    yield f"data: streaming {playlist}\n\n"
+                message, finished = progress_message(task)
+                if message:
+                    yield message
+                if finished:
+                    return
+            while True:
+                timeout = SUPERCUT_KEEPALIVE_SECONDS
+                if SUPERCUT_STREAM_SECONDS:
+                    timeout = min(timeout, deadline - time.monotonic())
+                    if timeout <= 0:
+                        return
+                latest = events.wait(task_id, version, timeout)
+                if latest != version:
+                    break
+                # Nothing changed, keep proxies from closing the connection
+                yield ': keep-alive\n\n'
+            version = latest
+            payload = events.payload(task_id)
+            # Read the job if its state didn't come with the event
+            task = json.loads(payload) if payload else supercut_queue.get(task_id)
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.call_on_close(progress_streams.release)
+    return response
+
+
+@application.route('/status/elasticsearch/')
+def elasticsearch_status():
+    """
+    Connection pool statistics for this worker's Elasticsearch client.
+    """
+    return jsonify(pool_stats())
+
+
+@application.route('/api/search/')
+def search_api():
+    """
+    Search transcripts, image captions and audio descriptions at once and return JSON.
+
+    Parameters: query, size, page, types (comma separated search types, all of them
+    by default) and only ('counts' or 'hits').
+    """
+    query = sanitise_string(request.args.get('query', ''))
+    search_types = tuple(
+        search_type for search_type in request.args.get('types', ','.join(SEARCH_TYPES)).split(',')
+        if search_type in SEARCH_TYPES
+    )
+    only = request.args.get('only')
+    if not query.strip() or not search_types or only not in (None, 'counts', 'hits'):
+        return jsonify({
+            'error': 'A query, valid types and only=counts or only=hits are required',
+        }), 400
+    size = 0 if only == 'counts' else request.args.get('size', type=int, default=20)
+    size = min(max(size, 0), MAX_SEARCH_SIZE)
+    page = max(request.args.get('page', type=int, default=1), 1)
+    try:
+        results = Search().search_all(query, search_types, size, page, only)
+    except elasticsearch.ApiError as exception:
+        print(f'ERROR: {exception}')
+        return jsonify({'error': 'The search failed'}), 502
+    except (elasticsearch.TransportError, FileNotFoundError) as exception:
+        # FileNotFoundError: SEARCH_BACKEND=local and the index hasn't been built
+        print(f'ERROR: {exception}')
+        return jsonify({'error': 'Search is unavailable'}), 503
+    return jsonify({
+        'query': query,
+        'page': page,
+        'size': size,
+        'results': results,
+    })
 
 
-@application.template_filter('average_log_probability_to_percentage')
-def average_log_probability_to_percentage_filter(avg_logprob):
+@application.route('/metrics')
+def metrics():
     """
-    Converts an average log probability into a percentage.
+    Prometheus metrics for requests, Elasticsearch queries, template renders and supercuts.
     """
-    return float_to_percentage_filter(exp(avg_logprob))
+    body, content_type = exposition(SupercutQueueCollector(supercut_queue))
+    return Response(body, content_type=content_type)
 
 
-@application.template_filter('calculate_prediction_counts')
-def calculate_prediction_counts_filter(predictions, score=0.0):
+@application.route('/status/search-cache/')
+def search_cache_status():
     """
-    Calculate the total occurrences of each prediction for this video.
-
-    Returns:
-        A list of touples of format: [(prediction label, count, average confidence)]
+    Search result cache hit and miss counters for this worker.
     """
-    prediction_text = []
-    return_list = []
-    for frame in predictions:
-        if frame.get('predictions'):
-            for prediction in frame.get('predictions'):
-                if prediction['confidence'] > score:
-                    prediction_text.append(prediction['prediction'])
-    most_common = dict(Counter(prediction_text).most_common())
-    for item in most_common.items():
-        scores = []
-        for frame in predictions:
-            if frame.get('predictions'):
-                for prediction in frame.get('predictions'):
-                    if item[0] == prediction['prediction'] and prediction['confidence'] > score:
-                        scores.append(prediction['confidence'])
-        return_list.append((item[0], item[1], round(statistics.mean(scores), 2)))
-    return return_list
-
-
-@application.template_filter('get_common_words_from_text')
-def get_common_words_from_text(text, number=50):
-    """
-    Returns a list of tuples containing the most common word and how many times it appears.
-    """
-    tags = None
-    try:
-        text = str(text)
-        words = [word.lower() for word in text.split(' ')]
-
-        # Remove non-alphabetical characters
-        regex = re.compile('[^a-zA-Z]')
-        words = [regex.sub('', word) for word in words]
+    return jsonify(search_cache.summary())
 
-        # Filter out stopwords
-        words = list(filter(lambda word: word not in STOPWORDS, words))
-        tags = Counter(words).most_common(number)
-    except TypeError:
-        pass
-    return tags
 
-
-def pad_with_leading_zero(number):
+@application.after_request
+def forget_missing_supercut(response):
     """
-    Add leading zeros to a single digit number.
+    Forget a catalogued supercut once its video is requested and turns out to
+    have gone, so the next search makes it again.
     """
-    padded_number = number
-    if len(str(padded_number)) == 1:
-        padded_number = f'0{padded_number}'
-    return padded_number
+    filename = (request.view_args or {}).get('filename', '')
+    if (
+        response.status_code == 404
+        and request.endpoint == 'static'
+        and filename.startswith('videos/')
+        and filename.endswith('.mp4')
+    ):
+        supercut_catalogue.forget(os.path.basename(filename))
+    return response
 
 
 def sanitise_string(input_string):
@@ -291,29 +337,10 @@ def sanitise_string(input_string):
     return sanitized_string
 
 
-@application.template_filter('poster')
-def poster_from_video_filter(video_file):
-    """
-    Returns the poster file name from a video file name.
-    """
-    return video_file.replace('.mp4', '.jpg')
-
-
-@application.template_filter('duration')
-def duration_filter(segment):
-    """
-    Returns the duration of a segment.
-    """
-    if segment.get('start'):
-        start_time = max(float(segment['start']) - 0.5, 0)
-        end_time = float(segment['end']) + 0.5
-        return end_time - start_time
-    return IMAGE_AUDIO_CAPTION_DURATION + 0.5
-
-
 def get_filename(query, page, search_type):
     """
     Returns the filename of a supercut video from a query, page number, and search type.
+    A preview has the same filename as the full supercut that replaces it.
     """
     filename = f'supercut_{slugify(query)}'
     if page and page > 1:
@@ -323,148 +350,65 @@ def get_filename(query, page, search_type):
     return f'{filename}.mp4'
 
 
-def cut_resize_to_temp(job):
+def get_playlist(filename):
     """
-    Worker: (video_path, start, end, fade) → temp-mp4-path
+    Returns the HLS playlist path of a supercut, relative to the static folder.
     """
-    path, start, end, fade = job
-    with VideoFileClip(path) as base:
-        clip = base.subclipped(start, min(end, base.duration))
-        if fade and clip.audio:
-            fade_in = clip.audio.with_effects([AudioFadeIn(0.5)])
-            fade_out = fade_in.with_effects([AudioFadeOut(0.5)])
-            clip = clip.with_audio(fade_out)
-        resized_clip = clip.resized(height=SUPERCUT_RESOLUTION[1])
-        if resized_clip.w > SUPERCUT_RESOLUTION[0]:
-            resized_clip = clip.resized(width=SUPERCUT_RESOLUTION[0])
-        background = ColorClip(
-            size=SUPERCUT_RESOLUTION,
-            color=(0, 0, 0),
-            duration=resized_clip.duration,
-        )
-        padded = CompositeVideoClip([background, resized_clip.with_position('center')])
-        with tempfile.NamedTemporaryFile(suffix='.mp4', delete=False) as temp_file:
-            padded.write_videofile(
-                temp_file.name,
-                codec='libx264',
-                audio_codec='aac',
-                ffmpeg_params=['-ar', '48000', '-ac', '2'],
-                preset='veryfast',
-                threads=multiprocessing.cpu_count(),
-            )
-        return temp_file.name
+    return f'videos/{Path(filename).stem}/{HLS_PLAYLIST}'
 
 
-# pylint: disable=too-many-locals,too-many-statements,too-many-branches
-def generate_supercut_background(query, search_results, task_id, page, search_type):
+def get_stream(task):
     """
-    Build the super-cut in a worker pool, update progress, write poster frame.
+    Returns the HLS playlist of a supercut job once it has a segment to play, or None.
     """
-    filename = get_filename(query, page, search_type)
-    output_path = f'app/static/videos/{filename}'
-    output_dir = os.path.dirname(output_path)
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    clip_jobs = []
-    for hit in search_results['hits']['hits']:
-        path = hit['_source']['web_resource']
-        if search_type == 'audio':
-            for segment in hit['_source']['transcription']['segments']:
-                if query.lower() in segment['text'].lower():
-                    start = max(segment['start'] - 0.5, 0)
-                    end = segment['end'] + 0.5
-                    clip_jobs.append((path, start, end, True))
-        elif search_type == 'image':
-            for segment in hit['_source']['classification']['captions']['huggingface']:
-                for prediction in segment['predictions']:
-                    if query.lower() in prediction['prediction'].lower():
-                        start = max(segment['timestamp'] - 0.5, 0)
-                        end = segment['timestamp'] + IMAGE_AUDIO_CAPTION_DURATION
-                        clip_jobs.append((path, start, end, True))
-        elif search_type == 'audioDescription':
-            for segment in hit['_source']['classification']['captions']['clap']:
-                for prediction in segment['predictions']:
-                    if query.lower() in prediction['prediction'].lower():
-                        start = max(segment['timestamp'] - 0.5, 0)
-                        end = segment['timestamp'] + IMAGE_AUDIO_CAPTION_DURATION
-                        clip_jobs.append((path, start, end, True))
-
-    total_steps = len(clip_jobs) + 2
-    temp_paths = []
-    with ProcessPoolExecutor(max_workers=os.cpu_count()) as pool:
-        for i, tmp in enumerate(pool.map(cut_resize_to_temp, clip_jobs), start=1):
-            try:
-                temp_paths.append(tmp)
-                with lock:
-                    supercut_tasks[task_id]['progress'] = i / total_steps * 100
-            except KeyError:
-                pass
-
-    with lock:
-        supercut_tasks[task_id]['status'] = 'saving'
-        supercut_tasks[task_id]['progress'] = (len(clip_jobs)+1) / total_steps * 100
-
-    clips = [VideoFileClip(temp_path) for temp_path in temp_paths]
-    supercut = concatenate_videoclips(clips, method='compose')
-    supercut.write_videofile(
-        output_path,
-        codec=VIDEO_CODEC,
-        audio_codec='aac',
-        preset=PRESET,
-        threads=THREADS,
-    )
-
-    final_clip = VideoFileClip(output_path)
-    frame = final_clip.get_frame(1.0)
-    img = Image.fromarray(frame.astype('uint8'))
-    if img.mode == 'RGBA':
-        img = img.convert('RGB')
-    img.save(output_path.replace('.mp4', '.jpg'), 'JPEG')
-    final_clip.close()
+    if not SUPERCUT_STREAMING or task['status'] == 'queued':
+        return None
+    playlist = get_playlist(get_filename(task['query'], task['page'], task['search_type']))
+    if os.path.isfile(f'app/static/{playlist}'):
+        return playlist
+    return None
 
-    for file_path in temp_paths:
-        os.remove(file_path)
 
-    with lock:
-        supercut_tasks[task_id]['status'] = 'completed'
-        supercut_tasks[task_id]['progress'] = 100
-        supercut_tasks[task_id]['filename'] = filename
+# Web workers queue jobs and watch them, the supercut worker (app.worker) runs them
+supercut_queue = SupercutQueue()
+progress_streams = threading.BoundedSemaphore(SUPERCUT_MAX_STREAMS)
+search_cache = SearchCache()
+shared_points_in_time = SharedPointsInTime()
+export_writer = ExportWriter()
+supercut_catalogue = SupercutCatalogue()
 
 
+# pylint: disable=too-many-locals,too-many-statements,too-many-branches
+# pylint: disable=too-many-arguments,too-many-positional-arguments
 class Search():
     """
     Elasticsearch interface.
     """
-    def __init__(self):
-        if DEBUG:
-            self.elastic_search = Elasticsearch(
-                ELASTICSEARCH_HOST,
-            )
-        else:
-            self.elastic_search = Elasticsearch(
-                cloud_id=ELASTICSEARCH_CLOUD_ID,
-                api_key=ELASTICSEARCH_API_KEY,
-            )
+    @property
+    def elastic_search(self):
+        """
+        The pooled Elasticsearch client shared by every request in this worker process,
+        or the embedded local index with SEARCH_BACKEND=local.
+        """
+        if SEARCH_BACKEND == 'local':
+            return get_local_index()
+        return get_client()
 
     def search(self, args, resource='videos'):
         """
         Perform a search for a query string in the index (resource).
         """
-        query_body = {}
         search_results = None
         errors = None
         query = args.get('query')
-        field = args.get('field', 'transcription.segments.text')
+        field = args.get('field', SEARCH_FIELDS['audio'])
         size = args.get('size', type=int, default=20)
         page = args.get('page', type=int, default=1)
         search_type = args.get('searchType', 'audio')
-        if search_type == 'image':
-            field = 'classification.captions.huggingface.predictions.prediction'
-        elif search_type == 'audioDescription':
-            field = 'classification.captions.clap.predictions.prediction'
+        if search_type in ('image', 'audioDescription'):
+            field = SEARCH_FIELDS[search_type]
         # Limit search results per page to 50
-        size = min(size, 50)
-        query_body['size'] = size
+        size = min(size, MAX_SEARCH_SIZE)
 
         # Elasticsearch uses `from` to specify page of results
         # e.g. Page 1 = from 0
@@ -472,58 +416,175 @@ class Search():
             page = 0
         else:
             page = (page - 1) * size
-        query_body['from'] = page
 
-        query_body['query'] = {
-            'match_phrase': {
-                field: query,
-            }
-        }
+        # Nested searches only return the matching segments rather than every
+        # segment of every video
+        path = nested_path(field) if ELASTICSEARCH_NESTED else None
+        query_body = search_body(field, query, size, page, path)
+        index = ELASTICSEARCH_INDEX_NAME or resource
+        # Every page is searched in a point in time in the same order, and carries a
+        # cursor so the next one is fetched with search_after rather than by counting hits
+        cursor = decode_cursor(args.get('cursor', ''))
+        pit = cursor.get('pit') if cursor else None
+        # Sort values only mean something in their own point in time
+        position = [cursor['direction'], cursor['after'], pit] if cursor else page
+        key = search_cache.key(index, query, search_type, size, position, field)
+        search_results = search_cache.get(key)
+        if search_results:
+            # Cached pages don't keep the point in time they were searched in, which
+            # may have expired since, so only a cursor's page carries on in its own
+            if pit:
+                search_results = {**search_results, 'pit_id': pit}
+            return search_results, errors
         try:
-            search_results = self.elastic_search.search(
-                index=ELASTICSEARCH_INDEX_NAME or resource,
-                body=query_body,
-            )
-        except elasticsearch.NotFoundError as exception:
+            search_results = self.cursor_search(index, query_body, cursor)
+            if path:
+                search_results = merge_inner_hits(search_results, path)
+            cached = dict(getattr(search_results, 'body', search_results))
+            cached.pop('pit_id', None)
+            search_cache.set(key, cached)
+        except (
+            elasticsearch.ApiError, elasticsearch.TransportError, FileNotFoundError,
+        ) as exception:
+            # FileNotFoundError: SEARCH_BACKEND=local and the index hasn't been built
             print(f'ERROR: {exception}')
             errors = exception
 
         return search_results, errors
 
-    def get_video(self, video_id, resource='videos'):
+    def open_point_in_time(self, index):
         """
-        Get a Video by its ID.
+        Open a point in time on an index for paging through search results.
         """
-        return self.elastic_search.search(
-            index=ELASTICSEARCH_INDEX_NAME or resource,
-            body={'query': {'match_phrase': {'id': video_id}}}
-        )['hits']['hits'][0]
+        with timed(ELASTICSEARCH_SECONDS, request_timings(), 'elasticsearch', operation='pit'):
+            response = self.elastic_search.open_point_in_time(
+                index=index,
+                keep_alive=ELASTICSEARCH_PIT_KEEP_ALIVE,
+            )
+        return response['id']
 
-    def index(self, resource, json_data):
+    def cursor_search(self, index, query_body, cursor):
         """
-        Update the search index for a single record.
+        Fetch a page in a point in time: the page after or before a cursor, or
+        without one the page at the body's `from` in this worker's shared point
+        in time. A cursor's sort values only mean something in its own point
+        in time, so if that has expired the page is fetched by its number instead.
         """
-        success = False
+        pit = cursor.get('pit') if cursor else None
+        if pit:
+            try:
+                search_results = self.point_in_time_search(query_body, cursor, pit)
+                if cursor['direction'] == 'previous':
+                    # Fetched in reverse order from the first hit of the page after
+                    search_results['hits']['hits'].reverse()
+                return search_results
+            except elasticsearch.NotFoundError:
+                shared_points_in_time.replace(pit, None)
+                self.close_point_in_time(pit)
+        pit = shared_points_in_time.get(self.elastic_search, index, self.open_point_in_time)
+        try:
+            return self.point_in_time_search(query_body, None, pit)
+        except elasticsearch.NotFoundError:
+            # The shared point in time has gone, e.g. with its index
+            shared_points_in_time.replace(pit, None)
+            pit = shared_points_in_time.get(self.elastic_search, index, self.open_point_in_time)
+            return self.point_in_time_search(query_body, None, pit)
+
+    def point_in_time_search(self, query_body, cursor, pit):
+        """
+        Search for a page in a point in time, closing the point in time if
+        Elasticsearch replaces it with a new one.
+        """
+        with timed(ELASTICSEARCH_SECONDS, request_timings(), 'elasticsearch', operation='search'):
+            search_results = self.elastic_search.search(body=cursor_body(query_body, cursor, pit))
+        observe_response_size('search', search_results)
+        if search_results.get('pit_id') not in (None, pit):
+            shared_points_in_time.replace(pit, search_results['pit_id'])
+            self.close_point_in_time(pit)
+        return search_results
+
+    def close_point_in_time(self, pit):
+        """
+        Close a point in time that's been replaced, rather than leave it open until it expires.
+        """
+        try:
+            with timed(ELASTICSEARCH_SECONDS, request_timings(), 'elasticsearch', operation='pit'):
+                self.elastic_search.close_point_in_time(id=pit)
+        except (elasticsearch.ApiError, elasticsearch.TransportError):
+            # It's already gone, or it'll expire by itself
+            pass
+
+    def search_all(self, query, search_types=SEARCH_TYPES, size=20, page=1, only=None,
+                   resource='videos'):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        """
+        Search every search type in a single multi-search round trip.
+        `only` may be 'counts' for just the number of matching videos, or 'hits'
+        for just the top hits without counting every match.
 
-        # Handle tags
-        tags_dictionary = {}
-        for tag in json_data.get('tags') or []:
-            tags_dictionary[tag[0]] = tag[1]
-        json_data['tags'] = json.dumps(tags_dictionary)
+        Returns compact results without the full _source, e.g.
+        {'audio': {'total': 3, 'hits': [{'id': 1, 'title': ..., 'segments': [...]}]}, ...}
+        """
+        size = 0 if only == 'counts' else min(max(size, 0), MAX_SEARCH_SIZE)
+        offset = (max(page, 1) - 1) * size
+        index = ELASTICSEARCH_INDEX_NAME or resource
+        key = search_cache.key(
+            index, query, f'all:{",".join(search_types)}', size, offset, only or 'all',
+        )
+        results = search_cache.get(key)
+        if results:
+            return results
+        searches = msearch_searches(
+            index, query, search_types, size, offset,
+            nested=ELASTICSEARCH_NESTED, counts=only != 'hits',
+        )
+        with timed(ELASTICSEARCH_SECONDS, request_timings(), 'elasticsearch', operation='msearch'):
+            response = self.elastic_search.msearch(searches=searches)
+        observe_response_size('msearch', response)
+        results = {}
+        for search_type, search_results in zip(search_types, response['responses']):
+            if 'error' in search_results:
+                error = search_results['error']
+                results[search_type] = {'error': error.get('reason') or error.get('type')}
+                continue
+            if ELASTICSEARCH_NESTED:
+                search_results = merge_inner_hits(search_results, nested_path(
+                    SEARCH_FIELDS[search_type],
+                ))
+            results[search_type] = {}
+            if only != 'hits':
+                results[search_type]['total'] = search_results['hits']['total']['value']
+            if only != 'counts':
+                results[search_type]['hits'] = [
+                    compact_hit(hit, search_type, query, nested=ELASTICSEARCH_NESTED)
+                    for hit in search_results['hits']['hits']
+                ]
+        search_cache.set(key, results)
+        return results
 
-        if REMOVE_QUERY_PARAMS:
-            # Remove the query params from resource URLs if they're in a public S3 bucket
-            if json_data.get('resource'):
-                json_data['resource'] = json_data['resource'].split('?')[0]
-            if json_data.get('web_resource'):
-                json_data['web_resource'] = json_data['web_resource'].split('?')[0]
-            if json_data.get('subtitles'):
-                json_data['subtitles'] = json_data['subtitles'].split('?')[0]
-            if json_data.get('subtitles_vtt'):
-                json_data['subtitles_vtt'] = json_data['subtitles_vtt'].split('?')[0]
-            if json_data.get('snapshot'):
-                json_data['snapshot'] = json_data['snapshot'].split('?')[0]
+    def get_video(self, video_id, resource='videos'):
+        """
+        Get a Video by its ID.
+        """
+        with timed(ELASTICSEARCH_SECONDS, request_timings(), 'elasticsearch', operation='get'):
+            response = self.elastic_search.search(
+                index=ELASTICSEARCH_INDEX_NAME or resource,
+                body={'query': {'match_phrase': {'id': video_id}}}
+            )
+        observe_response_size('get', response)
+        return response['hits']['hits'][0]
 
+    def index(self, resource, json_data, invalidate=True):
+        """
+        Update the search index for a single record. Callers indexing many records
+        can pass invalidate=False and invalidate the search cache once at the end.
+        """
+        if SEARCH_BACKEND == 'local':
+            raise RuntimeError(
+                'The local search index is read-only, rebuild it from the exported video JSON '
+                'with index_all or python -m app.local_search',
+            )
+        success = False
+        json_data = self.prepare_document(json_data)
         if EXPORT_VIDEO_JSON:
             self.export_video_json(json_data)
 
@@ -534,6 +595,8 @@ class Search():
                 body=json_data,
             )
             success = True
+            if invalidate:
+                search_cache.invalidate()
             return success
         except (
             elasticsearch.exceptions.RequestError,
@@ -543,92 +606,172 @@ class Search():
             print(f'ERROR indexing {json_data.get("id")}: {exception}')
             return success
 
-    def index_all(self, resource='videos'):
+    def prepare_document(self, json_data):
+        """
+        Convert an XOS asset into the document we store in the search index.
+        """
+        # Handle tags
+        tags_dictionary = {}
+        for tag in json_data.get('tags') or []:
+            tags_dictionary[tag[0]] = tag[1]
+        json_data['tags'] = json.dumps(tags_dictionary)
+
+        # Summarise the predictions once here rather than on every detail page view
+        json_data['summaries'] = summarise_document(json_data)
+
+        if REMOVE_QUERY_PARAMS:
+            # Remove the query params from resource URLs if they're in a public S3 bucket
+            for field in URL_FIELDS:
+                if json_data.get(field):
+                    json_data[field] = json_data[field].split('?')[0]
+
+        return json_data
+
+    def index_all(
+        self,
+        resource='videos',
+        chunk_size=INDEX_CHUNK_SIZE,
+        threads=INDEX_THREADS,
+        full=False,
+        build=False,
+    ):  # pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-locals
         """
         Index all of the objects for this resource.
+
+        XOS pages are prefetched concurrently and the documents are streamed
+        to Elasticsearch in bulk requests of `chunk_size` across `threads`.
+
+        Unless `full` is set only assets modified since the last successful
+        sync are requested, unchanged documents are skipped by content hash,
+        and documents for assets that have disappeared are deleted.
+
+        With `build` set everything is loaded into a new timestamped index
+        which replaces the live one with an atomic alias swap once it's ready,
+        so searches never see a half populated index.
+
+        With SEARCH_BACKEND=local the local index is rebuilt from the exported
+        video JSON instead.
         """
+        if SEARCH_BACKEND == 'local':
+            stats = rebuild_local_index()
+            search_cache.invalidate()
+            print(
+                f'Built the local search index: {stats["documents"]} videos '
+                f'in {stats["seconds"]}s',
+            )
+            return stats
         client = XOSAPI()
-        failed = []
-
-        next_page = True
-        page = 1
         api = None
+        alias = ELASTICSEARCH_INDEX_NAME or resource
+        index = alias
+        started = datetime.now(timezone.utc).isoformat()
+        state = load_state(alias, client=self.elastic_search)
+        hashes = {} if build else dict(state['hashes'])
+        incremental = not (full or build) and state['last_sync']
+        skipped = []
+        seen = set()
 
         if resource == 'videos':
             api = 'assets'
-
-        while next_page:
+        if build:
+            index = versioned_index_name(alias)
+            print(f'Building {index}')
+            create_build_index(self.elastic_search, index)
+        elif resource == 'videos' and ELASTICSEARCH_NESTED:
+            ensure_index(self.elastic_search, index)
+
+        def get_page(page):
             print(f'Starting page {page}')
             params = {
                 'page': page,
-                'page_size': 100,
+                'page_size': XOS_PAGE_SIZE,
             }
-            response = client.get(resource=api, params=params).json()
-            for result in response['results']:
-                if result['transcription'] or result['classification']:
-                    if not self.index(resource, result):
-                        failed.append(result['id'])
-            page += 1
-            next_page = response['next']
-        if failed:
-            print(f'Finished. Failed {len(failed)}: {failed}')
-
-    def export_video_json(self, json_data):
+            if incremental:
+                params[XOS_MODIFIED_SINCE_PARAM] = state['last_sync']
+            return client.get(resource=api, params=params).json()
+
+        def get_id_page(page):
+            return client.get(
+                resource=api,
+                params={'page': page, 'page_size': XOS_ID_PAGE_SIZE, 'fields': 'id'},
+            ).json()
+
+        def documents():
+            for response in fetch_pages(get_page):
+                for result in response['results']:
+                    seen.add(str(result['id']))
+                    yield self.prepare_document(result)
+
+        def removed():
+            if incremental:
+                # Only changed assets were listed, so ask XOS which ids still exist
+                current = {
+                    str(result['id'])
+                    for response in fetch_pages(get_id_page)
+                    for result in response['results']
+                }
+            else:
+                current = seen
+            return [document_id for document_id in list(hashes) if document_id not in current]
+
+        def actions():
+            for action in sync_actions(index, documents(), hashes, full=full, skipped=skipped):
+                yield export_writer.export_action(action) if EXPORT_VIDEO_JSON else action
+            for action in delete_actions(index, removed(), hashes):
+                yield export_writer.export_action(action) if EXPORT_VIDEO_JSON else action
+
+        stats = bulk_index(self.elastic_search, actions(), chunk_size=chunk_size, threads=threads)
+        if EXPORT_VIDEO_JSON:
+            export_writer.compact()
+        stats['skipped'] = len(skipped)
+        if stats['indexed'] or stats['deleted']:
+            search_cache.invalidate()
+        for document_id in map(str, stats['failed']):
+            # Retry failed documents next time, a failed delete keeps its old hash
+            # so the asset is still a candidate for deletion
+            if document_id in hashes:
+                del hashes[document_id]
+            elif document_id in state['hashes']:
+                hashes[document_id] = state['hashes'][document_id]
+        if build:
+            if len(stats['failed']) > INDEX_BUILD_MAX_FAILURES:
+                print(f'Not publishing {index}, {len(stats["failed"])} documents failed')
+                return stats
+            self.publish_index(alias, index)
+        save_state(alias, {
+            'last_sync': state['last_sync'] if stats['failed'] else started,
+            'hashes': hashes,
+        }, client=self.elastic_search)
+        print(
+            f'Finished. Indexed {stats["indexed"]}, skipped {stats["skipped"]} unchanged, '
+            f'deleted {stats["deleted"]} in {stats["seconds"]}s '
+            f'({stats["docs_per_second"]} docs/sec)',
+        )
+        print(
+            f'XOS pages: {client.stats["downloaded"]} downloaded, '
+            f'{client.stats["not_modified"]} not modified, {client.stats["cached"]} cached, '
+            f'{client.stats["retries"]} retries',
+        )
+        if stats['failed']:
+            print(f'Failed {len(stats["failed"])}: {stats["failed"]}')
+        return stats
+
+    def publish_index(self, alias, index):
         """
-        Save the json_data to the file system using the filename as the title.
+        Make a freshly built index live: merge it, restore its settings,
+        move the alias over to it and prune old versions.
         """
-        Path('app/static/json').mkdir(exist_ok=True)
-        title = json_data.get('title') or json_data.get('id')
-        with open(f'app/static/json/{title}.json', 'w', encoding='utf-8') as video_file:
-            json.dump(json_data, video_file, ensure_ascii=False, indent=4)
+        finalise_build_index(self.elastic_search, index)
+        swap_alias(self.elastic_search, alias, index)
+        search_cache.invalidate()
+        removed = prune_indices(self.elastic_search, alias)
+        print(f'{alias} now points to {index}, removed old indices: {removed}')
 
-
-class XOSAPI():  # pylint: disable=too-few-public-methods
-    """
-    XOS private API interface.
-    """
-    def __init__(self):
-        self.uri = XOS_API_ENDPOINT
-        self.headers = {
-            'Content-Type': 'application/json',
-        }
-        self.params = {
-            'page_size': 10,
-        }
-
-    def get(self, resource, params=None):
+    def export_video_json(self, json_data, encoded=None):
         """
-        Returns JSON for this resource.
+        Queue the json_data to be saved to the file system by the export writer's thread.
         """
-        endpoint = os.path.join(self.uri, f'{resource}/')
-        if not params:
-            params = self.params.copy()
-        if XOS_API_TOKEN:
-            self.headers['Authorization'] = f'Token {XOS_API_TOKEN}'
-        retries = 0
-        while retries < XOS_RETRIES:
-            try:
-                response = requests.get(
-                    url=endpoint,
-                    headers=self.headers,
-                    params=params,
-                    timeout=XOS_TIMEOUT,
-                )
-                response.raise_for_status()
-                return response
-            except (
-                requests.exceptions.HTTPError,
-                requests.exceptions.ConnectionError,
-                requests.exceptions.ReadTimeout,
-            ) as exception:
-                print(
-                    f'ERROR: couldn\'t get {endpoint} with params: {params}, '
-                    f'exception: {exception}... retrying',
-                )
-                retries += 1
-                if retries == XOS_RETRIES:
-                    raise exception
-        return None
+        export_writer.write(json_data, encoded)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,333 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+
+from moviepy import VideoFileClip
+from PIL import Image
+from werkzeug.datastructures import MultiDict
+
+from app.catalogue import SupercutCatalogue
+from app.clip_cache import ClipCache
+from app.filters import IMAGE_AUDIO_CAPTION_DURATION
+from app.jobs import SupercutQueue
+from app.media import MediaCache
+from app.metrics import (SUPERCUT_CLIPS, SUPERCUT_ENCODE_SPEED,
+                         SUPERCUT_JOB_SECONDS, SUPERCUT_POOL_BUSY,
+                         SUPERCUT_POOL_THREADS, SUPERCUT_STAGE_SECONDS,
+                         Timings, log_event, timed)
+from app.supercut import (SUPERCUT_PREVIEW_PROFILE, SUPERCUT_PROFILE,
+                          SUPERCUT_STREAMING, HLSPlaylist, choose_profile,
+                          concat_segments, encode_profile, encode_segment,
+                          encoder_settings, group_windows, preview_clips,
+                          probe)
+from app.video import Search, get_filename, get_playlist
+
+clip_cache = ClipCache()
+media_cache = MediaCache()
+supercut_catalogue = SupercutCatalogue()
+
+
+def cut_source_to_cache(job):  # pylint: disable=too-many-locals
+    """
+    Worker: (video_path, [(start, end), ...], fade, threads, profile, timings)
+    → [cached-mp4-path, ...]
+
+    Each source video is fetched and probed once, then all of its windows are
+    cut in timestamp order with the encode `profile`. Segments already encoded
+    for another supercut are reused from the clip cache.
+    """
+    path, windows, fade, threads, profile, timings = job
+    settings = encoder_settings(
+        codec=profile['codec'],
+        preset=profile['preset'],
+        crf=profile['crf'],
+        resolution=profile['resolution'],
+        fps=profile['fps'],
+    )
+    source = None
+    info = None
+    clip_paths = []
+    with SUPERCUT_POOL_BUSY.track_inprogress():
+        for start, end in windows:
+            key = clip_cache.key(path, start, end, fade, settings)
+            cached_path = clip_cache.get(key)
+            if cached_path:
+                SUPERCUT_CLIPS.labels(cache='hit').inc()
+                clip_paths.append(cached_path)
+                continue
+            SUPERCUT_CLIPS.labels(cache='miss').inc()
+            if source is None:
+                with timed(SUPERCUT_STAGE_SECONDS, timings, 'fetch', stage='fetch'):
+                    source = media_cache.resolve(path)
+                    info = probe(source)
+            temp_path = clip_cache.temp_path()
+            started = time.perf_counter()
+            try:
+                with timed(SUPERCUT_STAGE_SECONDS, timings, 'encode', stage='encode'):
+                    encode_segment(
+                        source,
+                        start,
+                        end,
+                        temp_path,
+                        fade=fade,
+                        threads=threads,
+                        codec=profile['codec'],
+                        preset=profile['preset'],
+                        info=info,
+                        crf=profile['crf'],
+                        resolution=profile['resolution'],
+                        fps=profile['fps'],
+                    )
+            except Exception:
+                # The encoder may have cleaned up its output already, keep its error
+                with suppress(FileNotFoundError):
+                    os.remove(temp_path)
+                raise
+            # Seconds of video encoded per second, e.g. 4.0 is four times faster than real time
+            media_seconds = min(end, info['duration'] or end) - start
+            SUPERCUT_ENCODE_SPEED.labels(profile=profile['name'], codec=profile['codec']).observe(
+                media_seconds / max(time.perf_counter() - started, 1e-6),
+            )
+            if timings is not None:
+                timings.add('encoded_media', media_seconds)
+            clip_paths.append(clip_cache.commit(key, temp_path))
+    return clip_paths
+
+
+def run_supercut_job(job, cpus):
+    """
+    Supercut queue runner: repeat the job's search and build its supercut using `cpus` CPUs.
+    A faster encode profile is used while the queue is busy, unless the job names one.
+    Logs how long each stage took once the job has finished.
+    """
+    args = MultiDict({
+        'query': job['query'],
+        'page': job['page'],
+        'size': job['size'],
+        'searchType': job['search_type'],
+    })
+    if job.get('cursor'):
+        # The same page the user saw, from the same point in time while it's open
+        args['cursor'] = job['cursor']
+    timings = Timings()
+    preview = bool(job.get('preview'))
+    if preview:
+        profile = encode_profile(SUPERCUT_PREVIEW_PROFILE)
+    else:
+        profile = encode_profile(
+            job.get('profile') or choose_profile(supercut_queue.counts().get('queued', 0)),
+        )
+    status = 'failed'
+    try:
+        with timed(SUPERCUT_STAGE_SECONDS, timings, 'search', stage='search'):
+            results, _ = Search().search(args)
+        filename = generate_supercut_background(
+            job['query'],
+            results,
+            job['id'],
+            job['page'],
+            job['search_type'],
+            cpus=cpus,
+            timings=timings,
+            profile=profile,
+            preview=preview,
+        )
+        status = 'completed' if filename else 'no_clips'
+    finally:
+        seconds = timings.elapsed()
+        SUPERCUT_JOB_SECONDS.labels(status=status).observe(seconds)
+        summary = timings.summary()
+        if summary.get('encode_seconds'):
+            summary['encode_speed'] = round(
+                summary['encoded_media_seconds'] / summary['encode_seconds'], 2,
+            )
+        log_event(
+            'supercut',
+            id=job['id'],
+            query=job['query'],
+            page=job['page'],
+            search_type=job['search_type'],
+            preview=preview,
+            status=status,
+            cpus=cpus,
+            profile=profile['name'],
+            codec=profile['codec'],
+            seconds=round(seconds, 4),
+            **summary,
+        )
+
+
+# pylint: disable=too-many-locals,too-many-statements,too-many-branches
+# pylint: disable=too-many-arguments,too-many-positional-arguments
+def find_clips(query, search_results, search_type):
+    """
+    Returns the (path, start, end, score) of every segment matching the query
+    in the search results, where score is the score of the segment's video.
+    """
+    clips = []
+    for hit in search_results['hits']['hits']:
+        path = hit['_source']['web_resource']
+        score = hit.get('_score') or 0
+        if search_type == 'audio':
+            for segment in hit['_source']['transcription']['segments']:
+                if query.lower() in segment['text'].lower():
+                    start = max(segment['start'] - 0.5, 0)
+                    end = segment['end'] + 0.5
+                    clips.append((path, start, end, score))
+        elif search_type == 'image':
+            for segment in hit['_source']['classification']['captions']['huggingface']:
+                for prediction in segment['predictions']:
+                    if query.lower() in prediction['prediction'].lower():
+                        start = max(segment['timestamp'] - 0.5, 0)
+                        end = segment['timestamp'] + IMAGE_AUDIO_CAPTION_DURATION
+                        clips.append((path, start, end, score))
+        elif search_type == 'audioDescription':
+            for segment in hit['_source']['classification']['captions']['clap']:
+                for prediction in segment['predictions']:
+                    if query.lower() in prediction['prediction'].lower():
+                        start = max(segment['timestamp'] - 0.5, 0)
+                        end = segment['timestamp'] + IMAGE_AUDIO_CAPTION_DURATION
+                        clips.append((path, start, end, score))
+    return clips
+
+
+def credit_clips(sources, search_results):
+    """
+    Returns the credit for each clip in the order the supercut plays them, from
+    the (path, [(start, end), ...]) windows actually encoded, e.g.
+    [{'source': 'https://example.com/video.mp4', 'start': 9.5, 'end': 14.5,
+      'work': {'id': 1, 'slug': 'elephants', 'title': 'Elephants'}}, ...]
+    """
+    works = {}
+    for hit in search_results['hits']['hits']:
+        work = (hit['_source'].get('works') or [None])[0]
+        works.setdefault(hit['_source']['web_resource'], work and {
+            'id': work.get('id'), 'slug': work.get('slug'), 'title': work.get('title'),
+        })
+    return [
+        {'source': path, 'start': start, 'end': end, 'work': works.get(path)}
+        for path, windows in sources
+        for start, end in windows
+    ]
+
+
+def generate_supercut_background(
+    query, search_results, task_id, page, search_type, cpus=None, timings=None, profile=None,
+    preview=False,
+):
+    """
+    Build the super-cut in a worker pool, update progress, write poster frame.
+    Clips are grouped by source video and up to `cpus` videos are cut at once,
+    or the encode profile's thread budget if that's smaller.
+    A `preview` only has the highest scoring clips, and is saved under the same
+    name as the full supercut so that replaces it. It isn't made once the full
+    supercut exists.
+    The clips it plays are recorded with the job and catalogue entry for its credits.
+    The time spent in each stage is added to `timings`.
+    Returns the supercut's filename, or None if nothing matched.
+    """
+    profile = profile or encode_profile(SUPERCUT_PREVIEW_PROFILE if preview else SUPERCUT_PROFILE)
+    cpus = cpus or supercut_queue.cpus_per_job
+    if profile['threads']:
+        cpus = min(cpus, profile['threads'])
+    filename = get_filename(query, page, search_type)
+    if preview:
+        entry = supercut_catalogue.get(filename)
+        if entry and not entry['preview']:
+            # The full supercut was made first, so there's nothing to preview
+            supercut_queue.update(
+                task_id, status='completed', progress=100, filename=filename,
+                clips=None if entry['clips'] is None else json.dumps(entry['clips']),
+            )
+            return filename
+    output_path = f'app/static/videos/{filename}'
+    output_dir = os.path.dirname(output_path)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    clips = find_clips(query, search_results, search_type)
+    if preview:
+        clip_jobs = preview_clips(clips)
+    else:
+        clip_jobs = [(path, start, end) for path, start, end, _ in clips]
+
+    if not clip_jobs:
+        supercut_queue.update(task_id, status='completed', progress=100)
+        return None
+
+    # Open each video once and merge overlapping windows into continuous clips
+    sources = group_windows(clip_jobs)
+    clip_count = sum(len(windows) for _, windows in sources)
+    threads = max(1, cpus // min(cpus, len(sources)))
+    source_jobs = [(path, windows, True, threads, profile, timings) for path, windows in sources]
+    total_steps = clip_count + 2
+    clip_paths = []
+    playlist = None
+    if SUPERCUT_STREAMING:
+        playlist = HLSPlaylist(
+            os.path.dirname(f'app/static/{get_playlist(filename)}'),
+            max(end - start for _, windows in sources for start, end in windows),
+        )
+    # The encoding happens in ffmpeg subprocesses so threads are enough here
+    SUPERCUT_POOL_THREADS.inc(cpus)
+    try:
+        with ThreadPoolExecutor(max_workers=cpus) as pool:
+            for source_clip_paths in pool.map(cut_source_to_cache, source_jobs):
+                clip_paths.extend(source_clip_paths)
+                if playlist:
+                    for clip_path in source_clip_paths:
+                        playlist.append(clip_path)
+                supercut_queue.update(task_id, progress=len(clip_paths) / total_steps * 100)
+    finally:
+        SUPERCUT_POOL_THREADS.dec(cpus)
+    if playlist:
+        playlist.close()
+
+    supercut_queue.update(
+        task_id,
+        status='saving',
+        progress=(clip_count+1) / total_steps * 100,
+    )
+
+    # Segments share identical encoding parameters, so join them without re-encoding
+    with timed(SUPERCUT_STAGE_SECONDS, timings, 'concat', stage='concat'):
+        concat_segments(clip_paths, output_path)
+
+    with timed(SUPERCUT_STAGE_SECONDS, timings, 'poster', stage='poster'):
+        final_clip = VideoFileClip(output_path)
+        frame = final_clip.get_frame(1.0)
+        img = Image.fromarray(frame.astype('uint8'))
+        if img.mode == 'RGBA':
+            img = img.convert('RGB')
+        img.save(output_path.replace('.mp4', '.jpg'), 'JPEG')
+        final_clip.close()
+
+    credited = credit_clips(sources, search_results)
+    supercut_catalogue.add(
+        query, page, search_type, filename, profile=profile['name'], clips=credited,
+        preview=preview,
+    )
+    supercut_queue.update(
+        task_id, status='completed', progress=100, filename=filename, clips=json.dumps(credited),
+    )
+    return filename
+
+
+# The queue this process runs jobs from, web workers only submit and watch them
+supercut_queue = SupercutQueue(runner=run_supercut_job)
+
+
+def main():
+    """
+    Run supercut jobs until stopped, starting with any left queued or running
+    before a restart, and picking up new ones as soon as they're queued.
+
+    Usage: python -m app.worker
+    """
+    print('Starting the supercut worker...')
+    supercut_queue.run()
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,271 @@
+import gzip
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from app.indexing import XOS_PREFETCH_THREADS
+from app.metrics import XOS_REQUESTS
+
+XOS_API_ENDPOINT = os.getenv('XOS_API_ENDPOINT', None)
+XOS_API_TOKEN = os.getenv('XOS_API_TOKEN', None)
+XOS_RETRIES = int(os.getenv('XOS_RETRIES', '3'))
+XOS_TIMEOUT = int(os.getenv('XOS_TIMEOUT', '60'))
+# Retries wait a random time up to XOS_BACKOFF_SECONDS, doubling each attempt
+# up to XOS_BACKOFF_MAX_SECONDS
+XOS_BACKOFF_SECONDS = float(os.getenv('XOS_BACKOFF_SECONDS', '1'))
+XOS_BACKOFF_MAX_SECONDS = float(os.getenv('XOS_BACKOFF_MAX_SECONDS', '30'))
+# Keep API responses here and revalidate them with ETag and If-Modified-Since,
+# blank to turn the cache off
+XOS_CACHE_DIR = os.getenv('XOS_CACHE_DIR', '')
+# Serve cached responses younger than this without asking XOS at all,
+# e.g. to resume an interrupted reindex, 0 to always revalidate
+XOS_CACHE_TTL = float(os.getenv('XOS_CACHE_TTL', '0'))
+
+# Status codes worth retrying, anything else is raised straight away
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+
+def backoff_seconds(attempt, base=XOS_BACKOFF_SECONDS, maximum=XOS_BACKOFF_MAX_SECONDS):
+    """
+    Returns how long to wait before retry number `attempt`: a random time up to
+    an exponentially growing cap, so many workers don't retry in lockstep.
+    """
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+def retry_after_seconds(response):
+    """
+    Returns the seconds a response's Retry-After header asks us to wait, or None.
+    """
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class ResponseCache():
+    """
+    XOS API responses on disk, gzipped, with the validators to ask XOS
+    whether they've changed. Files are written atomically so an interrupted
+    run never leaves a half written response behind.
+    """
+    def __init__(self, directory=XOS_CACHE_DIR, ttl=XOS_CACHE_TTL):
+        self.directory = directory
+        self.ttl = ttl
+
+    def key(self, url, params):
+        """
+        Returns the cache key for a request.
+        """
+        identity = json.dumps([url, sorted((params or {}).items())], default=str)
+        return hashlib.sha256(identity.encode('utf-8')).hexdigest()
+
+    def path(self, key, extension):
+        """
+        Returns the path of one of a cached response's files.
+        """
+        return os.path.join(self.directory, key[:2], f'{key}.{extension}')
+
+    def get(self, key):
+        """
+        Returns a cached response's metadata, e.g. its ETag, or None.
+        """
+        try:
+            with open(self.path(key, 'meta.json'), encoding='utf-8') as meta_file:
+                return json.load(meta_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def fresh(self, meta):
+        """
+        Whether a cached response can be used without revalidating it.
+        """
+        return bool(self.ttl) and time.time() - meta['stored'] < self.ttl
+
+    def content(self, key):
+        """
+        Returns a cached response's body, or None if it's gone.
+        """
+        try:
+            with gzip.open(self.path(key, 'body.gz'), 'rb') as body_file:
+                return body_file.read()
+        except (FileNotFoundError, EOFError, OSError):
+            return None
+
+    def set(self, key, response):
+        """
+        Store a response with its ETag and Last-Modified headers.
+        """
+        body_path = self.path(key, 'body.gz')
+        os.makedirs(os.path.dirname(body_path), exist_ok=True)
+        self.write(body_path, gzip.compress(response.content, compresslevel=5))
+        meta = {
+            'url': response.url,
+            'stored': time.time(),
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'content_type': response.headers.get('Content-Type'),
+        }
+        self.write(self.path(key, 'meta.json'), json.dumps(meta).encode('utf-8'))
+
+    def touch(self, key, meta):
+        """
+        Note that XOS confirmed a cached response is still current.
+        """
+        meta = {**meta, 'stored': time.time()}
+        self.write(self.path(key, 'meta.json'), json.dumps(meta).encode('utf-8'))
+
+    @staticmethod
+    def write(path, data):
+        """
+        Write a file atomically via a temporary file and a rename.
+        """
+        temporary = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temporary, 'wb') as temporary_file:
+            temporary_file.write(data)
+        os.replace(temporary, path)
+
+
+def cached_response(meta, content):
+    """
+    Build a response from a cached body, as if XOS had just sent it.
+    """
+    response = requests.Response()
+    response.status_code = 200
+    response._content = content  # pylint: disable=protected-access
+    response.url = meta['url']
+    response.encoding = 'utf-8'
+    response.headers = CaseInsensitiveDict({'Content-Type': meta.get('content_type') or ''})
+    response.from_cache = True
+    return response
+
+
+class XOSAPI():
+    """
+    XOS private API interface.
+
+    Requests share a pooled, gzip-enabled session, failures are retried with
+    exponential backoff and jitter, and with XOS_CACHE_DIR set responses are
+    cached on disk and revalidated with conditional requests, so a repeated
+    or interrupted reindex doesn't download unchanged pages again.
+    """
+    def __init__(self, cache=None):
+        self.uri = XOS_API_ENDPOINT
+        self.headers = {
+            'Content-Type': 'application/json',
+            'Accept-Encoding': 'gzip, deflate',
+        }
+        if XOS_API_TOKEN:
+            self.headers['Authorization'] = f'Token {XOS_API_TOKEN}'
+        self.params = {
+            'page_size': 10,
+        }
+        self.cache = cache or (ResponseCache() if XOS_CACHE_DIR else None)
+        self.stats = {'downloaded': 0, 'not_modified': 0, 'cached': 0, 'retries': 0}
+        self._session = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        """
+        A pooled HTTP session sized for the prefetch threads, created on first use
+        in each process.
+        """
+        with self._lock:
+            if self._session is None or self._session[0] != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_maxsize=max(XOS_PREFETCH_THREADS, 1) * 2)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.headers.update(self.headers)
+                self._session = (os.getpid(), session)
+            return self._session[1]
+
+    def count(self, stat):
+        """
+        Add one to a request statistic and its metric.
+        """
+        with self._lock:
+            self.stats[stat] += 1
+        XOS_REQUESTS.labels(result=stat).inc()
+
+    def get(self, resource, params=None):
+        """
+        Returns the response for this resource, from the cache if XOS says it hasn't changed.
+        """
+        endpoint = os.path.join(self.uri, f'{resource}/')
+        if not params:
+            params = self.params.copy()
+        key = self.cache.key(endpoint, params) if self.cache else None
+        meta = self.cache.get(key) if self.cache else None
+        content = self.cache.content(key) if meta else None
+        if content is not None and self.cache.fresh(meta):
+            self.count('cached')
+            return cached_response(meta, content)
+
+        headers = {}
+        if content is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        response = self.request(endpoint, params, headers)
+        if response.status_code == 304 and content is not None:
+            self.count('not_modified')
+            self.cache.touch(key, meta)
+            return cached_response(meta, content)
+        self.count('downloaded')
+        if self.cache:
+            self.cache.set(key, response)
+        return response
+
+    def request(self, endpoint, params, headers):
+        """
+        GET an endpoint, retrying connection errors, timeouts and busy or
+        failing servers with exponential backoff.
+        """
+        attempt = 0
+        while True:
+            response = None
+            try:
+                response = self.session.get(
+                    url=endpoint,
+                    headers=headers,
+                    params=params,
+                    timeout=XOS_TIMEOUT,
+                )
+                response.raise_for_status()
+                return response
+            except (
+                requests.exceptions.HTTPError,
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+            ) as exception:
+                status = response.status_code if response is not None else None
+                attempt += 1
+                if attempt >= XOS_RETRIES or (status and status not in RETRY_STATUSES):
+                    raise exception
+                wait = retry_after_seconds(response)
+                if wait is None:
+                    wait = backoff_seconds(
+                        attempt - 1, XOS_BACKOFF_SECONDS, XOS_BACKOFF_MAX_SECONDS,
+                    )
+                print(
+                    f'ERROR: couldn\'t get {endpoint} with params: {params}, '
+                    f'exception: {exception}... retrying in {wait:.1f}s',
+                )
+                self.count('retries')
+                time.sleep(min(wait, XOS_BACKOFF_MAX_SECONDS))
@@ -0,0 +1,129 @@
+import random
+
+WORDS = [
+    'the', 'a', 'large', 'small', 'elephants', 'frog', 'water', 'music', 'city', 'night',
+    'camera', 'film', 'light', 'train', 'street', 'people', 'dance', 'river', 'forest', 'car',
+    'television', 'studio', 'broadcast', 'news', 'children', 'beach', 'sunset', 'bird', 'dog',
+    'crowd', 'stage', 'guitar', 'rain', 'window', 'kitchen', 'garden', 'bridge', 'boat',
+]
+PHRASE = 'large elephants'
+
+
+def sentence(generator, length):
+    """
+    A random sentence of `length` words from the vocabulary.
+    """
+    return ' '.join(generator.choice(WORDS) for _ in range(length))
+
+
+def transcript_segments(generator, count, seconds_per_segment=4, phrase_every=50):
+    """
+    Transcription segments in Whisper's format, with PHRASE in every `phrase_every`th one.
+    """
+    segments = []
+    for number in range(count):
+        text = sentence(generator, 10)
+        if phrase_every and number % phrase_every == 0:
+            text = f'{text} {PHRASE}'
+        segments.append({
+            'start': number * seconds_per_segment,
+            'end': number * seconds_per_segment + seconds_per_segment - 0.5,
+            'text': text,
+            'avg_logprob': -generator.random(),
+        })
+    return segments
+
+
+def prediction_frames(generator, seconds, labels, per_frame, frames_per_second=1, minimum=0):
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    """
+    Classification frames with `minimum` to `per_frame` predictions drawn from `labels`.
+    """
+    return [
+        {
+            'timestamp': second / frames_per_second,
+            'predictions': [
+                {'prediction': generator.choice(labels), 'confidence': round(generator.random(), 4)}
+                for _ in range(generator.randint(minimum, per_frame))
+            ],
+        }
+        for second in range(int(seconds * frames_per_second))
+    ]
+
+
+def yolo_frames(hours=2, frames_per_second=1, labels=80, per_frame=6, seed=1):
+    """
+    A synthetic YOLO classification frame list for a video `hours` long.
+    """
+    return prediction_frames(
+        random.Random(seed),
+        hours * 60 * 60,
+        [f'object {number}' for number in range(labels)],
+        per_frame,
+        frames_per_second=frames_per_second,
+    )
+
+
+def video_document(video_id, segments=2000, seconds=7200, web_resource=None, seed=None):
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    """
+    A synthetic video shaped like an XOS asset, with `segments` transcription
+    segments and a frame of YOLO predictions every second.
+    """
+    generator = random.Random(video_id if seed is None else seed)
+    captions = [sentence(generator, 6) for _ in range(200)]
+    objects = [f'object {number}' for number in range(80)]
+    return {
+        'id': video_id,
+        'title': f'Video {video_id}',
+        'web_resource': web_resource or f'https://example.com/videos/{video_id}.mp4',
+        'snapshot': f'https://example.com/videos/{video_id}.jpg',
+        'works': [{'id': video_id, 'slug': f'work-{video_id}', 'title': f'Work {video_id}'}],
+        'master_metadata': {
+            'duration_hms': '02:00:00',
+            'width': 1920,
+            'height': 1080,
+            'video_frame_rate': 25,
+        },
+        'tags': [[word, generator.randint(1, 100)] for word in generator.sample(WORDS, 10)],
+        'transcription': {'segments': transcript_segments(generator, segments)},
+        'classification': {
+            'captions': {
+                'clap': prediction_frames(generator, seconds / 10, captions, 1, minimum=1),
+                'huggingface': prediction_frames(
+                    generator, seconds / 10, captions, 1, minimum=1,
+                ),
+            },
+            'objects': {
+                'huggingface': prediction_frames(generator, seconds / 10, objects, 3, minimum=1),
+                'yolo': prediction_frames(generator, seconds, objects, 6),
+            },
+            'actions': prediction_frames(generator, seconds / 10, captions, 2),
+        },
+    }
+
+
+def corpus(videos=20, **kwargs):
+    """
+    A list of synthetic videos.
+    """
+    return [video_document(video_id, **kwargs) for video_id in range(1, videos + 1)]
+
+
+def search_response(documents, size=20, page=1):
+    """
+    An Elasticsearch search response containing `documents` as hits.
+    """
+    start = (page - 1) * size
+    return {
+        'took': 1,
+        'timed_out': False,
+        'hits': {
+            'total': {'value': len(documents), 'relation': 'eq'},
+            'max_score': 1.0,
+            'hits': [
+                {'_index': 'videos', '_id': str(document['id']), '_score': 1.0, '_source': document}
+                for document in documents[start:start + size]
+            ],
+        },
+    }
@@ -0,0 +1,73 @@
+import argparse
+import statistics
+import timeit
+from collections import Counter
+
+from app.prediction_stats import PredictionStats
+from benchmarks.corpus import yolo_frames
+
+
+def legacy_prediction_counts(predictions, score=0.0):
+    """
+    calculate_prediction_counts_filter as it was before PredictionStats,
+    rescanning every frame for every distinct label.
+    """
+    prediction_text = []
+    return_list = []
+    for frame in predictions:
+        if frame.get('predictions'):
+            for prediction in frame.get('predictions'):
+                if prediction['confidence'] > score:
+                    prediction_text.append(prediction['prediction'])
+    most_common = dict(Counter(prediction_text).most_common())
+    for item in most_common.items():
+        scores = []
+        for frame in predictions:
+            if frame.get('predictions'):
+                for prediction in frame.get('predictions'):
+                    if item[0] == prediction['prediction'] and prediction['confidence'] > score:
+                        scores.append(prediction['confidence'])
+        return_list.append((item[0], item[1], round(statistics.mean(scores), 2)))
+    return return_list
+
+
+def benchmark(frames, score=0.5, repeat=3):
+    """
+    Returns the best time in seconds of the legacy filter and PredictionStats for `frames`.
+    """
+    assert legacy_prediction_counts(frames, score) == PredictionStats(frames).top(threshold=score)
+    return {
+        'frames': len(frames),
+        'predictions': sum(len(frame['predictions']) for frame in frames),
+        'legacy_seconds': min(timeit.repeat(
+            lambda: legacy_prediction_counts(frames, score), number=1, repeat=repeat,
+        )),
+        'prediction_stats_seconds': min(timeit.repeat(
+            lambda: PredictionStats(frames).top(threshold=score), number=1, repeat=repeat,
+        )),
+    }
+
+
+def main(argv=None):
+    """
+    Compare prediction counting on a long video's YOLO frames.
+
+    Usage: python -m benchmarks.prediction_stats --hours 2
+    """
+    parser = argparse.ArgumentParser(description='Benchmark prediction statistics.')
+    parser.add_argument('--hours', type=float, default=2)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    results = benchmark(yolo_frames(hours=args.hours), repeat=args.repeat)
+    speedup = results['legacy_seconds'] / results['prediction_stats_seconds']
+    print(
+        f'{results["frames"]} frames, {results["predictions"]} predictions: '
+        f'legacy {results["legacy_seconds"]:.3f}s, '
+        f'PredictionStats {results["prediction_stats_seconds"]:.3f}s ({speedup:.1f}x faster)',
+    )
+    return results
+
+
+if __name__ == '__main__':
+    main()
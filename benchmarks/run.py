@@ -0,0 +1,271 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from unittest.mock import MagicMock, patch
+
+from flask import render_template
+from moviepy.config import FFMPEG_BINARY
+from werkzeug.datastructures import MultiDict
+
+from app import elastic, filters, video, worker
+from app.catalogue import SupercutCatalogue
+from app.clip_cache import ClipCache
+from app.search_cache import SearchCache
+from benchmarks.corpus import PHRASE, corpus, search_response, video_document
+from benchmarks.standin import ElasticsearchStandIn
+
+SIZES = {
+    'full': {'videos': 20, 'segments': 2000, 'seconds': 7200},
+    'quick': {'videos': 5, 'segments': 500, 'seconds': 1800},
+}
+
+
+def measure(function, repeat=5):
+    """
+    Run `function` `repeat` times and return its fastest and mean time in seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - started)
+    return {
+        'min_seconds': round(min(times), 6),
+        'mean_seconds': round(statistics.mean(times), 6),
+        'runs': repeat,
+    }
+
+
+@contextmanager
+def elasticsearch_stand_in(documents):
+    """
+    Point the shared Elasticsearch client at a local stand-in serving `documents`.
+    """
+    with ElasticsearchStandIn(documents) as url, \
+            patch.object(elastic, 'DEBUG', True), \
+            patch.object(elastic, 'ELASTICSEARCH_HOST', url):
+        elastic.reset_client()
+        try:
+            yield
+        finally:
+            elastic.reset_client()
+
+
+def render_benchmarks(documents, repeat):
+    """
+    Time rendering the results page and a long video's detail page.
+    """
+    results = search_response(documents)
+    detail = {'_id': documents[0]['id'], '_source': documents[0]}
+    unsummarised = {
+        '_id': documents[0]['id'],
+        '_source': {key: value for key, value in documents[0].items() if key != 'summaries'},
+    }
+    with video.application.test_request_context(f'/?query={PHRASE}'):
+        return {
+            'render.index': measure(lambda: render_template(
+                'index.html',
+                query=PHRASE,
+                results=results,
+                search_type='audio',
+                size=20,
+                page=1,
+                errors=None,
+                examples=[],
+                supercut=None,
+                supercuts=False,
+            ), repeat),
+            'render.detail': measure(lambda: render_template(
+                'detail.html', video=detail, export_json=False,
+            ), repeat),
+            'render.detail_unsummarised': measure(lambda: render_template(
+                'detail.html', video=unsummarised, export_json=False,
+            ), repeat),
+        }
+
+
+def filter_benchmarks(document, repeat):
+    """
+    Time the prediction filters on a long video's YOLO frames.
+    """
+    frames = document['classification']['objects']['yolo']
+    return {
+        'filters.calculate_prediction_counts': measure(
+            lambda: filters.calculate_prediction_counts_filter(frames), repeat,
+        ),
+        'filters.get_common_words_from_text': measure(
+            lambda: filters.get_common_words_from_text(frames), repeat,
+        ),
+        'filters.common_words': measure(
+            lambda: filters.common_words_filter(document, 'objects.yolo'), repeat,
+        ),
+    }
+
+
+def search_benchmarks(documents, repeat):
+    """
+    Time searches through the Elasticsearch client against the stand-in, with and without the cache.
+    """
+    args = MultiDict({'query': PHRASE})
+    with elasticsearch_stand_in(documents), tempfile.TemporaryDirectory() as directory:
+        uncached = SearchCache(ttl=0)
+        cached = SearchCache(generation_file=os.path.join(directory, 'generation'))
+        with patch.object(video, 'search_cache', uncached):
+            results = {'search.uncached': measure(lambda: video.Search().search(args), repeat)}
+        with patch.object(video, 'search_cache', cached):
+            video.Search().search(args)
+            results['search.cached'] = measure(lambda: video.Search().search(args), repeat)
+        with patch.object(video, 'search_cache', uncached):
+            results['search.all_types'] = measure(
+                lambda: video.Search().search_all(PHRASE), repeat,
+            )
+    return results
+
+
+def make_video(path, duration=6):
+    """
+    Generate a tiny test pattern video with a tone.
+    """
+    subprocess.run(
+        [
+            FFMPEG_BINARY, '-hide_banner', '-loglevel', 'error', '-y',
+            '-f', 'lavfi', '-i', f'testsrc=size=160x120:rate=25:duration={duration}',
+            '-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}',
+            '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p', path,
+        ],
+        check=True,
+    )
+    return path
+
+
+def supercut_benchmarks(videos=3):
+    """
+    Time a supercut end to end, from the search to the joined video and poster,
+    as a preview, with an empty clip cache and again once its clips are cached.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        documents = []
+        for video_id in range(1, videos + 1):
+            document = video_document(
+                video_id,
+                segments=0,
+                seconds=6,
+                web_resource=make_video(os.path.join(directory, f'{video_id}.mp4')),
+            )
+            document['transcription']['segments'] = [
+                {'start': 0.5, 'end': 2, 'text': PHRASE},
+                {'start': 3, 'end': 4.5, 'text': f'two {PHRASE}'},
+            ]
+            documents.append(document)
+
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            with elasticsearch_stand_in(documents), \
+                    patch.object(video, 'search_cache', SearchCache(ttl=0)), \
+                    patch.object(
+                        worker, 'supercut_queue', MagicMock(cpus_per_job=os.cpu_count()),
+                    ), \
+                    patch.object(worker, 'clip_cache', ClipCache(directory='clips')), \
+                    patch.object(worker, 'supercut_catalogue', SupercutCatalogue(
+                        path='catalogue.sqlite3', directory='app/static/videos',
+                    )):
+
+                def supercut(preview=False):
+                    results, _ = video.Search().search(MultiDict({'query': PHRASE}))
+                    worker.generate_supercut_background(
+                        PHRASE, results, 'benchmark', 1, 'audio', preview=preview,
+                    )
+
+                return {
+                    'supercut.preview': measure(lambda: supercut(preview=True), 1),
+                    'supercut.cold': measure(supercut, 1),
+                    'supercut.warm': measure(supercut, 3),
+                }
+        finally:
+            os.chdir(cwd)
+
+
+def git_commit():
+    """
+    The current git commit, if there is one.
+    """
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            check=True, capture_output=True, text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous, current):
+    """
+    Print how each benchmark's fastest time changed since a previous run.
+    """
+    for name, result in current['results'].items():
+        before = previous['results'].get(name)
+        if not before:
+            print(f'{name}: {result["min_seconds"]:.4f}s (new)')
+            continue
+        change = result['min_seconds'] / before['min_seconds'] - 1 if before['min_seconds'] else 0
+        print(
+            f'{name}: {before["min_seconds"]:.4f}s -> {result["min_seconds"]:.4f}s '
+            f'({change:+.0%})',
+        )
+
+
+def main(argv=None):
+    """
+    Run the benchmark suite and save the results as JSON.
+
+    Usage: python -m benchmarks.run --output benchmarks.json [--compare previous.json] [--quick]
+    """
+    parser = argparse.ArgumentParser(description='Benchmark search, render and supercut hot paths.')
+    parser.add_argument('--output', default='benchmarks.json')
+    parser.add_argument('--compare', help='A previous results file to compare against.')
+    parser.add_argument('--quick', action='store_true', help='Use a smaller corpus.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--skip-supercut', action='store_true')
+    args = parser.parse_args(argv)
+
+    size = SIZES['quick' if args.quick else 'full']
+    search = video.Search()
+    documents = [search.prepare_document(document) for document in corpus(**size)]
+
+    results = {}
+    results.update(render_benchmarks(documents, args.repeat))
+    results.update(filter_benchmarks(documents[0], args.repeat))
+    results.update(search_benchmarks(documents, args.repeat))
+    if not args.skip_supercut:
+        results.update(supercut_benchmarks())
+
+    report = {
+        'created': datetime.now(timezone.utc).isoformat(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'corpus': size,
+        'results': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as output_file:
+        json.dump(report, output_file, indent=4)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as previous_file:
+            compare(json.load(previous_file), report)
+    else:
+        for name, result in results.items():
+            print(f'{name}: {result["min_seconds"]:.4f}s')
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks.corpus import search_response
+
+
+def phrase_from_query(query):
+    """
+    Returns the phrase of a match_phrase query, nested or not.
+    """
+    if 'nested' in query:
+        return phrase_from_query(query['nested']['query'])
+    match = query.get('match_phrase') or {}
+    return next(iter(match.values()), '')
+
+
+class ElasticsearchStandIn():
+    """
+    A local HTTP server that answers Elasticsearch _search requests from an
+    in-memory list of documents, so benchmarks include a real client round trip
+    without needing a cluster.
+
+    Usage:
+        with ElasticsearchStandIn(documents) as url:
+            ...
+    """
+    def __init__(self, documents):
+        self.documents = documents
+        self.requests = 0
+        self.server = None
+
+    def search(self, body):
+        """
+        Returns a search response for the transcript segments matching a request body.
+        """
+        phrase = phrase_from_query(body.get('query') or {}).lower()
+        matches = [
+            document for document in self.documents
+            if any(
+                phrase in segment['text'].lower()
+                for segment in (document.get('transcription') or {}).get('segments') or []
+            )
+        ]
+        size = body.get('size', 20)
+        return search_response(matches, size=size, page=body.get('from', 0) // max(size, 1) + 1)
+
+    def handler(self):
+        """
+        The request handler class bound to this stand-in.
+        """
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """
+            Answers _search and _msearch with matching documents, opens a
+            pretend point in time for _pit and answers everything else with
+            an empty object.
+            """
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):  # pylint: disable=invalid-name
+                length = int(self.headers.get('Content-Length') or 0)
+                data = self.rfile.read(length) or b'{}'
+                stand_in.requests += 1
+                if '_msearch' in self.path:
+                    # Newline-delimited header and body pairs
+                    bodies = [json.loads(line) for line in data.splitlines() if line.strip()][1::2]
+                    response = {'responses': [stand_in.search(body) for body in bodies]}
+                elif '_search' in self.path:
+                    response = stand_in.search(json.loads(data))
+                elif '_pit' in self.path:
+                    response = {'id': 'stand-in-pit'}
+                else:
+                    response = {}
+                self.respond(response)
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                self.respond({'version': {'number': '9.0.0'}, 'tagline': 'You Know, for Search'})
+
+            def respond(self, response):
+                """
+                Send a JSON response with the headers the Elasticsearch client expects.
+                """
+                data = json.dumps(response).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.send_header('X-Elastic-Product', 'Elasticsearch')
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                pass
+
+        return Handler
+
+    def __enter__(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f'http://127.0.0.1:{self.server.server_port}'
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
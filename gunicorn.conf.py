@@ -0,0 +1,11 @@
+import os
+
+from prometheus_client import multiprocess
+
+
+def child_exit(server, worker):  # pylint: disable=unused-argument
+    """
+    Drop an exited worker's live gauges from the shared Prometheus metrics.
+    """
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(worker.pid)
@@ -1,5 +1,16 @@
 #!/bin/ash
 
+# Workers share Prometheus metrics through files that must start empty
+if [ "$DEBUG" != "true" ]; then
+    export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/video-search/metrics}
+    rm -rf $PROMETHEUS_MULTIPROC_DIR
+    mkdir -p $PROMETHEUS_MULTIPROC_DIR
+fi
+
+# Supercut jobs are encoded in their own process, started again if it stops
+echo "Starting supercut worker..."
+(while true; do python -u -m app.worker; sleep 5; done) &
+
 if [ "$DEBUG" = "true" ]; then
     echo "Starting Flask server..."
     python -u -m app.video
@@ -10,6 +21,8 @@ else
         --log-level DEBUG \
         --pythonpath $PYTHON_PATH \
         --workers 2 \
+        --worker-class ${GUNICORN_WORKER_CLASS:-gevent} \
+        --worker-connections ${GUNICORN_WORKER_CONNECTIONS:-1000} \
         --bind 0.0.0.0:$PORT \
         --timeout 12000 \
         --reload
@@ -0,0 +1,57 @@
+import argparse
+import base64
+import hashlib
+import io
+import json
+import os
+import tarfile
+import urllib.request
+
+# The hls.js release served from app/static/js for streaming supercuts in
+# browsers without native HLS
+HLS_JS_VERSION = '1.5.20'
+REGISTRY = 'https://registry.npmjs.org/hls.js'
+DESTINATION = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'app', 'static', 'js', 'hls.min.js',
+)
+
+
+def download(url):
+    """
+    Returns the body of a URL.
+    """
+    with urllib.request.urlopen(url, timeout=60) as response:
+        return response.read()
+
+
+def vendor(version=HLS_JS_VERSION, destination=DESTINATION):
+    """
+    Download a pinned hls.js release from the npm registry, check it against
+    the registry's integrity hash and save its minified build.
+    """
+    dist = json.loads(download(f'{REGISTRY}/{version}'))['dist']
+    tarball = download(dist['tarball'])
+    algorithm, expected = dist['integrity'].split('-', 1)
+    digest = base64.b64encode(hashlib.new(algorithm, tarball).digest()).decode('ascii')
+    if digest != expected:
+        raise SystemExit(f'hls.js {version} failed its {algorithm} integrity check')
+    with tarfile.open(fileobj=io.BytesIO(tarball), mode='r:gz') as archive:
+        script = archive.extractfile('package/dist/hls.min.js').read()
+    with open(destination, 'wb') as script_file:
+        script_file.write(script)
+    print(f'Saved hls.js {version} to {destination}')
+
+
+def main(argv=None):
+    """
+    Usage: python scripts/vendor_hls.py [--version 1.5.20]
+    """
+    parser = argparse.ArgumentParser(description='Vendor a pinned hls.js into app/static/js.')
+    parser.add_argument('--version', default=HLS_JS_VERSION)
+    args = parser.parse_args(argv)
+    vendor(args.version)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,54 @@
-from unittest.mock import patch
+# pylint: disable=too-many-lines
+import base64
+import gzip
+import hashlib
+import importlib.util
+import io
+import json
+import os
+import re
+import runpy
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tarfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from copy import deepcopy
+from functools import partial
+from http.server import (BaseHTTPRequestHandler, SimpleHTTPRequestHandler,
+                         ThreadingHTTPServer)
+from unittest.mock import MagicMock, patch
 
-from app.video import application, sanitise_string
+import elasticsearch
+import pytest
+import requests
+from moviepy.config import FFMPEG_BINARY
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+from werkzeug.datastructures import MultiDict
+
+from app import (elastic, filters, indexing, local_search, supercut, video,
+                 worker, xos)
+from app.catalogue import SupercutCatalogue, parse_filename
+from app.clip_cache import ClipCache
+from app.events import EventChannel
+from app.exports import ExportWriter
+from app.jobs import SupercutQueue
+from app.media import MediaCache
+from app.metrics import REGISTRY
+from app.prediction_stats import PredictionStats
+from app.search_cache import SearchCache
+from app.utils import STOPWORDS
+from app.video import Search, application, sanitise_string
+from benchmarks.corpus import video_document, yolo_frames
+from benchmarks.prediction_stats import benchmark as prediction_stats_benchmark
+from benchmarks.prediction_stats import legacy_prediction_counts
+from benchmarks.run import main as run_benchmarks
 
 mock_search = {
     'hits': {
@@ -30,12 +78,20 @@ mock_search = {
 }, {}
 
 
+def temp_catalogue(tmp_path):
+    """
+    A supercut catalogue for a temporary supercut directory.
+    """
+    return SupercutCatalogue(path=str(tmp_path / 'catalogue.sqlite3'), directory=str(tmp_path))
+
+
 @patch('app.video.Search.search', return_value=mock_search)
-def test_root(_):
+def test_root(_, tmp_path):
     """
     Test the Video search root returns expected content.
     """
-    with application.test_client() as client:
+    with patch('app.video.supercut_catalogue', temp_catalogue(tmp_path)), \
+            application.test_client() as client:
         response = client.get('/')
         assert response.status_code == 200
         assert 'Video search' in response.text
@@ -66,3 +122,1987 @@ def test_sanitise_string():
     assert sanitise_string('tr?<?"/&ee"\\') == 'tree'
     assert sanitise_string('hello, there') == 'hello, there'
     assert sanitise_string("what's that") == "what's that"
+
+
+@patch('app.elastic.DEBUG', True)
+def test_shared_elasticsearch_client():
+    """
+    Test the Elasticsearch client is created once per process and reports pool stats.
+    """
+    elastic.reset_client()
+    assert elastic.pool_stats()['created'] is False
+    client = elastic.get_client()
+    assert elastic.get_client() is client
+    assert Search().elastic_search is client
+    assert Search().elastic_search is Search().elastic_search
+
+    stats = elastic.pool_stats()
+    assert stats['created'] is True
+    assert stats['nodes'][0]['base_url'] == elastic.ELASTICSEARCH_HOST.rstrip('/')
+    assert stats['nodes'][0]['connections_opened'] == 0
+
+    # A forked worker gets a fresh client rather than its parent's sockets
+    elastic._forget_client_after_fork()  # pylint: disable=protected-access
+    assert elastic.get_client() is not client
+    elastic.reset_client()
+
+    with application.test_client() as http_client:
+        response = http_client.get('/status/elasticsearch/')
+        assert response.status_code == 200
+        assert response.json['created'] is False
+
+
+mock_nested_search = {
+    'hits': {
+        'total': {
+            'value': 1,
+        },
+        'hits': [{
+            '_id': 1,
+            '_score': 0.9,
+            '_source': {
+                'id': 1,
+                'title': 'A video',
+            },
+            'inner_hits': {
+                'transcription.segments': {
+                    'hits': {
+                        'hits': [
+                            {'_source': {'text': 'more large elephants', 'start': 30, 'end': 32}},
+                            {'_source': {'text': 'three large elephants', 'start': 9, 'end': 11}},
+                        ],
+                    },
+                },
+            },
+        }],
+    },
+}
+
+
+@patch('app.video.ELASTICSEARCH_NESTED', True)
+@patch('app.video.get_client')
+def test_nested_search(mock_get_client, tmp_path):
+    """
+    Test nested search mode asks for inner_hits with filtered _source
+    and only renders the matching segments.
+    """
+    mock_get_client.return_value = MagicMock()
+    mock_get_client.return_value.search.return_value = mock_nested_search
+    with patch('app.video.supercut_catalogue', temp_catalogue(tmp_path)), \
+            application.test_client() as client:
+        response = client.get('/?query=large+elephants')
+        assert response.status_code == 200
+        assert 'three large elephants' in response.text
+        text = response.text
+        assert text.index('three large elephants') < text.index('more large elephants')
+
+    body = mock_get_client.return_value.search.call_args.kwargs['body']
+    assert body['query']['nested']['path'] == 'transcription.segments'
+    assert body['query']['nested']['query'] == {
+        'match_phrase': {'transcription.segments.text': 'large elephants'},
+    }
+    assert 'inner_hits' in body['query']['nested']
+    assert 'transcription' not in body['_source']['includes']
+
+    segments = mock_nested_search['hits']['hits'][0]['_source']['transcription']['segments']
+    assert [segment['start'] for segment in segments] == [9, 30]
+    assert elastic.nested_path('classification.captions.clap.predictions.prediction') == \
+        'classification.captions.clap'
+    assert elastic.nested_path('title') is None
+
+
+@patch('app.video.ELASTICSEARCH_NESTED', True)
+@patch('app.video.get_client')
+def test_nested_image_supercut_progress(mock_get_client, tmp_path):
+    """
+    Test the supercut progress page renders for a nested image search,
+    which has no transcription in its _source. Its credits are added once
+    the supercut is made.
+    """
+    mock_get_client.return_value = MagicMock()
+    mock_get_client.return_value.search.return_value = {
+        'hits': {
+            'total': {'value': 1},
+            'hits': [{
+                '_id': 1,
+                '_score': 0.9,
+                '_source': {'id': 1, 'title': 'A video', 'works': []},
+                'inner_hits': {
+                    'classification.captions.huggingface': {'hits': {'hits': [
+                        {'_source': {
+                            'timestamp': 75,
+                            'predictions': [{'prediction': 'a large elephant'}],
+                        }},
+                    ]}},
+                },
+            }],
+        },
+    }
+    queue = SupercutQueue(path=str(tmp_path / 'jobs.sqlite3'))
+    queue.start = MagicMock()
+    with patch('app.video.supercut_queue', queue), \
+            patch('app.video.supercut_catalogue', temp_catalogue(tmp_path)), \
+            application.test_client() as client:
+        response = client.get('/?query=large+elephant&searchType=image&supercuts=on')
+        assert response.status_code == 200
+        assert 'Generating a Supercut' in response.text
+        assert '<ol class="supercut-credits"></ol>' in response.text
+
+
+@patch('app.video.get_client')
+def test_search_cache(mock_get_client, tmp_path):
+    """
+    Test repeated searches are served from the cache, shared between workers,
+    and dropped once the index changes.
+    """
+    mock_get_client.return_value.search.return_value = mock_search[0]
+    settings = {
+        'path': str(tmp_path / 'cache.sqlite3'),
+        'generation_file': str(tmp_path / 'generation'),
+    }
+    cache = SearchCache(**settings)
+    with patch('app.video.search_cache', cache), \
+            patch('app.video.supercut_catalogue', temp_catalogue(tmp_path)), \
+            application.test_client() as client:
+        assert 'three large elephants' in client.get('/?query=Large+Elephants').text
+        assert client.get('/?query=large++elephants').status_code == 200
+        assert mock_get_client.return_value.search.call_count == 1
+        client.get('/?query=large+elephants&page=2')
+        assert mock_get_client.return_value.search.call_count == 2
+        assert cache.summary()['hits'] == 1 and cache.summary()['misses'] == 2
+        assert client.get('/status/search-cache/').json['hits'] == 1
+
+    # Another worker finds the result in the shared cache
+    other_worker = SearchCache(**settings)
+    with patch('app.video.search_cache', other_worker), \
+            patch('app.video.supercut_catalogue', temp_catalogue(tmp_path)), \
+            application.test_client() as client:
+        client.get('/?query=large+elephants')
+        assert mock_get_client.return_value.search.call_count == 2
+        assert other_worker.summary()['shared_hits'] == 1
+
+        cache.invalidate()
+        client.get('/?query=large+elephants')
+        assert mock_get_client.return_value.search.call_count == 3
+
+        # Indexing one record drops cached results unless the caller will do it later
+        with patch.object(other_worker, 'invalidate') as invalidate:
+            Search().index('videos', {'id': 1, 'title': 'A video'}, invalidate=False)
+            invalidate.assert_not_called()
+            Search().index('videos', {'id': 1, 'title': 'A video'})
+            invalidate.assert_called_once()
+
+
+@patch('app.video.get_client')
+def test_search_api(mock_get_client, tmp_path):
+    """
+    Test the JSON search API searches every type in one msearch
+    and returns compact hits with only their matching segments.
+    """
+    caption_hit = {
+        '_id': 2,
+        '_score': 0.5,
+        '_source': {
+            'id': 2,
+            'title': 'Another video',
+            'classification': {'captions': {'huggingface': [
+                {'timestamp': 12, 'predictions': [
+                    {'prediction': 'two large elephants', 'confidence': 0.8},
+                    {'prediction': 'a frog', 'confidence': 0.1},
+                ]},
+                {'timestamp': 18, 'predictions': [{'prediction': 'a river', 'confidence': 0.6}]},
+            ]}},
+        },
+    }
+    mock_get_client.return_value.msearch.return_value = {'responses': [
+        mock_search[0],
+        {'hits': {'total': {'value': 1}, 'hits': [caption_hit]}},
+        {'error': {'type': 'search_phase_execution_exception', 'reason': 'Timed out'}},
+    ]}
+    cache = SearchCache(
+        path=str(tmp_path / 'cache.sqlite3'), generation_file=str(tmp_path / 'generation'),
+    )
+    with patch('app.video.search_cache', cache), application.test_client() as client:
+        response = client.get('/api/search/?query=Large+Elephants&size=5')
+        assert response.status_code == 200
+        results = response.json['results']
+        assert results['audio']['total'] == 1
+        assert results['audio']['hits'][0]['segments'] == [
+            {'text': 'three large elephants', 'start': 9},
+        ]
+        assert 'transcription' not in results['audio']['hits'][0]
+        assert results['image']['hits'][0]['segments'] == [
+            {'timestamp': 12, 'predictions': [
+                {'prediction': 'two large elephants', 'confidence': 0.8},
+            ]},
+        ]
+        assert results['audioDescription'] == {'error': 'Timed out'}
+        assert mock_get_client.return_value.msearch.call_count == 1
+
+        searches = mock_get_client.return_value.msearch.call_args.kwargs['searches']
+        assert len(searches) == 6
+        assert searches[1]['query'] == {
+            'match_phrase': {'transcription.segments.text': 'large elephants'},
+        }
+        assert searches[1]['size'] == 5 and searches[1]['track_total_hits']
+        assert 'transcription.segments' in searches[1]['_source']['includes']
+
+        client.get('/api/search/?query=large+elephants&size=5')
+        assert mock_get_client.return_value.msearch.call_count == 1
+
+        counts = client.get('/api/search/?query=large+elephants&types=audio&only=counts').json
+        assert counts['results'] == {'audio': {'total': 1}}
+        searches = mock_get_client.return_value.msearch.call_args.kwargs['searches']
+        assert len(searches) == 2 and searches[1]['size'] == 0
+
+        client.get('/api/search/?query=large+elephants&types=audio&only=hits')
+        searches = mock_get_client.return_value.msearch.call_args.kwargs['searches']
+        assert searches[1]['track_total_hits'] is False
+
+        assert client.get('/api/search/').status_code == 400
+        assert client.get('/api/search/?query=frog&types=video').status_code == 400
+        assert client.get('/api/search/?query=frog&only=everything').status_code == 400
+
+        # Sizes and pages are clamped before they're searched and echoed
+        response = client.get('/api/search/?query=frog&types=audio&size=-5&page=-2').json
+        assert (response['size'], response['page']) == (0, 1)
+        searches = mock_get_client.return_value.msearch.call_args.kwargs['searches']
+        assert (searches[1]['size'], searches[1]['from']) == (0, 0)
+        assert client.get('/api/search/?query=frog&types=audio&size=500').json['size'] == 50
+
+        # Elasticsearch errors are returned as JSON
+        mock_get_client.return_value.msearch.side_effect = elasticsearch.ConnectionError('down')
+        response = client.get('/api/search/?query=toad')
+        assert response.status_code == 503 and response.json['error']
+        mock_get_client.return_value.msearch.side_effect = elasticsearch.BadRequestError(
+            'bad', MagicMock(status=400), {},
+        )
+        response = client.get('/api/search/?query=newt')
+        assert response.status_code == 502 and response.json['error']
+
+
+def page_of_hits(first, size, total=100, pit_id=None):
+    """
+    A search response with `size` hits numbered from `first`, and their sort
+    values if it's from a point in time.
+    """
+    response = {'hits': {'total': {'value': total, 'relation': 'eq'}, 'hits': [
+        {
+            '_id': number,
+            '_score': 1.0,
+            '_source': {
+                'id': number,
+                'title': f'Video {number}',
+                'transcription': {'segments': [{'text': 'two elephants', 'start': 1}]},
+            },
+        }
+        for number in range(first, first + size)
+    ]}}
+    if pit_id:
+        response['pit_id'] = pit_id
+        for hit in response['hits']['hits']:
+            hit['sort'] = [1.0, hit['_id']]
+    return response
+
+
+@patch('app.video.get_client')
+def test_search_cursors(mock_get_client, tmp_path):  # pylint: disable=too-many-locals,too-many-statements
+    """
+    Test every page is searched in a point in time shared by searches without
+    a cursor, later pages are fetched with search_after by following the cursors
+    in the previous and next links, and replaced points in time are closed.
+    """
+    elastic_search = mock_get_client.return_value
+    elastic_search.open_point_in_time.return_value = {'id': 'pit-1'}
+    elastic_search.search.return_value = page_of_hits(1, 2, pit_id='pit-1')
+
+    def next_link(text):
+        return re.search(r'href="([^"]+)">Next', text).group(1).replace('&amp;', '&')
+
+    cache = SearchCache(ttl=0, generation_file=str(tmp_path / 'generation'))
+    with patch('app.video.search_cache', cache), \
+            patch('app.video.shared_points_in_time', elastic.SharedPointsInTime()), \
+            patch('app.video.supercut_catalogue', temp_catalogue(tmp_path)), \
+            application.test_client() as client:
+        # The first page is sorted the same way as the rest, so no hits are
+        # repeated or skipped between pages 1 and 2
+        first_page = client.get('/?query=elephants&size=2')
+        kwargs = elastic_search.search.call_args.kwargs
+        assert 'index' not in kwargs
+        assert kwargs['body']['from'] == 0 and kwargs['body']['sort'] == elastic.SEARCH_SORT
+        assert kwargs['body']['pit']['id'] == 'pit-1'
+        link = next_link(first_page.text)
+        assert 'page=2' in link and 'cursor=' in link
+        # Other searches without a cursor share the point in time
+        client.get('/?query=lions&size=2&page=3')
+        assert elastic_search.search.call_args.kwargs['body']['from'] == 4
+        elastic_search.open_point_in_time.assert_called_once()
+
+        # Page 2 carries on from page 1's last hit in its point in time
+        elastic_search.search.return_value = page_of_hits(3, 2, pit_id='pit-2')
+        second_page = client.get(link)
+        assert 'Video 3' in second_page.text
+        body = elastic_search.search.call_args.kwargs['body']
+        assert body['pit']['id'] == 'pit-1' and body['search_after'] == [1.0, 2]
+        assert 'from' not in body
+        # Elasticsearch replaced the point in time, so the old one is closed
+        elastic_search.close_point_in_time.assert_called_once_with(id='pit-1')
+
+        elastic_search.search.return_value = page_of_hits(5, 2, pit_id='pit-2')
+        third_link = next_link(second_page.text)
+        third_page = client.get(third_link)
+        body = elastic_search.search.call_args.kwargs['body']
+        assert body['pit']['id'] == 'pit-2' and body['search_after'] == [1.0, 4]
+        assert elastic_search.open_point_in_time.call_count == 1
+
+        # Going back fetches the page before the first hit in reverse and puts it in order
+        previous_link = re.search(r'href="([^"]+)">Previous', third_page.text).group(1)
+        elastic_search.search.return_value = page_of_hits(3, 2, pit_id='pit-2')
+        elastic_search.search.return_value['hits']['hits'].reverse()
+        second_again = client.get(previous_link.replace('&amp;', '&')).text
+        body = elastic_search.search.call_args.kwargs['body']
+        assert body['sort'] == elastic.REVERSE_SEARCH_SORT and body['search_after'] == [1.0, 5]
+        assert second_again.index('Video 3') < second_again.index('Video 4')
+
+        # A cursor's sort values don't carry over to another point in time, so
+        # once its point in time has expired the page is fetched by number
+        elastic_search.open_point_in_time.return_value = {'id': 'pit-3'}
+        elastic_search.search.side_effect = [
+            elasticsearch.NotFoundError('search_context_missing_exception', MagicMock(), {}),
+            page_of_hits(7, 2, pit_id='pit-3'),
+        ]
+        assert 'Video 7' in client.get(next_link(third_page.text)).text
+        elastic_search.close_point_in_time.assert_called_with(id='pit-2')
+        body = elastic_search.search.call_args.kwargs['body']
+        assert body['pit']['id'] == 'pit-3' and body['from'] == 6
+        assert 'search_after' not in body
+
+        # Other Elasticsearch errors are shown rather than failing the page
+        elastic_search.search.side_effect = elasticsearch.ApiError(
+            'es_rejected_execution_exception', MagicMock(status=429), {},
+        )
+        rejected = client.get('/?query=tigers')
+        assert rejected.status_code == 200
+        assert 'es_rejected_execution_exception' in rejected.text
+
+        # Sizes over the limit are capped once, so a full page still has a next page
+        elastic_search.search.side_effect = None
+        elastic_search.search.return_value = page_of_hits(1, 50, total=200)
+        big_page = client.get('/?query=elephants&size=100')
+        assert elastic_search.search.call_args.kwargs['body']['size'] == 50
+        assert 'size=50' in next_link(big_page.text)
+
+        # A supercut of a page searches for the page the user saw
+        with patch('app.video.supercut_queue') as queue:
+            queue.submit.return_value = 'task'
+            client.get(f'{third_link}&supercuts=on')
+        assert queue.submit.call_args.kwargs['cursor'] == re.search(
+            r'cursor=([^&]+)', third_link,
+        ).group(1)
+
+    assert elastic.decode_cursor('not a cursor') is None
+    # A shared point in time is replaced once it's older than reuse_seconds
+    opened = iter(['old', 'new'])
+    points = elastic.SharedPointsInTime(reuse_seconds=-1)
+    assert points.get('client', 'videos', lambda index: next(opened)) == 'old'
+    assert points.get('client', 'videos', lambda index: next(opened)) == 'new'
+    # The last page has no next page
+    previous_cursor, next_cursor = elastic.page_cursors(page_of_hits(99, 2, pit_id='pit'), 50, 2)
+    assert elastic.decode_cursor(previous_cursor)['after'] == [1.0, 99]
+    assert next_cursor is None
+
+
+@patch('app.video.get_client')
+def test_search_cache_points_in_time(mock_get_client, tmp_path):
+    """
+    Test cached pages don't hand out the point in time they were searched in,
+    and a cursor's page is only served from the cache in its own point in time.
+    """
+    elastic_search = mock_get_client.return_value
+    elastic_search.open_point_in_time.return_value = {'id': 'pit-1'}
+    elastic_search.search.return_value = page_of_hits(1, 2, pit_id='pit-1')
+    cache = SearchCache(generation_file=str(tmp_path / 'generation'))
+    with patch('app.video.search_cache', cache), \
+            patch('app.video.shared_points_in_time', elastic.SharedPointsInTime()), \
+            patch('app.video.supercut_catalogue', temp_catalogue(tmp_path)), \
+            application.test_client() as client:
+        first_page = client.get('/?query=elephants&size=2').text
+        assert 'cursor=' in first_page
+        cached_page = client.get('/?query=elephants&size=2').text
+        assert elastic_search.search.call_count == 1
+        # The point in time may have expired, so the cached page links by number
+        assert 'page=2' in cached_page and 'cursor=' not in cached_page
+
+        cursor = {'pit': 'pit-1', 'sort_values': [1.0, 2]}
+        elastic_search.search.return_value = page_of_hits(3, 2, pit_id='pit-1')
+        link = f'/?query=elephants&size=2&page=2&cursor={elastic.encode_cursor(**cursor)}'
+        client.get(link)
+        assert 'cursor=' in client.get(link).text
+        assert elastic_search.search.call_count == 2
+        cursor['pit'] = 'pit-2'
+        client.get(f'/?query=elephants&size=2&page=2&cursor={elastic.encode_cursor(**cursor)}')
+        assert elastic_search.search.call_count == 3
+
+
+@patch('app.video.SEARCH_BACKEND', 'local')
+@patch('app.video.get_client', side_effect=AssertionError('Elasticsearch was used'))
+def test_local_search(_, tmp_path):
+    """
+    Test the embedded search backend answers phrase searches from exported
+    video JSON with the matching segments, without Elasticsearch.
+    """
+    exports = tmp_path / 'json'
+    exports.mkdir()
+    for video_id in (1, 2, 3):
+        document = Search().prepare_document(video_document(video_id, segments=120, seconds=60))
+        document['classification']['captions']['huggingface'][2]['predictions'] = [
+            {'prediction': 'a frog near large elephants', 'confidence': 0.5},
+        ] if video_id == 2 else []
+        with open(exports / f'Video {video_id}.json', 'w', encoding='utf-8') as export_file:
+            json.dump(document, export_file)
+    stats = local_search.build_index(str(exports), str(tmp_path / 'index'))
+    assert stats['documents'] == 3 and stats['segments'] > 360
+
+    index = local_search.LocalIndex(str(tmp_path / 'index'))
+    matches = index.phrase('audio', 'Large Elephants')
+    assert sorted(index.ids[number] for number in matches) == [1, 2, 3]
+    for number, segments in matches.items():
+        # The same segments as scanning every transcript, numbered from the video's first one
+        transcript = index.document(number)['transcription']['segments']
+        expected = [
+            segment_number for segment_number, segment in enumerate(transcript)
+            if re.search(r'\blarge elephants\b', segment['text'])
+        ]
+        assert [int(segment - index.ranges[number][0][0]) for segment in segments] == expected
+        assert expected[:1] == [0]
+    assert not index.phrase('image', 'elephants near frog')
+    assert not index.phrase('audio', 'no such words')
+    number = index.numbers['2']
+    assert index.phrase('image', 'frog near large') == {number: [index.ranges[number][1][0] + 2]}
+
+    local_search.reset_local_index()
+    with patch('app.local_search.LOCAL_SEARCH_INDEX', str(tmp_path / 'index')), \
+            patch('app.video.search_cache', SearchCache(ttl=0)), \
+            patch('app.video.supercut_catalogue', temp_catalogue(tmp_path)), \
+            application.test_client() as client:
+        response = client.get('/?query=large+elephants&size=2')
+        assert response.status_code == 200
+        assert 'Video 1' in response.text and 'Video 2' in response.text
+        assert 'Video 3' not in response.text
+        assert 'Video 3' in client.get('/?query=large+elephants&size=2&page=2').text
+        assert client.get('/videos/2/').status_code == 200
+
+        results = client.get('/api/search/?query=frog+near+large+elephants').json['results']
+        assert results['audio']['total'] == 0
+        assert [hit['id'] for hit in results['image']['hits']] == [2]
+        assert results['image']['hits'][0]['segments'][0]['timestamp'] == 2
+
+        with patch('app.video.ELASTICSEARCH_NESTED', True):
+            search_results, _ = Search().search(MultiDict({'query': 'large elephants'}))
+        segments = search_results['hits']['hits'][0]['_source']['transcription']['segments']
+        assert all('large elephants' in segment['text'] for segment in segments)
+        assert {0, 200, 400} <= {segment['start'] for segment in segments}
+    local_search.reset_local_index()
+
+
+@patch('app.video.SEARCH_BACKEND', 'local')
+def test_local_search_builds(tmp_path):
+    """
+    Test searches never build the local index, index_all rebuilds it from the
+    exports with an atomic swap, and workers reopen the new build.
+    """
+    exports = tmp_path / 'json'
+    exports.mkdir()
+    index = str(tmp_path / 'index')
+    local_search.reset_local_index()
+    with patch('app.local_search.LOCAL_SEARCH_EXPORTS', str(exports)), \
+            patch('app.local_search.LOCAL_SEARCH_INDEX', index), \
+            patch('app.local_search.SearchCache'), \
+            patch('app.video.search_cache', SearchCache(ttl=0)):
+        with pytest.raises(FileNotFoundError, match='python -m app.local_search'):
+            local_search.get_local_index()
+        # Until it's built pages show the error and the API is unavailable
+        with application.test_client() as client:
+            response = client.get('/?query=elephants')
+            assert response.status_code == 200
+            assert 'python -m app.local_search' in response.text
+            response = client.get('/api/search/?query=elephants')
+            assert response.status_code == 503
+            assert response.json == {'error': 'Search is unavailable'}
+        assert not os.path.exists(index)
+        with pytest.raises(RuntimeError, match='read-only'):
+            Search().index('videos', video_document(1, segments=1))
+
+        for video_id in (1, 2, 3):
+            with open(exports / f'{video_id}.json', 'w', encoding='utf-8') as export_file:
+                json.dump(video_document(video_id, segments=5), export_file)
+            stats = Search().index_all()
+            assert stats['indexed'] == video_id and not stats['failed']
+            opened = local_search.get_local_index()
+            assert opened.ids == list(range(video_id, 0, -1))
+            assert local_search.get_local_index() is opened
+        # The index is a link to the latest build, and only the one before it is kept
+        assert os.path.islink(index)
+        assert len([name for name in os.listdir(tmp_path) if name.startswith('index-')]) == 2
+    local_search.reset_local_index()
+
+
+@patch('app.video.get_client')
+def test_metrics(mock_get_client, tmp_path, capsys):
+    """
+    Test requests and supercut jobs are measured, exposed on /metrics and logged as JSON.
+    """
+    mock_get_client.return_value.search.return_value = mock_search[0]
+    queue = SupercutQueue(path=str(tmp_path / 'jobs.sqlite3'))
+    queue.start = MagicMock()
+    queue.submit('elephants', 1, 'audio')
+
+    def sample(name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    searches = sample('elasticsearch_query_seconds_count', operation='search')
+    renders = sample('template_render_seconds_count', template='index.html')
+    jobs = sample('supercut_job_seconds_count', status='no_clips')
+    with patch('app.video.search_cache', SearchCache(ttl=0)), \
+            patch('app.video.supercut_catalogue', temp_catalogue(tmp_path)), \
+            patch('app.video.supercut_queue', queue), \
+            patch('app.worker.supercut_queue', queue), \
+            patch('app.worker.generate_supercut_background', return_value=None), \
+            application.test_client() as client:
+        client.get('/?query=large+elephants')
+        worker.run_supercut_job(
+            {'id': 'job', 'query': 'elephants', 'page': 1, 'size': 20, 'search_type': 'audio'},
+            cpus=1,
+        )
+        body = client.get('/metrics').text
+
+    assert sample('elasticsearch_query_seconds_count', operation='search') == searches + 2
+    assert sample('template_render_seconds_count', template='index.html') == renders + 1
+    assert sample('supercut_job_seconds_count', status='no_clips') == jobs + 1
+    assert 'supercut_jobs{status="queued"} 1.0' in body
+    assert 'http_request_seconds_count{endpoint="/",method="GET",status="200"}' in body
+
+    request_log, job_log, _ = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert job_log['event'] == 'supercut' and job_log['status'] == 'no_clips'
+    assert job_log['search_count'] == 1
+    assert request_log['event'] == 'request' and request_log['endpoint'] == '/'
+    # Opening the worker's shared point in time, then the search in it
+    assert request_log['elasticsearch_count'] == 2 and request_log['render_count'] == 1
+
+
+def test_prediction_summaries():
+    """
+    Test prediction summaries are computed at index time, match the render time
+    filters, and are what the detail page shows.
+    """
+    frames = [
+        {'timestamp': 0, 'predictions': [
+            {'prediction': 'A green frog', 'confidence': 0.9},
+            {'prediction': 'a pond', 'confidence': 0.5},
+        ]},
+        {'timestamp': 1, 'predictions': [{'prediction': 'A green frog', 'confidence': 0.7}]},
+        {'timestamp': 2, 'predictions': []},
+    ]
+    captions = [
+        {'timestamp': 0, 'predictions': [
+            {'prediction': "A dog's bark, then rain\ton a tin roof", 'confidence': 0.25},
+        ]},
+        {'timestamp': 4.5, 'end': 9, 'predictions': [
+            {'prediction': 'Rain-soaked dog barking, barking', 'confidence': 1e-05},
+        ]},
+    ]
+
+    def render_time_words(text, number=50):
+        # The detail page's filter before summaries were precomputed
+        words = [re.compile('[^a-zA-Z]').sub('', word.lower()) for word in str(text).split(' ')]
+        return Counter(word for word in words if word not in STOPWORDS).most_common(number)
+
+    document = Search().prepare_document({
+        'id': 1,
+        'title': 'A video',
+        'master_metadata': {},
+        'works': [],
+        'transcription': {'segments': []},
+        'classification': {
+            'captions': {'clap': captions, 'huggingface': []},
+            'objects': {'huggingface': [], 'yolo': frames},
+            'actions': [],
+        },
+    })
+    summary = document['summaries']['objects']['yolo']
+    assert summary['labels'] == [
+        {'label': 'A green frog', 'count': 2, 'confidence': 0.8},
+        {'label': 'a pond', 'count': 1, 'confidence': 0.5},
+    ]
+    assert [(item['word'], item['count']) for item in summary['words']] == \
+        filters.get_common_words_from_text(frames)
+    assert [(item['label'], item['count'], item['confidence']) for item in summary['labels']] == \
+        filters.calculate_prediction_counts_filter(frames)
+    # Captions show the same words as they did when they were counted on every view
+    assert filters.common_words_filter(document, 'captions.clap') == render_time_words(captions)
+    assert filters.common_words_filter(document, 'objects.yolo') == render_time_words(frames)
+    assert document['summaries']['captions']['huggingface'] == {'words': [], 'labels': []}
+
+    document['summaries']['objects']['yolo']['words'] = [{'word': 'precomputed', 'count': 9}]
+    with patch('app.video.Search.get_video', return_value={'_id': 1, '_source': document}), \
+            application.test_client() as client:
+        response = client.get('/videos/1/')
+    assert 'precomputed (9)' in response.text
+
+    # Documents indexed before summaries existed are summarised when they're viewed
+    del document['summaries']
+    assert filters.common_words_filter(document, 'objects.yolo') == [
+        ('green', 2), ('frog', 2), ('pond', 1),
+    ]
+
+
+def test_prediction_stats():
+    """
+    Test single pass prediction statistics match the frame by frame calculation.
+    """
+    frames = yolo_frames(hours=0.05)
+    stats = PredictionStats(frames)
+    assert stats.top(threshold=0.5) == legacy_prediction_counts(frames, 0.5)
+    assert stats.top(number=3) == legacy_prediction_counts(frames)[:3]
+
+    label, count, _ = stats.top(number=1)[0]
+    confidences = [
+        prediction['confidence']
+        for frame in frames
+        for prediction in frame['predictions']
+        if prediction['prediction'] == label
+    ]
+    aggregates = stats.aggregate()
+    assert aggregates['count'][stats.label_ids[label]] == count
+    assert aggregates['min'][stats.label_ids[label]] == min(confidences)
+    assert aggregates['max'][stats.label_ids[label]] == max(confidences)
+    assert sum(stats.histogram(bin_seconds=60, label=label)) == count
+    assert len(stats.histogram(bin_seconds=60)) == 3
+    median = round(statistics.median(confidences), 4)
+    assert stats.percentiles(label, percentiles=(50,))[50] == median
+    assert stats.percentiles('not a label') == {}
+    assert PredictionStats([{'timestamp': 0, 'predictions': []}]).top() == []
+
+    results = prediction_stats_benchmark(frames, repeat=1)
+    assert results['frames'] == len(frames)
+
+
+def test_benchmark_suite(tmp_path, capsys):
+    """
+    Test the benchmark suite runs against its Elasticsearch stand-in and compares runs.
+    """
+    sizes = {'quick': {'videos': 2, 'segments': 100, 'seconds': 60}}
+    output = str(tmp_path / 'before.json')
+    with patch('benchmarks.run.SIZES', sizes):
+        report = run_benchmarks([
+            '--quick', '--skip-supercut', '--repeat', '1', '--output', output,
+        ])
+        assert set(report['results']) >= {
+            'render.index',
+            'render.detail',
+            'filters.calculate_prediction_counts',
+            'search.uncached',
+            'search.cached',
+        }
+        assert report['results']['search.cached']['runs'] == 1
+        with open(output, encoding='utf-8') as results_file:
+            assert json.load(results_file)['corpus'] == sizes['quick']
+
+        run_benchmarks([
+            '--quick', '--skip-supercut', '--repeat', '1',
+            '--output', str(tmp_path / 'after.json'), '--compare', output,
+        ])
+    assert 'render.index:' in capsys.readouterr().out
+
+
+def mock_xos_page(page, pages=5, page_size=2):
+    """
+    A fake XOS assets page.
+    """
+    return {
+        'count': pages * page_size,
+        'next': f'?page={page + 1}' if page < pages else None,
+        'results': [
+            {
+                'id': (page - 1) * page_size + number,
+                'title': f'Video {(page - 1) * page_size + number}',
+                'tags': [['music', 3]],
+                'transcription': {'segments': []} if number else None,
+                'classification': None,
+            }
+            for number in range(page_size)
+        ],
+    }
+
+
+def test_fetch_pages():
+    """
+    Test XOS pages are prefetched concurrently but yielded in order, and
+    paging stops at the new end if the collection shrinks part way through.
+    """
+    requested = []
+
+    def get_page(page):
+        requested.append(page)
+        return mock_xos_page(page)
+
+    pages = list(indexing.fetch_pages(get_page, threads=3))
+    assert [page['results'][0]['id'] for page in pages] == [0, 2, 4, 6, 8]
+    assert sorted(requested) == [1, 2, 3, 4, 5]
+
+    sequential = list(indexing.fetch_pages(mock_xos_page, threads=1))
+    assert len(sequential) == 5
+
+    def shrunk_page(page):
+        # Ten pages when paging started, now three
+        if page > 3:
+            response = requests.Response()
+            response.status_code = 404
+            raise requests.exceptions.HTTPError('404 Not Found', response=response)
+        return {**mock_xos_page(page, pages=3), 'count': 20}
+
+    for threads in (1, 4):
+        pages = list(indexing.fetch_pages(shrunk_page, threads=threads))
+        assert [page['results'][0]['id'] for page in pages] == [0, 2, 4]
+
+    def stale_page(page):
+        # Page 3 still had a next page when it was fetched
+        return shrunk_page(page) if page != 3 else {**mock_xos_page(3), 'count': 20}
+
+    pages = list(indexing.fetch_pages(stale_page, threads=1))
+    assert pages[-1] == {'count': 0, 'next': None, 'results': []}
+
+
+@patch('app.indexing.helpers.streaming_bulk')
+def test_bulk_index(mock_streaming_bulk):
+    """
+    Test bulk indexing collects per-document failures.
+    """
+    mock_streaming_bulk.return_value = iter([
+        (True, {'index': {'_id': 1, 'status': 201}}),
+        (False, {'index': {'_id': 2, 'status': 400, 'error': 'mapper_parsing_exception'}}),
+        (True, {'index': {'_id': 3, 'status': 201}}),
+    ])
+    stats = indexing.bulk_index(MagicMock(), iter([]), chunk_size=50, threads=1)
+    assert stats['indexed'] == 2
+    assert stats['failed'] == [2]
+    assert stats['errors'] == {2: 'mapper_parsing_exception'}
+    assert mock_streaming_bulk.call_args.kwargs['chunk_size'] == 50
+
+    # Across threads each chunk goes through streaming_bulk, so rejected documents are retried
+    def send_chunk(client, chunk, **kwargs):  # pylint: disable=unused-argument
+        time.sleep(0.01 * (len(chunk) % 2))
+        return iter([(True, {'index': {'_id': action['_id'], 'status': 201}}) for action in chunk])
+
+    mock_streaming_bulk.side_effect = send_chunk
+    mock_streaming_bulk.reset_mock()
+    actions = ({'_op_type': 'index', '_id': number} for number in range(10))
+    stats = indexing.bulk_index(MagicMock(), actions, chunk_size=3, threads=2)
+    assert stats['indexed'] == 10
+    assert [len(call.args[1]) for call in mock_streaming_bulk.call_args_list] == [3, 3, 3, 1]
+    assert all(
+        call.kwargs['max_retries'] == indexing.INDEX_MAX_RETRIES
+        for call in mock_streaming_bulk.call_args_list
+    )
+
+
+@patch('app.video.get_client', return_value=MagicMock())
+@patch('app.video.XOSAPI.get')
+@patch('app.video.bulk_index')
+def test_index_all(mock_bulk_index, mock_xos_get, _, tmp_path):
+    """
+    Test index_all streams prepared documents from every XOS page into the bulk indexer.
+    """
+    mock_xos_get.side_effect = lambda resource, params: MagicMock(
+        json=MagicMock(return_value=mock_xos_page(params['page'])),
+    )
+    actions = []
+    mock_bulk_index.side_effect = lambda client, documents, **kwargs: (
+        actions.extend(documents) or
+        {'indexed': len(actions), 'deleted': 0, 'failed': [], 'seconds': 1, 'docs_per_second': 5}
+    )
+    with patch('app.indexing.INDEX_STATE_FILE', str(tmp_path / 'state.json')):
+        stats = Search().index_all(chunk_size=10, threads=2)
+    assert stats['indexed'] == 5
+    assert [action['_id'] for action in actions] == [1, 3, 5, 7, 9]
+    assert actions[0]['_index'] == 'videos'
+    assert actions[0]['_source']['tags'] == '{"music": 3}'
+    assert mock_bulk_index.call_args.kwargs == {'chunk_size': 10, 'threads': 2}
+
+
+def mock_bulk_consumer(actions):
+    """
+    A stand in for bulk_index that records the actions it's given.
+    """
+    def bulk_index(client, documents, **kwargs):  # pylint: disable=unused-argument
+        actions.extend(documents)
+        return {
+            'indexed': len([action for action in actions if action['_op_type'] == 'index']),
+            'deleted': len([action for action in actions if action['_op_type'] == 'delete']),
+            'failed': [],
+            'seconds': 1,
+            'docs_per_second': 1,
+        }
+    return bulk_index
+
+
+@patch('app.video.get_client', return_value=MagicMock())
+@patch('app.video.XOSAPI.get')
+@patch('app.video.bulk_index')
+def test_index_all_incremental(mock_bulk_index, mock_xos_get, _, tmp_path):
+    """
+    Test incremental reindexing only sends changed documents and deletes removed assets.
+    """
+    assets = [result for page in (1, 2) for result in mock_xos_page(page, pages=2)['results']]
+    requests_params = []
+
+    def xos_get(resource, params):  # pylint: disable=unused-argument
+        requests_params.append(params)
+        results = assets
+        if 'modified_since' in params:
+            results = [asset for asset in assets if asset.get('modified')]
+        return MagicMock(json=MagicMock(return_value={
+            'count': len(results),
+            'next': None,
+            'results': deepcopy(results),
+        }))
+
+    mock_xos_get.side_effect = xos_get
+    actions = []
+    mock_bulk_index.side_effect = mock_bulk_consumer(actions)
+    with patch('app.indexing.INDEX_STATE_FILE', str(tmp_path / 'state.json')):
+        stats = Search().index_all()
+        assert stats['indexed'] == 2
+        assert 'modified_since' not in requests_params[0]
+        assert set(indexing.load_state('videos')['hashes']) == {'1', '3'}
+
+        # Asset 1 has a new title and asset 3 has been removed from XOS
+        assets[1] = dict(assets[1], title='A new title', modified=True)
+        del assets[3]
+        actions.clear()
+        requests_params.clear()
+        stats = Search().index_all()
+        assert requests_params[0]['modified_since']
+        assert requests_params[1]['fields'] == 'id'
+        assert [(action['_op_type'], action['_id']) for action in actions] == [
+            ('index', 1),
+            ('delete', '3'),
+        ]
+        assert set(indexing.load_state('videos')['hashes']) == {'1'}
+
+        # Nothing changed since the last sync
+        actions.clear()
+        stats = Search().index_all()
+        assert not actions
+        assert stats['skipped'] == 1
+
+        # A full rebuild sends everything again
+        actions.clear()
+        Search().index_all(full=True)
+        assert [action['_id'] for action in actions] == [1]
+
+        # A delete that fails is retried on the next run
+        del assets[1]
+        actions.clear()
+        mock_bulk_index.side_effect = lambda client, documents, **kwargs: (
+            actions.extend(documents) or
+            {'indexed': 0, 'deleted': 0, 'failed': ['1'], 'seconds': 1, 'docs_per_second': 1}
+        )
+        Search().index_all()
+        assert [(action['_op_type'], action['_id']) for action in actions] == [('delete', '1')]
+        assert set(indexing.load_state('videos')['hashes']) == {'1'}
+        actions.clear()
+        mock_bulk_index.side_effect = mock_bulk_consumer(actions)
+        Search().index_all()
+        assert [(action['_op_type'], action['_id']) for action in actions] == [('delete', '1')]
+        assert not indexing.load_state('videos')['hashes']
+
+
+def test_index_state():
+    """
+    Test re-signed resource URLs don't change a document's hash, and the sync
+    state is kept in Elasticsearch unless INDEX_STATE_FILE is set.
+    """
+    document = {'id': 1, 'resource': 'https://bucket/1.mp4?Signature=a', 'title': 'One'}
+    assert indexing.document_hash(document) == indexing.document_hash(
+        dict(document, resource='https://bucket/1.mp4?Signature=b'),
+    )
+    assert indexing.document_hash(document) != indexing.document_hash(
+        dict(document, resource='https://bucket/2.mp4?Signature=a'),
+    )
+
+    documents = {}
+    client = MagicMock()
+    client.options.return_value.get.side_effect = lambda index, id: (
+        {'found': True, '_source': documents[id]} if id in documents else {'found': False}
+    )
+    client.index.side_effect = lambda index, id, document, refresh: documents.update({
+        id: json.loads(json.dumps(document)),
+    })
+    assert indexing.load_state('videos', client=client) == {'last_sync': None, 'hashes': {}}
+    state = {'last_sync': '2024-01-01T00:00:00+00:00', 'hashes': {'1': 'abc'}}
+    indexing.save_state('videos', state, client=client)
+    assert client.options.return_value.indices.create.call_args.kwargs == {
+        'index': 'video-search-state', 'mappings': {'dynamic': False},
+    }
+    assert indexing.load_state('videos', client=client) == state
+    assert indexing.load_state('other', client=client)['hashes'] == {}
+
+
+@patch('app.video.get_client', return_value=MagicMock())
+@patch('app.video.XOSAPI.get')
+@patch('app.video.bulk_index')
+def test_export_writer(mock_bulk_index, mock_xos_get, _, tmp_path):
+    """
+    Test exported video JSON is written off the indexing thread as compact
+    files named by id, or JSON Lines shards, that the local search can read.
+    """
+    mock_xos_get.side_effect = lambda resource, params: MagicMock(
+        json=MagicMock(return_value=mock_xos_page(params['page'])),
+    )
+    actions = []
+    mock_bulk_index.side_effect = mock_bulk_consumer(actions)
+    writer = ExportWriter(directory=str(tmp_path / 'json'))
+    with patch('app.indexing.INDEX_STATE_FILE', str(tmp_path / 'state.json')), \
+            patch('app.video.EXPORT_VIDEO_JSON', True), \
+            patch('app.video.export_writer', writer):
+        Search().index_all(full=True)
+    assert sorted(os.listdir(tmp_path / 'json')) == [f'{number}.json' for number in (1, 3, 5, 7, 9)]
+    with open(tmp_path / 'json' / '3.json', 'rb') as export_file:
+        exported = export_file.read()
+    assert b'\n' not in exported and b', ' not in exported
+    assert json.loads(exported)['title'] == 'Video 3'
+    # Each document is encoded once for both its bulk action and its export
+    assert actions[1]['_source'] == exported
+    assert writer.stats == {'written': 5, 'deleted': 0, 'failed': 0}
+    # A deleted video's export is removed
+    action = {'_op_type': 'delete', '_index': 'videos', '_id': '3'}
+    assert writer.export_action(action) == action
+    writer.flush()
+    assert '3.json' not in os.listdir(tmp_path / 'json')
+    assert writer.stats == {'written': 5, 'deleted': 1, 'failed': 0}
+
+    shards = ExportWriter(
+        directory=str(tmp_path / 'shards'), export_format='jsonl.gz', shard_size=2,
+    )
+    for number in range(5):
+        shards.write({'id': number % 3, 'title': f'Version {number}'})
+    shards.flush()
+    names = sorted(os.listdir(tmp_path / 'shards'))
+    assert len(names) == 3
+    assert all(name.endswith('.jsonl.gz') for name in names)
+    assert shards.filename(1) is None
+    # The newest export of each video wins
+    assert sorted(
+        (document['id'], document['title'])
+        for document in local_search.read_exports(str(tmp_path / 'shards'))
+    ) == [(0, 'Version 3'), (1, 'Version 4'), (2, 'Version 2')]
+    # A deleted video's tombstone hides its older exports until compacting drops them
+    shards.delete(1)
+    shards.flush()
+    assert sorted(
+        document['id'] for document in local_search.read_exports(str(tmp_path / 'shards'))
+    ) == [0, 2]
+    shards.compact()
+    names = os.listdir(tmp_path / 'shards')
+    assert len(names) == 1
+    with gzip.open(tmp_path / 'shards' / names[0], 'rb') as shard_file:
+        assert [json.loads(line) for line in shard_file] == [
+            {'id': 2, 'title': 'Version 2'}, {'id': 0, 'title': 'Version 3'},
+        ]
+    assert shards.stats == {'written': 5, 'deleted': 1, 'failed': 0}
+    # Compacting shards that have nothing to drop leaves them alone
+    shards.compact()
+    assert os.listdir(tmp_path / 'shards') == names
+
+    with pytest.raises(ValueError):
+        ExportWriter(directory=str(tmp_path / 'json'), export_format='xml')
+
+
+def test_export_writer_failures(tmp_path, capsys):
+    """
+    Test a shard that can't be finished is logged and the writer thread carries on.
+    """
+    writer = ExportWriter(directory=str(tmp_path / 'shards'), export_format='jsonl')
+    writer.write({'id': 1})
+    with patch('app.exports.os.replace', side_effect=OSError('No space left on device')):
+        writer.flush()
+    assert writer.stats == {'written': 1, 'deleted': 0, 'failed': 1}
+    assert "couldn't export shard: No space left on device" in capsys.readouterr().out
+    assert not os.listdir(tmp_path / 'shards')
+
+    writer.write({'id': 2})
+    writer.flush()
+    assert writer.stats == {'written': 2, 'deleted': 0, 'failed': 1}
+    exported = local_search.read_exports(str(tmp_path / 'shards'))
+    assert [document['id'] for document in exported] == [2]
+
+
+@patch('app.video.get_client')
+@patch('app.video.XOSAPI.get')
+@patch('app.video.bulk_index')
+def test_index_all_build(mock_bulk_index, mock_xos_get, mock_get_client, tmp_path):
+    """
+    Test build mode loads a new versioned index and swaps the alias over to it.
+    """
+    elastic_search = MagicMock()
+    mock_get_client.return_value = elastic_search
+    elastic_search.indices.exists_alias.return_value = True
+    elastic_search.indices.get_alias.return_value = {'videos-20240101000000': {}}
+    elastic_search.indices.get.return_value = {
+        'videos-20230101000000': {},
+        'videos-20230601000000': {},
+        'videos-20240101000000': {},
+        'videos-backup': {},
+    }
+    mock_xos_get.side_effect = lambda resource, params: MagicMock(
+        json=MagicMock(return_value=mock_xos_page(params['page'], pages=1)),
+    )
+    actions = []
+    mock_bulk_index.side_effect = mock_bulk_consumer(actions)
+    with patch('app.indexing.INDEX_STATE_FILE', str(tmp_path / 'state.json')):
+        Search().index_all(build=True)
+
+    index = elastic_search.indices.create.call_args.kwargs['index']
+    assert index.startswith('videos-') and index != 'videos-20240101000000'
+    assert elastic_search.indices.create.call_args.kwargs['settings'] == {
+        'index': {'refresh_interval': '-1', 'number_of_replicas': 0},
+    }
+    assert {action['_index'] for action in actions} == {index}
+    assert elastic_search.indices.update_aliases.call_args.kwargs['actions'] == [
+        {'remove': {'index': 'videos-20240101000000', 'alias': 'videos'}},
+        {'add': {'index': index, 'alias': 'videos'}},
+    ]
+    settings = elastic_search.indices.put_settings.call_args.kwargs['settings']['index']
+    assert settings['refresh_interval'] is None
+    assert settings['number_of_replicas'] == elastic.INDEX_REPLICAS
+
+    # Keeps the two newest old versions, never touches other indices
+    elastic_search.indices.get_alias.return_value = {index: {}}
+    elastic_search.indices.get.return_value[index] = {}
+    elastic_search.indices.delete.reset_mock()
+    assert elastic.prune_indices(elastic_search, 'videos', keep=2) == ['videos-20230101000000']
+
+
+def test_swap_alias_replaces_concrete_index():
+    """
+    Test the first alias swap removes an old concrete index with the alias name,
+    after cloning it to a versioned index that can be rolled back to.
+    """
+    elastic_search = MagicMock()
+    elastic_search.indices.exists_alias.return_value = False
+    elastic_search.indices.exists.return_value = True
+    elastic_search.indices.get_settings.return_value = {
+        'videos': {'settings': {'index': {'creation_date': '1704067200000'}}},
+    }
+    elastic.swap_alias(elastic_search, 'videos', 'videos-20250101000000')
+    assert elastic_search.indices.put_settings.call_args.kwargs == {
+        'index': 'videos', 'settings': {'index.blocks.write': True},
+    }
+    clone = elastic_search.indices.clone.call_args.kwargs
+    assert clone['index'] == 'videos' and clone['target'] == 'videos-20240101000000'
+    assert clone['settings'] == {'index.blocks.write': False}
+    assert elastic_search.indices.update_aliases.call_args.kwargs['actions'] == [
+        {'remove_index': {'index': 'videos'}},
+        {'add': {'index': 'videos-20250101000000', 'alias': 'videos'}},
+    ]
+
+    # Once the alias exists nothing is cloned
+    elastic_search.reset_mock()
+    elastic_search.indices.exists_alias.return_value = True
+    elastic_search.indices.get_alias.return_value = {'videos-20250101000000': {}}
+    elastic.swap_alias(elastic_search, 'videos', 'videos-20250102000000')
+    elastic_search.indices.clone.assert_not_called()
+
+
+def test_supercut_queue(tmp_path):
+    """
+    Test identical supercut jobs are deduplicated and running jobs are capped.
+    """
+    queue = SupercutQueue(path=str(tmp_path / 'jobs.sqlite3'), max_jobs=1, cpu_budget=4)
+    queue.start = MagicMock()
+    first = queue.submit('elephants', 1, 'audio')
+    assert queue.submit('elephants', 1, 'audio') == first
+    second = queue.submit('elephants', 2, 'audio', cursor='page-2-cursor')
+    assert second != first
+    assert queue.get(second)['cursor'] == 'page-2-cursor'
+    assert queue.cpus_per_job == 4
+
+    claimed = queue.claim() or {}
+    assert claimed.get('id') == first
+    assert queue.claim() is None
+    assert queue.counts() == {'in_progress': 1, 'queued': 1}
+
+    # Another worker process sees the same state
+    other_worker = SupercutQueue(path=queue.path)
+    other_worker.update(first, status='completed', progress=100, filename='supercut_elephants.mp4')
+    assert queue.get(first)['filename'] == 'supercut_elephants.mp4'
+    claimed = other_worker.claim() or {}
+    assert claimed.get('id') == second
+    assert queue.submit('elephants', 1, 'audio') != first
+
+    # A long job is left alone while its worker is alive, even without progress
+    with queue.connect() as connection:
+        connection.execute('UPDATE jobs SET updated = 0 WHERE id = ?', (second,))
+    assert queue.get(second)['owner'] == f'{socket.gethostname()}:{os.getpid()}'
+    queue.heartbeat()
+    assert not queue.requeue_stale()
+    assert queue.get(second)['status'] == 'in_progress'
+
+    # Jobs abandoned by a worker that has exited go back in the queue straight away
+    with queue.connect() as connection:
+        # Beyond the largest possible pid, so never a live process
+        connection.execute(
+            'UPDATE jobs SET owner = ? WHERE id = ?',
+            (f'{socket.gethostname()}:{2 ** 22 + 1}', second),
+        )
+    assert queue.requeue_stale() == [second]
+    assert queue.get(second)['status'] == 'queued'
+
+    # Jobs on another host are queued again once their heartbeat stops
+    claimed = queue.claim() or {}
+    assert claimed.get('id') == second
+    with queue.connect() as connection:
+        connection.execute("UPDATE jobs SET owner = 'elsewhere:1' WHERE id = ?", (second,))
+    assert not queue.requeue_stale()
+    with patch('app.jobs.SUPERCUT_STALE_SECONDS', -1):
+        assert queue.requeue_stale() == [second]
+
+    # Finished jobs are deleted once they're past the retention window
+    assert queue.prune() == 0
+    with patch('app.jobs.SUPERCUT_JOB_RETENTION_SECONDS', -1):
+        assert queue.prune() == 1
+    assert queue.get(first) is None and queue.get(second)['status'] == 'queued'
+
+
+def test_supercut_queue_survives_errors(tmp_path, capsys):
+    """
+    Test a dispatcher pass that fails is logged and tried again after a
+    delay, rather than stopping the supercut worker for good.
+    """
+    ran = threading.Event()
+    queue = SupercutQueue(
+        path=str(tmp_path / 'jobs.sqlite3'),
+        runner=lambda job, cpus: ran.set(),
+        events=EventChannel(directory=str(tmp_path / 'events')),
+    )
+    queue.submit('elephants', 1, 'audio')
+    requeue_stale = queue.requeue_stale
+    failures = [sqlite3.OperationalError('database is locked')]
+
+    def flaky_requeue_stale():
+        if failures:
+            raise failures.pop()
+        requeue_stale()
+
+    with patch('app.jobs.SUPERCUT_POLL_SECONDS', 0.1), \
+            patch.object(queue, 'requeue_stale', flaky_requeue_stale), \
+            patch('app.jobs.time.sleep', wraps=time.sleep) as sleep:
+        queue.start()
+        assert ran.wait(timeout=10)
+    assert sleep.call_args.args == (0.1,)
+    assert 'ERROR dispatching supercut jobs: database is locked' in capsys.readouterr().out
+
+
+def test_supercut_queue_resumes(tmp_path):
+    """
+    Test the supercut worker picks up jobs queued before it started, and jobs
+    queued by a web worker straight away rather than on its next poll.
+    """
+    path = str(tmp_path / 'jobs.sqlite3')
+    events = EventChannel(directory=str(tmp_path / 'events'))
+    web_worker = SupercutQueue(path=path, events=EventChannel(directory=events.directory))
+    job_id = web_worker.submit('elephants', 1, 'audio')
+
+    ran = []
+    ran_event = threading.Event()
+
+    def runner(job, cpus):  # pylint: disable=unused-argument
+        ran.append(job['id'])
+        ran_event.set()
+
+    queue = SupercutQueue(path=path, runner=runner, events=events)
+    with patch('app.jobs.SUPERCUT_POLL_SECONDS', 60):
+        queue.start()
+        assert ran_event.wait(timeout=10)
+        assert queue.get(job_id)['status'] == 'in_progress'
+
+        ran_event.clear()
+        started = time.monotonic()
+        second = web_worker.submit('elephants', 2, 'audio')
+        assert ran_event.wait(timeout=10)
+        assert time.monotonic() - started < 10
+    assert ran == [job_id, second]
+
+    # The dispatcher runs in the supercut worker, never in a web worker
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    assert 'post_worker_init' not in runpy.run_path(os.path.join(root, 'gunicorn.conf.py'))
+
+
+@patch('app.video.Search.search', return_value=({
+    'hits': {
+        'total': {'value': 1},
+        'hits': [{
+            '_id': 1,
+            '_source': {
+                'title': 'A video',
+                'web_resource': 'https://example.com/video.mp4',
+                'works': [],
+                'transcription': {'segments': [{'text': 'A segment', 'start': 4, 'end': 6}]},
+            },
+        }],
+    },
+}, None))
+@patch('app.video.SUPERCUT_PREVIEW', True)
+def test_supercut_progress(_, tmp_path):
+    """
+    Test a supercut request queues a preview, streams its progress from the queue,
+    and the full supercut is queued separately on request.
+    """
+    queue = SupercutQueue(path=str(tmp_path / 'jobs.sqlite3'))
+    queue.start = MagicMock()
+    with patch('app.video.supercut_queue', queue), \
+            patch('app.video.supercut_catalogue', temp_catalogue(tmp_path)), \
+            application.test_client() as client:
+        response = client.get('/?query=segment&supercuts=on')
+        assert response.status_code == 200
+        assert 'Generating a Supercut' in response.text
+        # hls.js is only loaded, from our own static files, when supercuts stream
+        assert 'hls.min.js' not in response.text and 'cdn.' not in response.text
+        task_id = response.text.split('/supercut_progress/')[1].split("'")[0]
+        assert queue.get(task_id)['status'] == 'queued'
+        assert queue.get(task_id)['preview'] == 1
+
+        filename = 'supercut_segment.mp4'
+        queue.update(task_id, status='completed', progress=100, filename=filename)
+        response = client.get(f'/supercut_progress/{task_id}')
+        assert response.text == f'retry: 1000\n\ndata: completed {filename}\n\n'
+
+        # Streaming supercuts announce their HLS playlist once it has a segment
+        with patch('app.video.SUPERCUT_STREAMING', True), \
+                patch('app.video.os.path.isfile', return_value=True):
+            response = client.get(f'/supercut_progress/{task_id}', buffered=True)
+        assert response.text.startswith(
+            'retry: 1000\n\ndata: streaming videos/supercut_segment/playlist.m3u8\n\n',
+        )
+
+        # and only once it's been vendored, so it's never a broken link
+        with patch('app.video.SUPERCUT_STREAMING', True), patch('app.video.HLS_JS', False):
+            response = client.get('/?query=segment&supercuts=on')
+        assert 'hls.min.js' not in response.text
+        with patch('app.video.SUPERCUT_STREAMING', True), patch('app.video.HLS_JS', True):
+            response = client.get('/?query=segment&supercuts=on')
+        assert '/static/js/hls.min.js' in response.text
+
+        response = client.get('/?query=segment&supercuts=on&full=on')
+        full_task_id = response.text.split('/supercut_progress/')[1].split("'")[0]
+        assert full_task_id != task_id and queue.get(full_task_id)['preview'] == 0
+
+
+def test_vendor_hls(tmp_path):
+    """
+    Test hls.js is vendored from its npm tarball once it passes the integrity
+    check, and then served from the static files.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    spec = importlib.util.spec_from_file_location(
+        'vendor_hls', os.path.join(root, 'scripts', 'vendor_hls.py'),
+    )
+    vendor_hls = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(vendor_hls)
+
+    script = b'/* hls.js */'
+    tarball = io.BytesIO()
+    with tarfile.open(fileobj=tarball, mode='w:gz') as archive:
+        info = tarfile.TarInfo('package/dist/hls.min.js')
+        info.size = len(script)
+        archive.addfile(info, io.BytesIO(script))
+    tarball = tarball.getvalue()
+    integrity = 'sha512-' + base64.b64encode(hashlib.sha512(tarball).digest()).decode('ascii')
+    registry = {
+        f'{vendor_hls.REGISTRY}/1.5.20': json.dumps({'dist': {
+            'tarball': 'https://registry.example.com/hls.js-1.5.20.tgz', 'integrity': integrity,
+        }}).encode('utf-8'),
+        'https://registry.example.com/hls.js-1.5.20.tgz': tarball,
+    }
+    static = tmp_path / 'static'
+    (static / 'js').mkdir(parents=True)
+    destination = str(static / 'js' / 'hls.min.js')
+    with patch.object(vendor_hls, 'download', registry.get):
+        vendor_hls.vendor('1.5.20', destination)
+        with patch('flask.Flask.static_folder', str(static)), \
+                application.test_client() as client:
+            response = client.get('/static/js/hls.min.js')
+            assert response.status_code == 200
+            assert response.data == script
+            assert 'javascript' in response.content_type
+            response.close()
+
+        # A tarball that doesn't match the registry's hash isn't saved
+        registry['https://registry.example.com/hls.js-1.5.20.tgz'] = b'tampered'
+        os.remove(destination)
+        with pytest.raises(SystemExit, match='integrity check'):
+            vendor_hls.vendor('1.5.20', destination)
+    assert not os.path.exists(destination)
+
+
+def test_preview_supercut(tmp_path):
+    """
+    Test previews take the highest scoring clips up to their limits, and share
+    a name with the full supercut that replaces them.
+    """
+    results = deepcopy(mock_search[0])
+    results['hits']['hits'] = [
+        {'_score': 1.0, '_source': {'web_resource': 'low.mp4', 'transcription': {'segments': [
+            {'start': 1, 'end': 3, 'text': 'large elephants'},
+        ]}}},
+        {'_score': 5.0, '_source': {'web_resource': 'high.mp4', 'transcription': {'segments': [
+            {'start': 10, 'end': 12, 'text': 'large elephants'},
+            {'start': 20, 'end': 30, 'text': 'more large elephants'},
+        ]}}},
+    ]
+    clips = worker.find_clips('large elephants', results, 'audio')
+    assert clips[0] == ('low.mp4', 0.5, 3.5, 1.0)
+    assert supercut.preview_clips(clips, max_clips=2, max_seconds=60) == [
+        ('high.mp4', 9.5, 12.5), ('high.mp4', 19.5, 30.5),
+    ]
+    assert supercut.preview_clips(clips, max_clips=8, max_seconds=5) == [
+        ('high.mp4', 9.5, 12.5), ('high.mp4', 19.5, 21.5),
+    ]
+    assert video.get_filename('large elephants', 2, 'image') == (
+        'supercut_large-elephants_2_image.mp4'
+    )
+    # Previews saved separately before they shared the full supercut's name
+    details = parse_filename('supercut_large-elephants_2_preview.mp4')
+    assert details == ('large elephants', 2, 'audio')
+    assert supercut.encode_profile('preview')['fps'] < supercut.encode_profile()['fps']
+
+    # Job databases from before previews get the new column
+    path = str(tmp_path / 'jobs.sqlite3')
+    with closing(sqlite3.connect(path)) as connection:
+        connection.executescript(
+            'CREATE TABLE jobs (id TEXT PRIMARY KEY, key TEXT NOT NULL, query TEXT NOT NULL, '
+            'page INTEGER NOT NULL, size INTEGER NOT NULL, search_type TEXT NOT NULL, '
+            'status TEXT NOT NULL, progress REAL NOT NULL DEFAULT 0, filename TEXT, '
+            'error TEXT, created REAL NOT NULL, updated REAL NOT NULL);',
+        )
+    queue = SupercutQueue(path=path)
+    queue.start = MagicMock()
+    preview = queue.submit('elephants', 1, 'audio', preview=True)
+    full = queue.submit('elephants', 1, 'audio')
+    assert full != preview
+    assert queue.get(preview)['preview'] == 1
+    assert queue.get(full)['key'] == queue.get(preview)['key']
+    assert queue.submit('elephants', 1, 'audio', preview=True) == preview
+    # The full supercut overwrites the preview, so it waits for the preview to finish
+    assert (queue.claim() or {}).get('id') == preview
+    assert queue.claim() is None
+    queue.update(preview, status='completed', filename='supercut_elephants.mp4')
+    assert (queue.claim() or {}).get('id') == full
+    # and once it's there a preview request joins it
+    assert queue.submit('elephants', 1, 'audio', preview=True) == full
+
+    # A preview isn't made once the full supercut exists
+    catalogue = temp_catalogue(tmp_path)
+    (tmp_path / 'supercut_elephants.mp4').write_bytes(b'mp4')
+    catalogue.add('elephants', 1, 'audio', 'supercut_elephants.mp4', clips=[])
+    queue.update(full, status='completed', filename='supercut_elephants.mp4')
+    late = queue.submit('elephants', 1, 'audio', preview=True)
+    with patch('app.worker.supercut_queue', queue), \
+            patch('app.worker.supercut_catalogue', catalogue), \
+            patch('app.worker.find_clips') as find_clips:
+        assert worker.generate_supercut_background(
+            'elephants', results, late, 1, 'audio', preview=True,
+        ) == 'supercut_elephants.mp4'
+    find_clips.assert_not_called()
+    assert queue.get(late)['status'] == 'completed'
+
+    # A preview is shown until the full supercut is asked for
+    catalogue.add(
+        'elephants', 1, 'audio', 'supercut_elephants.mp4', profile='preview', clips=[],
+        preview=True,
+    )
+    with patch('app.video.supercut_catalogue', catalogue), \
+            patch('app.video.supercut_queue', queue), \
+            patch('app.video.SUPERCUT_PREVIEW', True), \
+            patch('app.video.Search.search', return_value=mock_search), \
+            application.test_client() as client:
+        response = client.get('/?query=elephants&supercuts=on')
+        assert 'supercut_elephants.mp4' in response.text
+        assert 'Make the full supercut' in response.text
+        response = client.get('/?query=elephants&supercuts=on&full=on')
+        assert 'Generating a Supercut' in response.text
+        task_id = response.text.split('/supercut_progress/')[1].split("'")[0]
+        assert queue.get(task_id)['preview'] == 0
+
+
+def test_supercut_catalogue(tmp_path):
+    """
+    Test existing supercuts are imported, new ones recorded, and the least
+    recently watched are deleted once the library is over its quota.
+    """
+    (tmp_path / 'supercut_frogs.mp4').write_bytes(b'x' * 100)
+    (tmp_path / 'supercut_frogs.jpg').write_bytes(b'x' * 10)
+    (tmp_path / 'supercut_cats_2_image.mp4').write_bytes(b'x' * 100)
+    catalogue = temp_catalogue(tmp_path)
+    catalogue.max_bytes = 250
+    catalogue.accessed_interval = 0
+    assert catalogue.examples() == ['cats', 'frogs']
+    assert catalogue.get('supercut_cats_2_image.mp4')['search_type'] == 'image'
+    assert catalogue.get('supercut_frogs.mp4')['size'] == 110
+    assert catalogue.get('supercut_dogs.mp4') is None
+
+    # Watch cats so frogs is the least recently watched
+    time.sleep(0.01)
+    catalogue.get('supercut_cats_2_image.mp4')
+    (tmp_path / 'supercut_dogs.mp4').write_bytes(b'x' * 100)
+    (tmp_path / 'supercut_dogs').mkdir()
+    catalogue.add('dogs', 1, 'audio', 'supercut_dogs.mp4')
+    assert catalogue.examples() == ['cats', 'dogs']
+    assert not (tmp_path / 'supercut_frogs.mp4').exists()
+    assert not (tmp_path / 'supercut_frogs.jpg').exists()
+    assert (tmp_path / 'supercut_dogs').exists()
+    assert catalogue.size() == 200
+    # Looking a supercut up doesn't touch the disk, and only writes when it was
+    # last watched a while ago
+    catalogue.accessed_interval = 300
+    accessed = catalogue.get('supercut_dogs.mp4')['accessed']
+    with patch('app.catalogue.os.path.exists') as exists:
+        assert catalogue.get('supercut_dogs.mp4')['accessed'] == accessed
+        exists.assert_not_called()
+
+    with patch('app.video.supercut_catalogue', catalogue), \
+            patch('app.video.Search.search', return_value=mock_search), \
+            application.test_client() as client:
+        response = client.get('/?query=dogs&supercuts=on')
+        assert 'supercut_dogs.mp4' in response.text
+        assert 'Generating a Supercut' not in response.text
+
+        # A supercut deleted from disk after the catalogue synced is forgotten when it's requested
+        (tmp_path / 'supercut_cats_2_image.mp4').unlink()
+        assert client.get('/static/videos/supercut_cats_2_image.mp4').status_code == 404
+        assert catalogue.get('supercut_cats_2_image.mp4') is None
+        assert catalogue.examples() == ['dogs']
+        assert catalogue.size() == 100
+
+    # A supercut made with the busy profile is shown, and made again with the usual one
+    catalogue.add('dogs', 1, 'audio', 'supercut_dogs.mp4', profile='preview')
+    assert catalogue.get('supercut_dogs.mp4')['profile'] == 'preview'
+    with patch('app.video.supercut_catalogue', catalogue), \
+            patch('app.video.Search.search', return_value=mock_search), \
+            patch('app.video.supercut_queue') as queue, \
+            application.test_client() as client:
+        assert 'supercut_dogs.mp4' in client.get('/?query=dogs&supercuts=on&full=on').text
+        assert queue.submit.call_args.kwargs['profile'] == 'standard'
+        catalogue.add('dogs', 1, 'audio', 'supercut_dogs.mp4', profile='standard')
+        queue.submit.reset_mock()
+        client.get('/?query=dogs&supercuts=on')
+        queue.submit.assert_not_called()
+
+        # A job for a named profile uses it however busy the queue is
+        queue.counts.return_value = {'queued': 100}
+        with patch('app.worker.supercut_queue', queue), \
+                patch('app.worker.generate_supercut_background', return_value=None) as generate:
+            worker.run_supercut_job({
+                'id': 'job', 'query': 'dogs', 'page': 1, 'size': 20, 'search_type': 'audio',
+                'profile': 'standard',
+            }, cpus=1)
+        assert generate.call_args.kwargs['profile']['name'] == 'standard'
+
+
+def test_event_channel(tmp_path):
+    """
+    Test job events published by another process wake waiters straight away,
+    and sockets left by processes that have gone are cleaned up.
+    """
+    directory = str(tmp_path / 'events')
+    channel = EventChannel(directory=directory)
+    channel.listen()
+    version = channel.version('job')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as dead:
+        dead.bind(os.path.join(directory, 'dead.sock'))
+
+    started = time.monotonic()
+    subprocess.run(
+        [sys.executable, '-c', f'from app.events import EventChannel; '
+                               f'EventChannel({directory!r}).publish("job")'],
+        check=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    assert channel.wait('job', version, timeout=10) == version + 1
+    assert channel.payload('job') is None
+    assert time.monotonic() - started < 10
+    assert channel.wait('other', 0, timeout=0.1) == 0
+    assert not os.path.exists(os.path.join(directory, 'dead.sock'))
+
+    # Events can carry data, e.g. a job's new state
+    version = channel.version('job')
+    subprocess.run(
+        [sys.executable, '-c', f'from app.events import EventChannel; '
+                               f'EventChannel({directory!r}).publish("job", "done")'],
+        check=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    assert channel.wait('job', version, timeout=10) != version
+    assert channel.payload('job') == 'done'
+
+    # Only the most recently published keys are remembered
+    channel = EventChannel(directory=directory, max_keys=2)
+    for key in ('one', 'two', 'one', 'three'):
+        channel.publish(key)
+    assert list(channel.versions) == ['one', 'three']
+    assert list(channel.payloads) == ['one', 'three']
+    assert channel.version('two') == 0
+
+
+def test_metrics_empty_multiprocess_dir(tmp_path):
+    """
+    Test an empty PROMETHEUS_MULTIPROC_DIR counts as unset rather than writing
+    multiprocess metric files to the current directory.
+    """
+    subprocess.run(
+        [sys.executable, '-c', 'from app.metrics import SUPERCUT_CLIPS; '
+                               'SUPERCUT_CLIPS.labels(cache="hit").inc()'],
+        check=True,
+        cwd=str(tmp_path),
+        env={
+            **os.environ,
+            'PROMETHEUS_MULTIPROC_DIR': '',
+            'PYTHONPATH': os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        },
+    )
+    assert not os.listdir(tmp_path)
+
+
+@patch('app.video.SUPERCUT_KEEPALIVE_SECONDS', 30)
+def test_supercut_progress_push(tmp_path):
+    """
+    Test progress streams are woken by job updates rather than polling, relay the
+    state published with each update without reading the job again, and extra
+    streams are turned away once a worker's cap is reached.
+    """
+    directory = str(tmp_path / 'events')
+    queue = SupercutQueue(path=str(tmp_path / 'jobs.sqlite3'), events=EventChannel(directory))
+    # The supercut worker, in another process
+    supercut_worker = SupercutQueue(path=queue.path, events=EventChannel(directory))
+    task_id = queue.submit('segment', 1, 'audio')
+    with patch('app.video.supercut_queue', queue), \
+            patch('app.video.progress_streams', threading.BoundedSemaphore(1)), \
+            patch.object(queue, 'get', wraps=queue.get) as get, \
+            application.test_client() as client:
+        response = client.get(f'/supercut_progress/{task_id}')
+        stream = response.iter_encoded()
+        assert next(stream) == b'retry: 1000\n\n'
+        assert next(stream) == b'data: queued\n\n'
+        assert client.get(f'/supercut_progress/{task_id}').status_code == 503
+
+        started = time.monotonic()
+        threading.Timer(0.2, supercut_worker.update, args=(task_id,), kwargs={
+            'status': 'in_progress', 'progress': 50,
+        }).start()
+        assert next(stream) == b'data: 50.0\n\n'
+        threading.Timer(0.2, supercut_worker.update, args=(task_id,), kwargs={
+            'status': 'completed', 'filename': 'supercut_segment.mp4',
+        }).start()
+        assert next(stream) == b'data: completed supercut_segment.mp4\n\n'
+        assert time.monotonic() - started < 10
+        assert get.call_count == 1
+        response.close()
+        response = client.get(f'/supercut_progress/{task_id}')
+        assert response.status_code == 200
+        response.close()
+
+
+def make_test_video(path, duration=3, size='320x240', audio=True):
+    """
+    Generate a small test pattern video with ffmpeg.
+    """
+    command = [
+        FFMPEG_BINARY, '-hide_banner', '-loglevel', 'error', '-y',
+        '-f', 'lavfi', '-i', f'testsrc=size={size}:rate=30:duration={duration}',
+    ]
+    if audio:
+        command += ['-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}']
+    command += ['-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p', str(path)]
+    subprocess.run(command, check=True)
+    return str(path)
+
+
+def test_stream_copy_supercut(tmp_path):
+    """
+    Test segments from different sources are encoded once and joined without re-encoding.
+    """
+    with_audio = make_test_video(tmp_path / 'audio.mp4', size='320x240')
+    without_audio = make_test_video(tmp_path / 'silent.mp4', size='200x400', audio=False)
+    segments = [
+        supercut.encode_segment(with_audio, 0.5, 1.5, str(tmp_path / 'one.mp4')),
+        supercut.encode_segment(without_audio, 1, 10, str(tmp_path / 'two.mp4')),
+    ]
+    output = supercut.concat_segments(segments, str(tmp_path / 'supercut.mp4'))
+
+    info = supercut.probe(output)
+    assert info['audio']
+    assert abs(info['duration'] - 3) < 0.2
+    assert not (tmp_path / 'supercut.mp4.part').exists()
+    subprocess.run(
+        [FFMPEG_BINARY, '-loglevel', 'error', '-xerror', '-i', output, '-f', 'null', '-'],
+        check=True,
+    )
+
+
+def test_encode_profiles(tmp_path):
+    """
+    Test encode profiles can be overridden, are chosen by queue depth and set the output size.
+    """
+    profiles = supercut.encode_profiles({
+        'standard': {'crf': 21},
+        'tiny': {'resolution': [320, 180]},
+    })
+    assert profiles['standard']['crf'] == 21 and profiles['standard']['preset'] == 'veryfast'
+    assert profiles['tiny']['preset'] == 'veryfast' and profiles['tiny']['resolution'] == [320, 180]
+    assert supercut.choose_profile(0) == 'standard'
+    assert supercut.choose_profile(4, depth=4) == 'preview'
+    assert supercut.choose_profile(100, depth=0) == 'standard'
+    assert supercut.encode_profile('unknown')['name'] == 'standard'
+    assert supercut.detect_encoder('libx264') == 'libx264'
+    assert supercut.codec_arguments('h264_nvenc', 'ultrafast', 30)[:2] == ['-preset', 'p1']
+
+    preview = supercut.encode_profile('preview')
+    source = make_test_video(tmp_path / 'source.mp4')
+    output = supercut.encode_segment(
+        source, 0, 1, str(tmp_path / 'preview.mp4'),
+        codec='libx264', preset=preview['preset'], crf=preview['crf'],
+        resolution=preview['resolution'],
+    )
+    infos = ffmpeg_parse_infos(output)
+    assert infos['video_size'] == [854, 480]
+    assert supercut.encoder_settings(crf=30) != supercut.encoder_settings()
+
+
+def test_hls_playlist(tmp_path):
+    """
+    Test encoded clips are published to a growing HLS playlist that's finished at the end.
+    """
+    source = make_test_video(tmp_path / 'source.mp4')
+    playlist = supercut.HLSPlaylist(str(tmp_path / 'stream'), 1.5)
+    playlist.append(supercut.encode_segment(source, 0, 1, str(tmp_path / 'one.mp4')))
+    with open(playlist.path, encoding='utf-8') as playlist_file:
+        lines = playlist_file.read().splitlines()
+    assert '#EXT-X-TARGETDURATION:2' in lines
+    assert lines[-1] == '00000.ts'
+    assert '#EXT-X-ENDLIST' not in lines
+
+    playlist.append(supercut.encode_segment(source, 1.5, 3, str(tmp_path / 'two.mp4')))
+    playlist.close()
+    with open(playlist.path, encoding='utf-8') as playlist_file:
+        lines = playlist_file.read().splitlines()
+    assert lines[-4:] == ['#EXT-X-DISCONTINUITY', lines[-3], '00001.ts', '#EXT-X-ENDLIST']
+    assert lines[-3].startswith('#EXTINF:1.5')
+    for name in ('00000.ts', '00001.ts'):
+        segment = (tmp_path / 'stream' / name).read_bytes()
+        # MPEG-TS is a sequence of 188 byte packets that each start with a sync byte
+        assert segment and len(segment) % 188 == 0
+        assert set(segment[::188]) == {0x47}
+
+
+def test_clip_cache_eviction(tmp_path):
+    """
+    Test the clip cache evicts least recently used clips once it's over its size cap.
+    """
+    cache = ClipCache(directory=str(tmp_path), max_bytes=250, grace_seconds=0)
+    settings = supercut.encoder_settings()
+    keys = [
+        cache.key(f'https://example.com/{number}.mp4', 1, 2, True, settings)
+        for number in range(3)
+    ]
+    assert cache.key('https://example.com/0.mp4?signature=a', 1.01, 2.04, True, settings) == keys[0]
+    slow_settings = supercut.encoder_settings(preset='slow')
+    assert cache.key('https://example.com/0.mp4', 1, 2, True, slow_settings) != keys[0]
+
+    for age, key in enumerate(keys[:2]):
+        temp_path = cache.temp_path()
+        with open(temp_path, 'wb') as clip:
+            clip.write(b'x' * 100)
+        cache.commit(key, temp_path)
+        os.utime(cache.path(key), (time.time() - 100 + age, time.time() - 100 + age))
+    assert cache.get(keys[0])  # Marks the first clip as recently used
+
+    temp_path = cache.temp_path()
+    with open(temp_path, 'wb') as clip:
+        clip.write(b'x' * 100)
+    cache.commit(keys[2], temp_path)
+    assert cache.get(keys[0]) and cache.get(keys[2])
+    assert cache.get(keys[1]) is None
+    assert cache.size() == 200
+
+
+@patch('app.worker.supercut_queue')
+@patch('app.worker.supercut_catalogue', MagicMock())
+@patch('app.worker.media_cache')
+@patch('app.worker.probe', MagicMock(return_value={'duration': 60, 'audio': True}))
+@patch('app.worker.encode_segment')
+@patch('app.worker.concat_segments')
+@patch('app.worker.VideoFileClip')
+def test_supercut_reuses_cached_clips(
+    _, mock_concat, mock_encode, mock_media_cache, __, tmp_path,
+):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+    """
+    Test overlapping supercuts only encode each segment once, each source
+    video is only fetched once per supercut, and failed encodes are reported.
+    """
+    mock_encode.side_effect = lambda path, start, end, output, **kwargs: output
+    mock_media_cache.resolve.side_effect = lambda path: path
+    results = {'hits': {'hits': [{'_source': {
+        'web_resource': 'https://example.com/video.mp4',
+        'transcription': {'segments': [
+            {'text': 'large elephants', 'start': 4, 'end': 6},
+            {'text': 'small elephants', 'start': 10, 'end': 12},
+        ]},
+    }}]}}
+    with patch('app.worker.clip_cache', ClipCache(directory=str(tmp_path))), \
+            patch('app.worker.Image'):
+        worker.generate_supercut_background('elephants', results, 'task', 1, 'audio', cpus=2)
+        worker.generate_supercut_background('large elephants', results, 'task', 1, 'audio', cpus=2)
+    assert mock_encode.call_count == 2
+    assert mock_media_cache.resolve.call_count == 1
+    assert mock_concat.call_args_list[1].args[0] == mock_concat.call_args_list[0].args[0][:1]
+
+    # An encode that fails after its output has gone raises its own error
+    def failed_encode(*args, **_):
+        os.remove(args[3])
+        raise RuntimeError('ffmpeg exited with 1')
+    mock_encode.side_effect = failed_encode
+    with patch('app.worker.clip_cache', ClipCache(directory=str(tmp_path))), \
+            pytest.raises(RuntimeError, match='ffmpeg exited with 1'):
+        worker.cut_source_to_cache(
+            ('video.mp4', [(20, 22)], 0.5, 1, supercut.encode_profile('standard'), None),
+        )
+
+
+@patch('app.worker.media_cache', MagicMock(resolve=lambda path: path))
+@patch('app.worker.probe', MagicMock(return_value={'duration': 60, 'audio': True}))
+@patch('app.worker.encode_segment', MagicMock())
+@patch('app.worker.concat_segments', MagicMock())
+@patch('app.worker.VideoFileClip', MagicMock())
+@patch('app.worker.Image', MagicMock())
+def test_supercut_credits(tmp_path):
+    """
+    Test supercut credits follow the clips actually encoded, with overlapping
+    segments merged into one clip, on the supercut's page and its progress page.
+    """
+    results = {'hits': {'hits': [{'_source': {
+        'web_resource': 'https://example.com/video.mp4',
+        'works': [{'id': 1, 'slug': 'elephants', 'title': 'Elephants', 'acmi_id': 'A1'}],
+        'transcription': {'segments': [
+            {'text': 'large elephants', 'start': 4, 'end': 6},
+            {'text': 'more elephants', 'start': 6.5, 'end': 8},
+            {'text': 'small elephants', 'start': 20, 'end': 22},
+        ]},
+    }}]}}
+    queue = SupercutQueue(path=str(tmp_path / 'jobs.sqlite3'))
+    catalogue = temp_catalogue(tmp_path)
+    task_id = queue.submit('elephants', 1, 'audio')
+    (tmp_path / 'supercut_elephants.mp4').write_bytes(b'mp4')
+    with patch('app.worker.supercut_queue', queue), \
+            patch('app.worker.supercut_catalogue', catalogue), \
+            patch('app.worker.clip_cache', ClipCache(directory=str(tmp_path / 'clips'))):
+        worker.generate_supercut_background('elephants', results, task_id, 1, 'audio', cpus=1)
+    clips = catalogue.get('supercut_elephants.mp4')['clips']
+    assert [(clip['start'], clip['end']) for clip in clips] == [(3.5, 8.5), (19.5, 22.5)]
+    assert clips[0]['work'] == {'id': 1, 'slug': 'elephants', 'title': 'Elephants'}
+    assert json.loads(queue.get(task_id)['clips']) == clips
+
+    # One credit per merged clip, lasting as long as it plays
+    with patch('app.video.supercut_catalogue', catalogue), \
+            patch('app.video.supercut_queue', queue), \
+            patch('app.video.Search.search', return_value=mock_search), \
+            application.test_client() as client:
+        page = client.get('/?query=elephants&supercuts=on').text
+        fragment = client.get(f'/supercut_credits/{task_id}').text
+        assert client.get('/supercut_credits/unknown').status_code == 404
+    for html in (page, fragment):
+        assert re.findall(r'data-duration="([\d.]+)"', html) == ['5.0', '3.0']
+        assert 'https://www.acmi.net.au/works/1--elephants/' in html
+
+
+def test_group_windows():
+    """
+    Test clips are grouped per source video with overlapping windows merged in timestamp order.
+    """
+    clips = [
+        ('b.mp4', 9.5, 12),
+        ('a.mp4', 20, 22),
+        ('b.mp4', 0, 2),
+        ('b.mp4', 11.5, 14),
+        ('a.mp4', 1, 3),
+    ]
+    assert supercut.group_windows(clips) == [
+        ('b.mp4', [(0, 2), (9.5, 14)]),
+        ('a.mp4', [(1, 3), (20, 22)]),
+    ]
+    assert supercut.merge_windows([(0, 2), (2.5, 4)], gap=1) == [(0, 4)]
+
+
+class StandInHandler(SimpleHTTPRequestHandler):
+    """
+    A local stand-in for S3 that counts requests and advertises range support.
+    """
+    requests = []
+
+    def end_headers(self):
+        self.send_header('Accept-Ranges', 'bytes')
+        super().end_headers()
+
+    def do_GET(self):
+        StandInHandler.requests.append(('GET', self.path))
+        time.sleep(0.2)  # Slow enough for concurrent fetches to overlap
+        super().do_GET()
+
+    def do_HEAD(self):
+        StandInHandler.requests.append(('HEAD', self.path))
+        super().do_HEAD()
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+def test_media_cache(tmp_path):
+    """
+    Test concurrent fetches of a remote video share one download, and long
+    files are left remote for byte-range reads.
+    """
+    served = tmp_path / 'served'
+    served.mkdir()
+    (served / 'video.mp4').write_bytes(b'v' * 4096)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(StandInHandler, directory=str(served)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/video.mp4'
+    StandInHandler.requests = []
+    try:
+        cache = MediaCache(directory=str(tmp_path / 'media'))
+        with ThreadPoolExecutor(max_workers=5) as pool:
+            signed_urls = [f'{url}?signature={number}' for number in range(5)]
+            paths = list(pool.map(cache.resolve, signed_urls))
+        assert len(set(paths)) == 1
+        assert paths[0].endswith('.mp4')
+        with open(paths[0], 'rb') as media_file:
+            assert media_file.read() == b'v' * 4096
+        assert [request[0] for request in StandInHandler.requests] == ['GET']
+        # Downloads share a fixed set of lock files rather than leaving one per URL
+        (served / 'other.mp4').write_bytes(b'o' * 4096)
+        cache.max_bytes = cache.grace_seconds = 0
+        cache.resolve(url.replace('video', 'other'))
+        names = os.listdir(tmp_path / 'media')
+        assert len([name for name in names if name.endswith('.mp4')]) == 0
+        assert all(name.startswith('.') and len(name) == 8 for name in names)
+
+        StandInHandler.requests = []
+        (served / 'long.mp4').write_bytes(b'l' * 4096)
+        ranged = MediaCache(directory=str(tmp_path / 'media'), range_bytes=1024)
+        long_url = url.replace('video', 'long')
+        assert ranged.resolve(long_url) == long_url
+        assert [request[0] for request in StandInHandler.requests] == ['HEAD']
+        assert cache.resolve('/local/video.mp4') == '/local/video.mp4'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class XOSStandInHandler(BaseHTTPRequestHandler):
+    """
+    A local stand-in for the XOS API that serves pages of assets with ETags,
+    answers conditional requests and can fail on purpose.
+    """
+    protocol_version = 'HTTP/1.1'
+    requests = []
+    failures = []
+    pages = {}
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        XOSStandInHandler.requests.append({
+            'path': self.path,
+            'port': self.client_address[1],
+            'headers': dict(self.headers),
+        })
+        if XOSStandInHandler.failures:
+            status, headers = XOSStandInHandler.failures.pop(0)
+            self.respond(status, b'{}', headers)
+            return
+        page = re.search(r'page=(\d+)', self.path).group(1)
+        if page not in XOSStandInHandler.pages:
+            self.respond(404, b'{}')
+            return
+        body = json.dumps(XOSStandInHandler.pages[page]).encode('utf-8')
+        etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.respond(304, b'', {'ETag': etag})
+            return
+        headers = {'ETag': etag, 'Content-Type': 'application/json'}
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+        self.respond(200, body, headers)
+
+    def respond(self, status, body, headers=None):
+        """
+        Send a response that keeps the connection open.
+        """
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+def test_xos_api(tmp_path):
+    """
+    Test the XOS client reuses one connection, retries busy servers with backoff,
+    and serves unchanged pages from its on-disk cache via conditional requests.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), XOSStandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    XOSStandInHandler.requests = []
+    XOSStandInHandler.pages = {'1': {'count': 1, 'next': None, 'results': [{'id': 1}]}}
+    XOSStandInHandler.failures = [(503, {}), (429, {'Retry-After': '0'})]
+    try:
+        with patch('app.xos.XOS_API_ENDPOINT', f'http://127.0.0.1:{server.server_port}/api/'), \
+                patch('app.xos.XOS_API_TOKEN', 'secret'), \
+                patch('app.xos.XOS_BACKOFF_SECONDS', 0.01):
+            client = xos.XOSAPI(cache=xos.ResponseCache(directory=str(tmp_path / 'xos')))
+            assert client.get('assets', {'page': 1}).json()['results'] == [{'id': 1}]
+            assert client.stats['retries'] == 2
+            headers = XOSStandInHandler.requests[-1]['headers']
+            assert headers['Authorization'] == 'Token secret'
+            assert 'gzip' in headers['Accept-Encoding']
+
+            # Unchanged pages are revalidated rather than downloaded again
+            response = client.get('assets', {'page': 1})
+            assert response.json()['results'] == [{'id': 1}]
+            assert response.from_cache
+            assert XOSStandInHandler.requests[-1]['headers']['If-None-Match']
+            assert client.stats['not_modified'] == 1
+
+            XOSStandInHandler.pages['1']['results'].append({'id': 2})
+            assert len(client.get('assets', {'page': 1}).json()['results']) == 2
+            assert client.stats['downloaded'] == 2
+            # Every request went over one pooled connection
+            assert len({request['port'] for request in XOSStandInHandler.requests}) == 1
+
+            # Within the TTL a resumed run doesn't ask XOS at all
+            requests_made = len(XOSStandInHandler.requests)
+            resumed = xos.XOSAPI(cache=xos.ResponseCache(directory=str(tmp_path / 'xos'), ttl=60))
+            assert len(resumed.get('assets', {'page': 1}).json()['results']) == 2
+            assert resumed.stats['cached'] == 1
+            assert len(XOSStandInHandler.requests) == requests_made
+
+            # Errors that won't go away aren't retried
+            with pytest.raises(requests.exceptions.HTTPError):
+                client.get('assets', {'page': 2})
+            assert len(XOSStandInHandler.requests) == requests_made + 1
+    finally:
+        server.shutdown()
+        server.server_close()